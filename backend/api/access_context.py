@@ -0,0 +1,174 @@
+"""
+Контекст доступа пользователя: роль, нормализованный БИН и договоры, к которым у него есть доступ.
+Вычисляется один раз и хранится в отдельном кеше (settings.CACHES['access_context'] - память процесса
+или Redis) с коротким временем жизни, поэтому представления не выполняют User.objects.get и запрос
+договоров на каждый запрос API. Кеш сбрасывается сигналами при сохранении/удалении пользователя или договора.
+"""
+import logging
+from typing import Dict, FrozenSet, NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Contract, User, normalize_bin
+
+logger = logging.getLogger('api')
+
+CACHE_ALIAS = 'access_context'
+CACHE_KEY = 'access_context:{}'
+
+# Статусы договоров, по которым работодатель видит контингент и маршрутные листы
+CONTRACT_ACCESS_STATUSES = ('approved', 'active', 'in_progress', 'sent', 'pending_approval')
+
+
+class AccessContext(NamedTuple):
+    user_id: int
+    role: str
+    clinic_role: Optional[str]
+    bin: str  # Нормализованный БИН/ИИН организации ('' - не указан)
+    # Договоры, которые пользователь видит в списке договоров: ID -> статус.
+    # Работодатель - employer = пользователь или employer_bin совпадает с его БИН;
+    # клиника - основная клиника, субподрядчик или передавшая договор на субподряд
+    contracts: Dict[int, str]
+    # Договоры, где клиника - основная (clinic = пользователь): доступ к контингенту и планам по договору
+    clinic_contract_ids: FrozenSet[int] = frozenset()
+
+    @property
+    def is_clinic(self):
+        return self.role == 'clinic'
+
+    @property
+    def is_employer(self):
+        return self.role == 'employer'
+
+    def contract_ids(self, statuses=None):
+        """ID договоров пользователя (с указанными статусами или все)"""
+        if statuses is None:
+            return list(self.contracts)
+        return [contract_id for contract_id, status in self.contracts.items() if status in statuses]
+
+    def can_access_contract(self, contract_id):
+        """Доступ к данным по договору (контингент, планы): клиника - основная клиника договора, работодатель - сторона договора"""
+        try:
+            contract_id = int(contract_id)
+        except (TypeError, ValueError):
+            return False
+        if self.is_clinic:
+            return contract_id in self.clinic_contract_ids
+        if self.is_employer:
+            return contract_id in self.contracts
+        return False
+
+
+def _bin_variants(registration_data):
+    """БИН из данных регистрации в нормализованном и исходном виде (договоры могут хранить БИН с пробелами)"""
+    raw = (registration_data or {}).get('bin') or (registration_data or {}).get('inn')
+    if not raw:
+        return ()
+    return tuple({normalize_bin(raw), str(raw), str(raw).strip()} - {''})
+
+
+def build_access_context(user):
+    """Вычислить контекст доступа пользователя (без кеша)"""
+    contracts = {}
+    clinic_contract_ids = frozenset()
+    if user.role == 'employer':
+        condition = Q(employer=user)
+        bins = _bin_variants(user.registration_data)
+        if bins:
+            condition |= Q(employer_bin__in=bins)
+        contracts = dict(Contract.objects.filter(condition).values_list('id', 'status'))
+    elif user.role == 'clinic':
+        rows = list(Contract.objects.filter(
+            Q(clinic=user) | Q(subcontractor_clinic=user) | Q(original_clinic=user)
+        ).values_list('id', 'status', 'clinic_id'))
+        contracts = {contract_id: status for contract_id, status, _ in rows}
+        clinic_contract_ids = frozenset(contract_id for contract_id, _, clinic_id in rows if clinic_id == user.id)
+
+    return AccessContext(
+        user_id=user.id,
+        role=user.role,
+        clinic_role=user.clinic_role,
+        bin=user.bin or normalize_bin(
+            (user.registration_data or {}).get('bin') or (user.registration_data or {}).get('inn')
+        ),
+        contracts=contracts,
+        clinic_contract_ids=clinic_contract_ids,
+    )
+
+
+def _cache():
+    # Без отдельного кеша в настройках (например, в тестовых) - кеш по умолчанию
+    return caches[CACHE_ALIAS if CACHE_ALIAS in settings.CACHES else 'default']
+
+
+def get_access_context(user_id):
+    """
+    Контекст доступа пользователя из кеша (вычисляется при отсутствии).
+    Возвращает None, если пользователь не найден.
+    """
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+    key = CACHE_KEY.format(user_id)
+    context = _cache().get(key)
+    if context is not None:
+        return context
+
+    try:
+        user = User.objects.get(id=user_id)
+    except User.DoesNotExist:
+        return None
+    context = build_access_context(user)
+    _cache().set(key, context, timeout=getattr(settings, 'ACCESS_CONTEXT_CACHE_TIMEOUT', 60))
+    return context
+
+
+def invalidate_access_context(*user_ids):
+    """Сбросить кешированный контекст доступа пользователей"""
+    keys = [CACHE_KEY.format(user_id) for user_id in set(user_ids) if user_id]
+    if keys:
+        _cache().delete_many(keys)
+
+
+@receiver([post_save, post_delete], sender=User)
+def _invalidate_user_access_context(sender, instance, **kwargs):
+    invalidate_access_context(instance.pk)
+
+
+CONTRACT_PARTY_FIELDS = ('employer_id', 'clinic_id', 'subcontractor_clinic_id', 'original_clinic_id', 'employer_bin')
+
+
+@receiver(pre_save, sender=Contract)
+def _remember_contract_parties(sender, instance, **kwargs):
+    # Прежние стороны и БИН договора: после смены работодателя/клиники/БИН сбрасывается и их контекст
+    instance._access_previous_parties = None
+    if instance.pk:
+        instance._access_previous_parties = (
+            Contract.objects.filter(pk=instance.pk).values_list(*CONTRACT_PARTY_FIELDS).first()
+        )
+
+
+@receiver([post_save, post_delete], sender=Contract)
+def _invalidate_contract_access_context(sender, instance, **kwargs):
+    # Стороны договора и работодатели, которые видят договор по БИН (employer еще не привязан) -
+    # текущие и, если договор изменен, прежние
+    parties = [tuple(getattr(instance, field) for field in CONTRACT_PARTY_FIELDS)]
+    previous = getattr(instance, '_access_previous_parties', None)
+    if previous and previous != parties[0]:
+        parties.append(previous)
+
+    user_ids = []
+    bins = set()
+    for *party_user_ids, employer_bin in parties:
+        user_ids.extend(party_user_ids)
+        if normalize_bin(employer_bin):
+            bins.add(normalize_bin(employer_bin))
+    if bins:
+        user_ids.extend(User.objects.filter(role='employer', bin__in=bins).values_list('id', flat=True))
+    invalidate_access_context(*user_ids)
@@ -2,7 +2,7 @@ from django.contrib import admin
 from .models import (
     User, ContingentEmployee, CalendarPlan, RouteSheet, DoctorExamination, Expertise,
     EmergencyNotification, HealthImprovementPlan, RecommendationTracking, Doctor,
-    LaboratoryTest, FunctionalTest, Referral, PatientQueue, Contract
+    LaboratoryTest, FunctionalTest, Referral, PatientQueue, Contract, BackgroundJob
 )
 
 # Настройка стандартного Django admin
@@ -26,4 +26,4 @@ admin.site.register(FunctionalTest)
 admin.site.register(Referral)
 admin.site.register(PatientQueue)
 admin.site.register(Contract)
-
+admin.site.register(BackgroundJob)
@@ -0,0 +1,16 @@
+from importlib import import_module
+
+from django.apps import AppConfig
+
+
+class ApiConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'api'
+
+    # Модули с обработчиками сигналов (сброс кешей при изменении данных) - импортируются только ради
+    # регистрации @receiver, поэтому загружаются явно через import_module
+    signal_modules = ('access_context', 'route_sheet_builder')
+
+    def ready(self):
+        for module in self.signal_modules:
+            import_module(f'{self.name}.{module}')
@@ -0,0 +1,169 @@
+"""
+Очередь фоновых задач в БД (без внешнего брокера).
+Задачи ставятся в очередь из API и выполняются командой `python manage.py run_background_jobs`.
+Задача, завершившаяся ошибкой, возвращается в очередь с задержкой, пока не исчерпаны попытки (max_attempts);
+JobFailed - ошибка, при которой повтор не поможет (неверный файл и т.п.).
+Прогресс задачи, выполняющейся в транзакции, записывается через отдельное соединение (см. update_job_progress).
+"""
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import BackgroundJob
+
+logger = logging.getLogger('api')
+
+# Обработчики задач по типу. Обработчик получает BackgroundJob и возвращает dict с результатом.
+JOB_HANDLERS = {
+    'contingent_import': 'api.contingent_import.run_import_job',
+    'plan_route_sheets': 'api.route_sheet_builder.run_plan_route_sheets_job',
+}
+
+
+class JobFailed(Exception):
+    """Задача завершается с ошибкой сразу, без повторных попыток"""
+
+
+def enqueue_job(job_type, user=None, contract=None, payload=None, file_name='', file_data=None, max_attempts=None):
+    """Поставить задачу в очередь (max_attempts по умолчанию - BACKGROUND_JOB_MAX_ATTEMPTS)"""
+    job = BackgroundJob.objects.create(
+        job_type=job_type,
+        user=user,
+        contract=contract,
+        payload=payload or {},
+        file_name=file_name,
+        file_data=file_data,
+        max_attempts=max_attempts or getattr(settings, 'BACKGROUND_JOB_MAX_ATTEMPTS', 3),
+    )
+    logger.info(f"Background job {job.id} ({job_type}) queued")
+    return job
+
+
+# Отдельное соединение с БД для записи прогресса (свое в каждом потоке обработчика)
+_progress_local = threading.local()
+
+
+def _progress_connection():
+    """
+    Соединение для записи прогресса. Внутри транзакции запись через основное соединение не видна
+    до ее завершения (ни в API, ни для requeue_stale_jobs), а во время COPY запросы в нем невозможны,
+    поэтому используется отдельное соединение в режиме автокоммита.
+    SQLite не допускает параллельной записи - там всегда основное соединение.
+    """
+    if connection.vendor == 'sqlite' or not connection.in_atomic_block:
+        return connection
+    progress_connection = getattr(_progress_local, 'connection', None)
+    if progress_connection is None:
+        progress_connection = _progress_local.connection = connections.create_connection(DEFAULT_DB_ALIAS)
+    return progress_connection
+
+
+def close_progress_connection():
+    """Закрыть отдельное соединение для прогресса (после выполнения задачи)"""
+    progress_connection = getattr(_progress_local, 'connection', None)
+    if progress_connection is not None:
+        _progress_local.connection = None
+        progress_connection.close()
+
+
+def update_job_progress(job, **progress):
+    """Обновить прогресс задачи без перезаписи остальных полей"""
+    job.progress = {**(job.progress or {}), **progress}
+    updated_at = timezone.now()
+    progress_connection = _progress_connection()
+    if progress_connection is not connection:
+        opts = BackgroundJob._meta
+        progress_field, updated_at_field = opts.get_field('progress'), opts.get_field('updated_at')
+        quote = progress_connection.ops.quote_name
+        table, pk_column = quote(opts.db_table), quote(opts.pk.column)
+        with progress_connection.cursor() as cursor:
+            # SKIP LOCKED: если строку задачи заблокировала транзакция основного соединения,
+            # ожидание в отдельном соединении не закончится - тогда пишем через основное
+            cursor.execute(
+                f"UPDATE {table} SET {quote(progress_field.column)} = %s, {quote(updated_at_field.column)} = %s "
+                f"WHERE {pk_column} = (SELECT {pk_column} FROM {table} WHERE {pk_column} = %s FOR UPDATE SKIP LOCKED)",
+                [
+                    progress_field.get_db_prep_save(job.progress, progress_connection),
+                    updated_at_field.get_db_prep_save(updated_at, progress_connection),
+                    job.pk,
+                ],
+            )
+            if cursor.rowcount:
+                return
+    BackgroundJob.objects.filter(pk=job.pk).update(progress=job.progress, updated_at=updated_at)
+
+
+def will_retry(job):
+    """Вернется ли задача в очередь при ошибке текущей попытки"""
+    return job.attempts < job.max_attempts
+
+
+def claim_next_job():
+    """Взять следующую задачу из очереди. Блокировка SKIP LOCKED позволяет запускать несколько обработчиков."""
+    with transaction.atomic():
+        job = (
+            BackgroundJob.objects.select_for_update(skip_locked=True)
+            .filter(status='pending')
+            .filter(Q(run_after__isnull=True) | Q(run_after__lte=timezone.now()))
+            .order_by('created_at')
+            .first()
+        )
+        if not job:
+            return None
+        job.status = 'running'
+        job.started_at = timezone.now()
+        job.attempts += 1
+        job.save(update_fields=['status', 'started_at', 'attempts', 'updated_at'])
+    return job
+
+
+def requeue_stale_jobs(timeout_minutes):
+    """
+    Вернуть в очередь задачи, зависшие в статусе running (например, после падения обработчика).
+    Задачи, у которых попытки исчерпаны, завершаются с ошибкой.
+    """
+    now = timezone.now()
+    stale = BackgroundJob.objects.filter(status='running', updated_at__lt=now - timedelta(minutes=timeout_minutes))
+    stale.filter(attempts__gte=F('max_attempts')).update(status='failed', finished_at=now, file_data=None, updated_at=now)
+    return stale.filter(attempts__lt=F('max_attempts')).update(status='pending', updated_at=now)
+
+
+def run_job(job):
+    """
+    Выполнить задачу и сохранить результат или ошибку.
+    При ошибке задача возвращается в очередь (status='pending', run_after - время повтора),
+    если попытки не исчерпаны и ошибка не JobFailed.
+    """
+    handler_path = JOB_HANDLERS.get(job.job_type)
+    try:
+        if not handler_path:
+            raise JobFailed(f'Неизвестный тип задачи: {job.job_type}')
+        handler = import_string(handler_path)
+        try:
+            job.result = handler(job) or {}
+        finally:
+            close_progress_connection()
+        job.status = 'completed'
+    except Exception as e:
+        job.errors = (job.errors or []) + [str(e)]
+        if not isinstance(e, JobFailed) and will_retry(job):
+            delay = getattr(settings, 'BACKGROUND_JOB_RETRY_DELAY', 60) * job.attempts
+            logger.warning(f"Background job {job.id} ({job.job_type}) attempt {job.attempts}/{job.max_attempts} failed, retry in {delay}s: {str(e)}", exc_info=True)
+            job.status = 'pending'
+            job.run_after = timezone.now() + timedelta(seconds=delay)
+            # Файл и параметры сохраняются для следующей попытки
+            job.save(update_fields=['status', 'errors', 'run_after', 'payload', 'updated_at'])
+            return job
+        logger.error(f"Background job {job.id} ({job.job_type}) failed: {str(e)}", exc_info=True)
+        job.status = 'failed'
+    job.finished_at = timezone.now()
+    # Файл больше не нужен - не храним его в БД после обработки
+    job.file_data = None
+    job.save(update_fields=['status', 'result', 'errors', 'finished_at', 'file_data', 'updated_at'])
+    return job
@@ -0,0 +1,927 @@
+"""
+Вспомогательные компоненты загрузки списка контингента (upload_excel)
+"""
+import codecs
+import csv
+import hashlib
+import io
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+from openpyxl import load_workbook
+
+from .contingent_rows import _add_issue, is_valid_iin, normalize_rows, parse_employee_row
+from .models import ContingentEmployee
+
+logger = logging.getLogger('api')
+
+
+# Признаки нашего шаблона в первых строках файла
+TEMPLATE_TITLE_MARKER = 'СПИСОК лиц, подлежащих обязательному медицинскому осмотру'
+TEMPLATE_ORDER_MARKER = '№ ҚР ДСМ-131/2020'
+TEMPLATE_MISMATCH_DETAIL = 'Пожалуйста, скачайте последний действующий шаблон и заполните его'
+
+# Строка с заголовками колонок ищется только среди первых строк файла
+HEADER_SCAN_ROWS = 5
+
+REQUIRED_COLUMNS = {
+    'name': 'ФИО',
+    'department': 'Объект/участок',
+    'position': 'Занимаемая должность',
+}
+
+
+class ContingentFileError(Exception):
+    """Файл контингента не может быть загружен (не наш шаблон, слишком большой и т.п.)"""
+
+    def __init__(self, error, detail=''):
+        super().__init__(error)
+        self.error = error
+        self.detail = detail
+
+    def as_response_data(self):
+        return {'error': self.error, 'detail': self.detail}
+
+
+def build_column_map(header_values):
+    """Маппинг колонок (поиск по заголовкам). Индексы колонок начинаются с 1."""
+    column_map = {}
+    for idx, value in enumerate(header_values, start=1):
+        val = str(value).lower() if value else ''
+        if '№ п/п' in val or 'номер' in val:
+            column_map['number'] = idx
+        elif 'фио' in val or 'ф.и.о' in val:
+            column_map['name'] = idx
+        elif 'дата рождения' in val:
+            column_map['birth_date'] = idx
+        elif 'пол' in val:
+            column_map['gender'] = idx
+        elif 'объект' in val or 'участок' in val:
+            column_map['department'] = idx
+        elif 'должность' in val:
+            column_map['position'] = idx
+        elif 'общий стаж' in val:
+            column_map['total_experience'] = idx
+        elif 'стаж по должности' in val or 'стаж по занимаемой' in val:
+            column_map['position_experience'] = idx
+        elif 'последний медосмотр' in val or 'дата последнего' in val:
+            column_map['last_examination'] = idx
+        elif 'вредность' in val or 'профессиональная' in val:
+            column_map['harmful_factors'] = idx
+        elif 'примечание' in val:
+            column_map['notes'] = idx
+        elif 'иин' in val or 'иип' in val:
+            column_map['iin'] = idx
+        elif 'телефон' in val:
+            column_map['phone'] = idx
+        elif 'квартал' in val:
+            column_map['quarter'] = idx
+    return column_map
+
+
+class ContingentSheet:
+    """
+    Потоковое чтение списка контингента.
+    Заголовки определяются по первым HEADER_SCAN_ROWS строкам, строки данных
+    отдаются генератором, поэтому в памяти не держится весь файл.
+    layout=(header_row, column_map) - структура, уже определенная при проверке файла
+    (validate_excel); в этом случае проверка шаблона и поиск заголовков пропускаются.
+    require_template=False - не требовать заголовок нашего шаблона в первых строках
+    (CSV/TSV выгрузки из кадровых систем начинаются сразу со строки заголовков).
+    """
+
+    def __init__(self, rows, max_rows=None, on_close=None, layout=None, require_template=True):
+        self._rows = iter(rows)
+        self._on_close = on_close
+        self.max_rows = max_rows
+        self.require_template = require_template
+        # Оценка количества строк данных (по размеру листа Excel или числу строк CSV)
+        self.row_count_hint = None
+        head = list(islice(self._rows, HEADER_SCAN_ROWS))
+        if layout:
+            self.header_row, self.column_map = layout
+        else:
+            self.header_row, self.column_map = self._parse_header(head)
+        # Строки после заголовка, уже прочитанные при поиске заголовков
+        self._head_data_rows = head[self.header_row:]
+
+    def _parse_header(self, head):
+        if self.require_template:
+            # 1. Проверяем заголовок документа в первой строке
+            first_cell = head[0][0] if head and head[0] else None
+            if not first_cell or TEMPLATE_TITLE_MARKER not in str(first_cell):
+                raise ContingentFileError('Загружаемый файл не соответствует шаблону', TEMPLATE_MISMATCH_DETAIL)
+
+            # 2. Проверяем наличие ссылки на приказ во второй строке
+            second_cell = head[1][0] if len(head) > 1 and head[1] else None
+            if not second_cell or TEMPLATE_ORDER_MARKER not in str(second_cell):
+                raise ContingentFileError('Загружаемый файл не соответствует шаблону', TEMPLATE_MISMATCH_DETAIL)
+
+        # Ищем строку с заголовками колонок
+        header_row = None
+        for idx, row in enumerate(head, start=1):
+            row_values = [value for value in row if value]
+            if any('ФИО' in str(val) or '№ п/п' in str(val) for val in row_values):
+                header_row = idx
+                break
+
+        if not header_row:
+            raise ContingentFileError('Не найдены заголовки таблицы в шаблоне', TEMPLATE_MISMATCH_DETAIL)
+
+        column_map = build_column_map(head[header_row - 1])
+
+        # 3. Проверяем наличие обязательных колонок
+        missing_columns = [label for key, label in REQUIRED_COLUMNS.items() if key not in column_map]
+        if missing_columns:
+            raise ContingentFileError(
+                'Загружаемый файл не соответствует шаблону',
+                f'Отсутствуют обязательные колонки: {", ".join(missing_columns)}. {TEMPLATE_MISMATCH_DETAIL}'
+            )
+
+        return header_row, column_map
+
+    def iter_data_rows(self):
+        """Генератор (номер строки, кортеж значений) для строк после заголовка"""
+        try:
+            data_rows = chain(self._head_data_rows, self._rows)
+            for count, row in enumerate(data_rows, start=1):
+                if self.max_rows and count > self.max_rows:
+                    raise ContingentFileError(
+                        'Файл слишком большой',
+                        f'Максимальное количество строк в одном файле: {self.max_rows}. Разделите список на несколько файлов'
+                    )
+                yield self.header_row + count, tuple(row)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._on_close:
+            self._on_close()
+            self._on_close = None
+
+
+def open_contingent_workbook(file, max_rows=None, layout=None):
+    """
+    Открыть Excel-файл контингента в режиме read-only/values-only.
+    Файлы, у которых по размеру листа больше max_rows строк, отклоняются до чтения данных.
+    """
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        worksheet = workbook.active
+        if max_rows and worksheet.max_row and worksheet.max_row > max_rows + HEADER_SCAN_ROWS:
+            raise ContingentFileError(
+                'Файл слишком большой',
+                f'В файле {worksheet.max_row} строк, максимально допустимо {max_rows}. Разделите список на несколько файлов'
+            )
+        sheet = ContingentSheet(worksheet.iter_rows(values_only=True), max_rows=max_rows, on_close=workbook.close, layout=layout)
+        if worksheet.max_row:
+            sheet.row_count_hint = max(worksheet.max_row - sheet.header_row, 0)
+        return sheet
+    except Exception:
+        workbook.close()
+        raise
+
+
+# Расширения текстовых файлов и их разделители (None - определяется по содержимому)
+CSV_EXTENSIONS = {
+    '.csv': None,
+    '.tsv': '\t',
+    '.txt': None,
+}
+CSV_SNIFF_BYTES = 64 * 1024
+
+
+def _detect_csv_encoding(sample):
+    """UTF-8 (в том числе с BOM) или Windows-1251 - типичная кодировка выгрузок Excel/1С"""
+    try:
+        sample.decode('utf-8')
+        return 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        # Обрезанный на границе выборки многобайтовый символ не считается ошибкой
+        if e.start >= len(sample) - 3:
+            return 'utf-8-sig'
+        return 'cp1251'
+
+
+def _count_csv_lines(file, chunk_size=1024 * 1024):
+    """Число строк файла (по переводам строки) - оценка числа записей для выбора способа загрузки"""
+    file.seek(0)
+    lines = 0
+    last_chunk = b''
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        lines += chunk.count(b'\n')
+        last_chunk = chunk
+    if last_chunk and not last_chunk.endswith(b'\n'):
+        lines += 1
+    file.seek(0)
+    return lines
+
+
+def open_contingent_csv(file, max_rows=None, layout=None, delimiter=None):
+    """
+    Открыть CSV/TSV-файл контингента. Файл декодируется и разбирается модулем csv построчно,
+    заголовки определяются тем же способом, что и для Excel (без обязательного заголовка шаблона).
+    """
+    file.seek(0)
+    sample = file.read(CSV_SNIFF_BYTES)
+    file.seek(0)
+    encoding = _detect_csv_encoding(sample)
+
+    if delimiter is None:
+        try:
+            delimiter = csv.Sniffer().sniff(sample.decode(encoding, errors='ignore'), delimiters=',;\t').delimiter
+        except csv.Error:
+            delimiter = ';'
+
+    # Число строк CSV заранее неизвестно - считаем переводы строк (без разбора), как max_row у Excel.
+    # Переводы строк внутри кавычек завышают оценку, для выбора способа загрузки это не важно
+    line_count = _count_csv_lines(file)
+
+    reader = csv.reader(codecs.getreader(encoding)(file, errors='replace'), delimiter=delimiter)
+    sheet = ContingentSheet(reader, max_rows=max_rows, layout=layout, require_template=False)
+    sheet.row_count_hint = max(line_count - sheet.header_row, 0)
+    return sheet
+
+
+def open_contingent_file(file, max_rows=None, layout=None, file_name=None, validation=None):
+    """
+    Открыть файл контингента: CSV/TSV - потоково модулем csv, остальные - как Excel.
+    validation - сохраненный результат validate_contingent_file для этого содержимого (get_cached_validation):
+    структура файла берется из него, слишком большой файл отклоняется до чтения строк,
+    а число строк для выбора способа загрузки известно точно.
+    """
+    if validation:
+        layout = cached_layout(validation)
+        if max_rows and validation['rows_total'] > max_rows:
+            raise ContingentFileError(
+                'Файл слишком большой',
+                f'В файле {validation["rows_total"]} строк, максимально допустимо {max_rows}. Разделите список на несколько файлов'
+            )
+
+    name = (file_name or getattr(file, 'name', '') or '').lower()
+    for extension, delimiter in CSV_EXTENSIONS.items():
+        if name.endswith(extension):
+            sheet = open_contingent_csv(file, max_rows=max_rows, layout=layout, delimiter=delimiter)
+            break
+    else:
+        sheet = open_contingent_workbook(file, max_rows=max_rows, layout=layout)
+
+    if validation:
+        sheet.row_count_hint = validation['rows_total']
+    return sheet
+
+
+class IndexedEmployee(NamedTuple):
+    """Компактная запись индекса дубликатов (без объекта модели)"""
+    pk: Optional[int]
+    name: str
+
+
+class ContingentDuplicateIndex:
+    """
+    Хеш-индексы сотрудников договора для поиска дубликатов за O(1).
+    Существующие записи договора загружаются одним запросом, строки файла
+    добавляются в индекс по мере разбора - так находятся и дубликаты внутри файла.
+    По умолчанию индекс хранит только (pk, ФИО), а не объекты модели: строки файла после
+    записи очередной пачки в БД не удерживаются в памяти. keep_objects=True - хранить сами
+    объекты (нужно для сравнения и обновления при слиянии).
+    """
+
+    def __init__(self, keep_objects=False):
+        self.keep_objects = keep_objects
+        self.by_iin = {}
+        self.by_name_birth = {}
+        self.by_name = {}
+
+    @classmethod
+    def for_contract(cls, contract, full=False):
+        """
+        Построить индекс по уже загруженным сотрудникам договора.
+        full=True загружает все поля (нужно для сравнения при слиянии), иначе только ключевые.
+        """
+        index = cls(keep_objects=full)
+        if contract is None:
+            return index
+        queryset = ContingentEmployee.objects.filter(contract=contract).order_by('id')
+        if not full:
+            queryset = queryset.only('id', 'name', 'birth_date', 'iin')
+        for employee in queryset.iterator(chunk_size=2000):
+            index.add(employee)
+        return index
+
+    @staticmethod
+    def name_key(name):
+        """Ключ ФИО без учета регистра (аналог name__iexact)"""
+        return str(name or '').strip().casefold()
+
+    def add(self, employee):
+        """Добавить сотрудника (сохраненного или еще нет) в индексы. Первая запись с ключом имеет приоритет."""
+        name_key = self.name_key(employee.name)
+        iin, birth_date = employee.iin, employee.birth_date
+        if not self.keep_objects:
+            employee = IndexedEmployee(employee.pk, employee.name)
+        if is_valid_iin(iin):
+            self.by_iin.setdefault(iin, employee)
+        self.by_name_birth.setdefault((name_key, birth_date), employee)
+        self.by_name.setdefault(name_key, employee)
+
+    def find(self, iin, name, birth_date):
+        """
+        Поиск дубликата в том же порядке, что и прежние запросы к БД:
+        по ИИН, затем по ФИО + дате рождения, затем только по ФИО.
+        Возвращает (сотрудник, причина) или (None, None).
+        """
+        if is_valid_iin(iin) and iin in self.by_iin:
+            return self.by_iin[iin], 'iin'
+        name_key = self.name_key(name)
+        if (name_key, birth_date) in self.by_name_birth:
+            return self.by_name_birth[(name_key, birth_date)], 'name_birth'
+        if name_key in self.by_name:
+            return self.by_name[name_key], 'name'
+        return None, None
+
+
+# Результат проверки файла хранится в кеше по хешу содержимого
+VALIDATION_CACHE_PREFIX = 'contingent_validation'
+VALIDATION_CACHE_TIMEOUT = 60 * 60 * 24  # 24 часа
+# Максимум замечаний в ответе validate_excel (счетчики считаются по всем строкам)
+VALIDATION_MAX_ISSUES = 1000
+
+
+def file_content_hash(file):
+    """SHA-256 содержимого загруженного файла (позиция чтения возвращается в начало)"""
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(1024 * 1024), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def get_cached_validation(content_hash):
+    """Сохраненный результат проверки файла с таким содержимым или None"""
+    if not content_hash:
+        return None
+    return cache.get(f'{VALIDATION_CACHE_PREFIX}:{content_hash}')
+
+
+def cached_layout(validation):
+    """Структура файла (строка заголовков, маппинг колонок) из сохраненной проверки"""
+    if not validation:
+        return None
+    return validation['header_row'], validation['column_map']
+
+
+def validate_contingent_file(file, contract=None, max_rows=None):
+    """
+    Проверка файла контингента без записи в БД: тот же разбор шаблона и строк, что и при загрузке.
+    Возвращает отчет с ошибками/предупреждениями по строкам и хешем содержимого.
+    Для файлов с корректной структурой результат кешируется по хешу: структура файла, число строк
+    и ошибок разбора. Последующая загрузка того же файла (upload_excel) не ищет заголовки заново,
+    отклоняет слишком большой файл до чтения строк и возвращает сохраненную сводку проверки.
+    Предупреждения (в том числе дубликаты) зависят от договора и в кеш не попадают.
+    """
+    content_hash = file_content_hash(file)
+    report = {
+        'valid': False,
+        'content_hash': content_hash,
+        'rows_total': 0,
+        'rows_importable': 0,
+        'error_count': 0,
+        'warning_count': 0,
+        'errors': [],
+        'warnings': [],
+        'truncated': False,
+    }
+
+    try:
+        sheet = open_contingent_file(file, max_rows=max_rows)
+    except ContingentFileError as e:
+        report['error_count'] = 1
+        report['errors'].append({'level': 'error', 'row': None, 'field': 'file', 'message': e.error, 'value': e.detail})
+        return report
+
+    # Дубликаты ищутся так же, как при загрузке: среди сотрудников договора и строк самого файла
+    duplicate_index = ContingentDuplicateIndex.for_contract(contract)
+    issues = []
+    try:
+        for row_idx, row in sheet.iter_data_rows():
+            if not any(row):
+                continue
+            report['rows_total'] += 1
+
+            row_issues = []
+            fields = parse_employee_row(row, sheet.column_map, row_idx, issues=row_issues)
+            if fields is not None:
+                existing, duplicate_reason = duplicate_index.find(fields['iin'], fields['name'], fields['birth_date'])
+                if existing:
+                    _add_issue(row_issues, 'warning', row_idx, 'name', f'Дубликат ({duplicate_reason}) - строка будет пропущена', fields['name'])
+                else:
+                    duplicate_index.add(ContingentEmployee(**fields))
+                    report['rows_importable'] += 1
+
+            for issue in row_issues:
+                report[f"{issue['level']}_count"] += 1
+            if len(issues) < VALIDATION_MAX_ISSUES:
+                issues.extend(row_issues[:VALIDATION_MAX_ISSUES - len(issues)])
+            elif row_issues:
+                report['truncated'] = True
+    except ContingentFileError as e:
+        report['error_count'] += 1
+        issues.append({'level': 'error', 'row': None, 'field': 'file', 'message': e.error, 'value': e.detail})
+        return dict(report, **_split_issues(issues))
+
+    report.update(_split_issues(issues))
+    report['valid'] = report['error_count'] == 0
+    report['columns'] = sorted(sheet.column_map)
+
+    cache.set(f'{VALIDATION_CACHE_PREFIX}:{content_hash}', {
+        'header_row': sheet.header_row,
+        'column_map': sheet.column_map,
+        'valid': report['valid'],
+        'rows_total': report['rows_total'],
+        'error_count': report['error_count'],
+    }, timeout=VALIDATION_CACHE_TIMEOUT)
+    return report
+
+
+def _split_issues(issues):
+    return {
+        'errors': [issue for issue in issues if issue['level'] == 'error'],
+        'warnings': [issue for issue in issues if issue['level'] == 'warning'],
+    }
+
+
+# Размер пачки строк, передаваемой в процесс при параллельном разборе
+PARALLEL_CHUNK_SIZE = 2000
+
+
+def iter_normalized_rows(sheet, workers=1, parallel_threshold=0):
+    """
+    Непустые строки файла -> (номер строки, поля или None) в порядке строк файла.
+    Если в файле больше parallel_threshold строк и workers > 1, строки разбираются пачками
+    в ProcessPoolExecutor; в работе одновременно не более 2 * workers пачек.
+    """
+    rows = ((row_idx, row) for row_idx, row in sheet.iter_data_rows() if any(row))
+    column_map = sheet.column_map
+
+    head = list(islice(rows, parallel_threshold)) if parallel_threshold else []
+    if workers < 2 or not parallel_threshold or len(head) < parallel_threshold:
+        for row_idx, row in chain(head, rows):
+            yield row_idx, parse_employee_row(row, column_map, row_idx)
+        return
+
+    rows = chain(head, rows)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        while True:
+            chunk = list(islice(rows, PARALLEL_CHUNK_SIZE))
+            if chunk:
+                pending.append(executor.submit(normalize_rows, chunk, column_map))
+            if pending and (not chunk or len(pending) >= workers * 2):
+                yield from pending.popleft().result()
+            elif not chunk:
+                break
+
+
+# Поля, которые берутся из файла и сравниваются при слиянии (mode=merge)
+MERGE_FIELDS = [
+    'name', 'birth_date', 'gender', 'department', 'position', 'total_experience_years',
+    'position_experience_years', 'last_examination_date', 'harmful_factors', 'notes', 'iin', 'phone', 'quarter',
+]
+
+
+class ContingentImporter:
+    """
+    Загрузка строк файла в договор: разбор, поиск дубликатов по индексу
+    и массовая запись пачками в одной транзакции.
+
+    Режимы:
+    - обычный: новые сотрудники добавляются, дубликаты пропускаются
+      (replace_existing=True - перед вставкой удаляются все сотрудники договора);
+    - merge=True: строки сопоставляются с существующими сотрудниками по ИИН или ФИО + дате рождения,
+      изменившиеся записи обновляются, новые добавляются, отсутствующие в файле удаляются
+      только при delete_missing=True. ID существующих сотрудников сохраняются.
+
+    loader: 'orm' - bulk_create, 'copy' - PostgreSQL COPY (ContingentCopyLoader),
+    'auto' - COPY для больших файлов (CONTINGENT_IMPORT_COPY_THRESHOLD строк и больше).
+    """
+
+    # Как часто (в строках) сообщать о прогрессе
+    PROGRESS_EVERY = 500
+
+    def __init__(self, user, contract, replace_existing=False, merge=False, delete_missing=False, progress_callback=None, loader='auto'):
+        self.user = user
+        self.contract = contract
+        self.loader = loader
+        self.merge = merge
+        self.replace_existing = replace_existing and not merge
+        self.delete_missing = delete_missing and merge
+        self.progress_callback = progress_callback
+        # Только ID созданных сотрудников - сами объекты после записи пачки в памяти не хранятся
+        self.created_ids = []
+        self.stats = {
+            'rows_processed': 0,
+            'created': 0,
+            'skipped': 0,
+            'skipped_reasons': {'duplicate': 0, 'no_name': 0},
+        }
+        if self.merge:
+            self.stats.update({'updated': 0, 'unchanged': 0, 'deleted': 0, 'updated_fields': {}})
+
+    @property
+    def created_employees(self):
+        """Созданные сотрудники (загружаются из БД по ID)"""
+        return (
+            ContingentEmployee.objects.filter(contract=self.contract, id__in=self.created_ids)
+            .select_related('user', 'contract__employer')
+            .order_by('id')
+        )
+
+    def _batch_size(self):
+        return getattr(settings, 'CONTINGENT_IMPORT_BATCH_SIZE', 1000)
+
+    def _flush_created(self, new_employees):
+        """Записать пачку новых сотрудников и освободить список"""
+        if new_employees:
+            created = ContingentEmployee.objects.bulk_create(new_employees)
+            self.created_ids.extend(employee.pk for employee in created if employee.pk is not None)
+            self.stats['created'] += len(created)
+            new_employees.clear()
+
+    def _skip(self, reason):
+        self.stats['skipped'] += 1
+        self.stats['skipped_reasons'][reason] += 1
+
+    def _report_progress(self):
+        if self.progress_callback:
+            progress = dict(self.stats, skipped_reasons=dict(self.stats['skipped_reasons']))
+            if 'updated_fields' in progress:
+                progress['updated_fields'] = dict(progress['updated_fields'])
+            self.progress_callback(progress)
+
+    def _iter_parsed_rows(self, sheet):
+        """Непустые строки файла -> (номер строки, поля) с учетом пропусков без ФИО"""
+        normalized_rows = iter_normalized_rows(
+            sheet,
+            workers=getattr(settings, 'CONTINGENT_IMPORT_WORKERS', 1),
+            parallel_threshold=getattr(settings, 'CONTINGENT_IMPORT_PARALLEL_THRESHOLD', 0),
+        )
+        for row_idx, fields in normalized_rows:
+            self.stats['rows_processed'] += 1
+            if self.stats['rows_processed'] % self.PROGRESS_EVERY == 0:
+                self._report_progress()
+
+            if fields is None:
+                self._skip('no_name')
+                continue
+            yield row_idx, fields
+
+    def run(self, sheet):
+        """Выполнить загрузку. Возвращает dict со счетчиками и скоростью загрузки."""
+        ingest_start = time.time()
+
+        use_copy = self._use_copy_loader(sheet)
+        if self.merge:
+            self._run_merge(sheet)
+        elif use_copy:
+            self._run_copy(sheet)
+        else:
+            self._run_insert(sheet)
+        self._report_progress()
+
+        ingest_elapsed = time.time() - ingest_start
+        rows_processed = self.stats['rows_processed']
+        rows_per_second = round(rows_processed / ingest_elapsed, 1) if ingest_elapsed > 0 else float(rows_processed)
+        logger.info(f"[PERFORMANCE] Contingent import into contract {self.contract.id}: {rows_processed} rows in {ingest_elapsed:.3f}s ({rows_per_second} rows/s), created {self.stats['created']}")
+
+        return dict(
+            self.stats,
+            mode='merge' if self.merge else ('replace' if self.replace_existing else 'append'),
+            loader='copy' if use_copy else 'orm',
+            elapsed_seconds=round(ingest_elapsed, 3),
+            rows_per_second=rows_per_second,
+        )
+
+    def _use_copy_loader(self, sheet):
+        """
+        COPY используется только для PostgreSQL и без слияния:
+        loader='copy' - всегда, loader='auto' - если в файле не меньше CONTINGENT_IMPORT_COPY_THRESHOLD строк.
+        """
+        if self.merge or self.loader == 'orm' or connection.vendor != 'postgresql':
+            return False
+        if self.loader == 'copy':
+            return True
+        threshold = getattr(settings, 'CONTINGENT_IMPORT_COPY_THRESHOLD', 5000)
+        return bool(threshold) and (sheet.row_count_hint or 0) >= threshold
+
+    def _run_copy(self, sheet):
+        # Дубликаты отбрасываются при передаче строк в COPY - в памяти только ключи (ФИО и ИИН), а не объекты
+        loader = ContingentCopyLoader(self.user, self.contract)
+        with transaction.atomic():
+            if self.replace_existing:
+                deleted_count, _ = ContingentEmployee.objects.filter(contract=self.contract).delete()
+                logger.info(f"Contingent import: deleted {deleted_count} records (including related) of contract {self.contract.id} for replacement")
+            copied, created_ids = loader.load(fields for _, fields in self._iter_parsed_rows(sheet))
+
+        self.created_ids = list(created_ids)
+        self.stats['created'] = len(created_ids)
+        for _ in range(copied - len(created_ids)):
+            self._skip('duplicate')
+
+    def _run_insert(self, sheet):
+        # Индекс дубликатов: существующие сотрудники договора загружаются один раз,
+        # строки файла добавляются по мере разбора. При замене существующие записи
+        # будут удалены, поэтому сверяемся только со строками самого файла
+        duplicate_index = ContingentDuplicateIndex() if self.replace_existing else ContingentDuplicateIndex.for_contract(self.contract)
+
+        # Удаление (при замене) и вставка пачками по мере чтения файла - в одной транзакции,
+        # в памяти одновременно не больше одной пачки новых сотрудников. Прогресс фоновой задачи
+        # пишется отдельным соединением (update_job_progress) и виден до завершения транзакции
+        batch_size = self._batch_size()
+        new_employees = []
+        with transaction.atomic():
+            if self.replace_existing:
+                deleted_count, _ = ContingentEmployee.objects.filter(contract=self.contract).delete()
+                logger.info(f"Contingent import: deleted {deleted_count} records (including related) of contract {self.contract.id} for replacement")
+
+            for row_idx, fields in self._iter_parsed_rows(sheet):
+                # КРИТИЧЕСКИ ВАЖНО: Проверяем, существует ли уже сотрудник в рамках этого договора или файла
+                # (по ИИН, по ФИО + дате рождения, по ФИО) - поиск по индексу без запросов к БД
+                existing, duplicate_reason = duplicate_index.find(fields['iin'], fields['name'], fields['birth_date'])
+                if existing:
+                    logger.debug(f"Contingent import row {row_idx}: duplicate ({duplicate_reason}) - {fields['name']}, existing ID: {existing.pk}")
+                    self._skip('duplicate')
+                    continue
+
+                employee = ContingentEmployee(user=self.user, contract=self.contract, requires_examination=True, **fields)
+                new_employees.append(employee)
+                duplicate_index.add(employee)
+                if len(new_employees) >= batch_size:
+                    self._flush_created(new_employees)
+            self._flush_created(new_employees)
+
+    def _run_merge(self, sheet):
+        existing_index = ContingentDuplicateIndex.for_contract(self.contract, full=True)
+        # Новые строки файла проверяются на дубликаты между собой по тем же правилам, что и при обычной загрузке
+        new_rows_index = ContingentDuplicateIndex()
+        matched_ids = set()
+        new_employees = []
+        changed_employees = []
+        changed_fields = set()
+        updated_fields_stats = self.stats['updated_fields']
+        batch_size = self._batch_size()
+
+        def flush_changed():
+            if changed_employees:
+                ContingentEmployee.objects.bulk_update(changed_employees, sorted(changed_fields))
+                self.stats['updated'] += len(changed_employees)
+                changed_employees.clear()
+                changed_fields.clear()
+
+        # Новые и измененные сотрудники записываются пачками по мере чтения файла (в одной транзакции)
+        with transaction.atomic():
+            self._merge_rows(
+                sheet, existing_index, new_rows_index, matched_ids, new_employees, changed_employees, changed_fields,
+                updated_fields_stats, batch_size, flush_changed,
+            )
+            flush_changed()
+            self._flush_created(new_employees)
+
+            missing_ids = []
+            if self.delete_missing:
+                # Индекс хранит только первую запись с каждым ключом, поэтому полный список ID берем из БД
+                # (созданные в этой загрузке сотрудники тоже не удаляются)
+                keep_ids = matched_ids.union(self.created_ids)
+                missing_ids = [
+                    employee_id
+                    for employee_id in ContingentEmployee.objects.filter(contract=self.contract).values_list('id', flat=True)
+                    if employee_id not in keep_ids
+                ]
+            if missing_ids:
+                ContingentEmployee.objects.filter(contract=self.contract, id__in=missing_ids).delete()
+
+        self.stats['deleted'] = len(missing_ids)
+        logger.info(f"Contingent merge into contract {self.contract.id}: created {self.stats['created']}, updated {self.stats['updated']}, unchanged {self.stats['unchanged']}, deleted {self.stats['deleted']}")
+
+    def _merge_rows(self, sheet, existing_index, new_rows_index, matched_ids, new_employees, changed_employees,
+                    changed_fields, updated_fields_stats, batch_size, flush_changed):
+        """Сопоставление строк файла с сотрудниками договора (см. _run_merge)"""
+        for row_idx, fields in self._iter_parsed_rows(sheet):
+            has_real_iin = is_valid_iin(fields['iin'])
+            existing = existing_index.by_iin.get(fields['iin']) if has_real_iin else None
+            if existing is None:
+                key = (existing_index.name_key(fields['name']), fields['birth_date'])
+                existing = existing_index.by_name_birth.get(key)
+
+            if existing is not None:
+                if existing.pk in matched_ids:
+                    # Сотрудник уже встречался в этом файле
+                    self._skip('duplicate')
+                    continue
+                matched_ids.add(existing.pk)
+
+                row_changed = []
+                for field in MERGE_FIELDS:
+                    # Сгенерированный ИИН (строка без ИИН) не должен затирать сохраненный
+                    if field == 'iin' and not has_real_iin:
+                        continue
+                    if getattr(existing, field) != fields[field]:
+                        setattr(existing, field, fields[field])
+                        row_changed.append(field)
+
+                if row_changed:
+                    changed_employees.append(existing)
+                    changed_fields.update(row_changed)
+                    for field in row_changed:
+                        updated_fields_stats[field] = updated_fields_stats.get(field, 0) + 1
+                    if len(changed_employees) >= batch_size:
+                        flush_changed()
+                else:
+                    self.stats['unchanged'] += 1
+                continue
+
+            duplicate, duplicate_reason = new_rows_index.find(fields['iin'], fields['name'], fields['birth_date'])
+            if duplicate:
+                logger.debug(f"Contingent merge row {row_idx}: duplicate in file ({duplicate_reason}) - {fields['name']}")
+                self._skip('duplicate')
+                continue
+
+            employee = ContingentEmployee(user=self.user, contract=self.contract, requires_examination=True, **fields)
+            new_employees.append(employee)
+            new_rows_index.add(employee)
+            if len(new_employees) >= batch_size:
+                self._flush_created(new_employees)
+
+
+class _CopyRowsFile:
+    """Файлоподобный объект для copy_expert: строки CSV формируются по мере чтения"""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+        if size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class ContingentCopyLoader:
+    """
+    Загрузка большого списка контингента через PostgreSQL COPY:
+    строки потоково передаются во временную таблицу (COPY FROM STDIN), затем одним INSERT ... SELECT
+    переносятся в api_contingentemployee. Дубликаты отбрасываются при передаче строк по тем же правилам,
+    что и в ContingentDuplicateIndex: совпадение валидного ИИН или ФИО (без учета регистра)
+    с уже загруженным сотрудником договора или с более ранней принятой строкой файла.
+    Для этого в памяти хранятся только множества ключей, а не объекты сотрудников.
+    """
+
+    TEMP_TABLE = 'contingent_import_rows'
+    # Текстовые колонки: пустое значение - пустая строка, а не NULL
+    TEXT_COLUMNS = ['name', 'gender', 'department', 'position', 'notes', 'iin', 'phone', 'quarter']
+    COLUMNS = [
+        'name', 'birth_date', 'gender', 'department', 'position', 'total_experience_years',
+        'position_experience_years', 'last_examination_date', 'harmful_factors', 'notes', 'iin', 'phone', 'quarter',
+    ]
+
+    def __init__(self, user, contract):
+        self.user = user
+        self.contract = contract
+        self.rows_total = 0
+
+    def _existing_keys(self):
+        """Ключи сотрудников договора: (ФИО без учета регистра, валидные ИИН)"""
+        names, iins = set(), set()
+        existing = ContingentEmployee.objects.filter(contract=self.contract).values_list('name', 'iin')
+        for name, iin in existing.iterator(chunk_size=5000):
+            names.add(ContingentDuplicateIndex.name_key(name))
+            if is_valid_iin(iin):
+                iins.add(iin)
+        return names, iins
+
+    def _iter_unique_rows(self, rows, names, iins):
+        """Строки без дубликатов; self.rows_total - сколько строк было передано всего"""
+        for fields in rows:
+            self.rows_total += 1
+            name_key = ContingentDuplicateIndex.name_key(fields['name'])
+            has_real_iin = is_valid_iin(fields['iin'])
+            if name_key in names or (has_real_iin and fields['iin'] in iins):
+                continue
+            names.add(name_key)
+            if has_real_iin:
+                iins.add(fields['iin'])
+            yield fields
+
+    def _iter_csv_lines(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        for row_no, fields in enumerate(rows, start=1):
+            writer.writerow([row_no] + [self._format_value(column, fields[column]) for column in self.COLUMNS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    @staticmethod
+    def _format_value(column, value):
+        if value is None:
+            return ''
+        if column == 'harmful_factors':
+            return json.dumps(value, ensure_ascii=False)
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        return value
+
+    def load(self, rows):
+        """
+        Загрузить строки (dict полей из parse_employee_row). Вызывается внутри transaction.atomic().
+        Возвращает (количество переданных строк, список ID созданных сотрудников).
+        Строки читаются во время COPY, поэтому обработка строк (в т.ч. progress_callback) не должна
+        выполнять запросы в основном соединении - прогресс задачи пишется отдельным (update_job_progress).
+        """
+        table = ContingentEmployee._meta.db_table
+        columns = ', '.join(self.COLUMNS)
+        # Ключи загружаются до COPY - во время COPY другие запросы в этом соединении невозможны
+        names, iins = self._existing_keys()
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                CREATE TEMP TABLE {self.TEMP_TABLE} (
+                    row_no integer,
+                    name varchar(255),
+                    birth_date date,
+                    gender varchar(10),
+                    department varchar(255),
+                    position varchar(255),
+                    total_experience_years integer,
+                    position_experience_years integer,
+                    last_examination_date date,
+                    harmful_factors jsonb,
+                    notes text,
+                    iin varchar(20),
+                    phone varchar(20),
+                    quarter varchar(20)
+                ) ON COMMIT DROP
+            """)
+            cursor.copy_expert(
+                f"COPY {self.TEMP_TABLE} (row_no, {columns}) FROM STDIN "
+                f"WITH (FORMAT csv, FORCE_NOT_NULL ({', '.join(self.TEXT_COLUMNS)}))",
+                _CopyRowsFile(self._iter_csv_lines(self._iter_unique_rows(rows, names, iins))),
+            )
+            cursor.execute(f"""
+                INSERT INTO {table} (user_id, contract_id, requires_examination, created_at, {columns})
+                SELECT %s, %s, TRUE, %s, {columns}
+                FROM {self.TEMP_TABLE}
+                ORDER BY row_no
+                RETURNING id
+            """, [self.user.id, self.contract.id, timezone.now()])
+            created_ids = [row[0] for row in cursor.fetchall()]
+
+        return self.rows_total, created_ids
+
+
+def run_import_job(job):
+    """Обработчик фоновой задачи 'contingent_import' (см. api.background_jobs)"""
+    from .background_jobs import JobFailed, update_job_progress
+
+    if not job.file_data:
+        raise JobFailed('Файл задачи не найден')
+
+    try:
+        sheet = open_contingent_file(
+            io.BytesIO(bytes(job.file_data)),
+            max_rows=getattr(settings, 'CONTINGENT_IMPORT_MAX_ROWS', 50000),
+            validation=job.payload.get('validation'),
+            file_name=job.file_name,
+        )
+    except ContingentFileError as e:
+        raise JobFailed(f'{e.error}. {e.detail}'.strip())
+
+    importer = ContingentImporter(
+        job.user,
+        job.contract,
+        replace_existing=job.payload.get('replace_existing', False),
+        merge=job.payload.get('mode') == 'merge',
+        loader=job.payload.get('loader', 'auto'),
+        delete_missing=job.payload.get('delete_missing', False),
+        progress_callback=lambda progress: update_job_progress(job, **progress),
+    )
+    try:
+        return importer.run(sheet)
+    except ContingentFileError as e:
+        raise JobFailed(f'{e.error}. {e.detail}'.strip())
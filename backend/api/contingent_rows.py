@@ -0,0 +1,194 @@
+"""
+Нормализация строк списка контингента: кортеж значений ячеек -> поля ContingentEmployee.
+Модуль не зависит от Django (чистые функции), поэтому строки можно разбирать в отдельных процессах.
+"""
+import hashlib
+from datetime import datetime
+
+from .harmful_factors import parse_harmful_factors
+
+
+def row_value(row, column_map, key):
+    """Значение колонки key из кортежа значений строки (None, если колонки нет)"""
+    idx = column_map.get(key)
+    if not idx or idx > len(row):
+        return None
+    return row[idx - 1]
+
+
+def is_valid_iin(iin):
+    """ИИН считается валидным для сверки, если состоит только из цифр (не менее 10)"""
+    return bool(iin) and len(iin) >= 10 and iin.isdigit()
+
+
+def _add_issue(issues, level, row_idx, field, message, value=None):
+    if issues is not None:
+        issues.append({
+            'level': level,
+            'row': row_idx,
+            'field': field,
+            'message': message,
+            'value': '' if value is None else str(value),
+        })
+
+
+def parse_employee_row(row, column_map, row_idx, issues=None):
+    """
+    Разбор одной строки файла в поля ContingentEmployee.
+    Возвращает None, если в строке нет ФИО.
+    Если передан список issues, в него добавляются замечания по строке (level: error/warning) -
+    используется при проверке файла без загрузки (validate_excel).
+    """
+    name = str(row_value(row, column_map, 'name') or '').strip()
+    if not name or name == 'None':
+        _add_issue(issues, 'error', row_idx, 'name', 'Не указано ФИО - строка будет пропущена')
+        return None
+
+    # Парсим дату рождения
+    birth_date = None
+    birth_cell = row_value(row, column_map, 'birth_date')
+    if birth_cell:
+        if isinstance(birth_cell, datetime):
+            birth_date = birth_cell.date()
+        elif isinstance(birth_cell, str):
+            try:
+                birth_date = datetime.strptime(birth_cell, '%d.%m.%Y').date()
+            except ValueError:
+                pass
+        if birth_date is None:
+            _add_issue(issues, 'error', row_idx, 'birth_date', 'Не удалось распознать дату рождения (ожидается ДД.ММ.ГГГГ)', birth_cell)
+
+    # Пол (поле в БД не допускает NULL, поэтому по умолчанию пустая строка)
+    gender = ''
+    gender_cell = row_value(row, column_map, 'gender')
+    if gender_cell:
+        gender_str = str(gender_cell).lower()
+        if 'муж' in gender_str or 'male' in gender_str:
+            gender = 'male'
+        elif 'жен' in gender_str or 'female' in gender_str:
+            gender = 'female'
+
+    # Стаж
+    total_exp_cell = row_value(row, column_map, 'total_experience')
+    total_exp = _parse_experience(total_exp_cell)
+    if total_exp_cell and total_exp is None:
+        _add_issue(issues, 'warning', row_idx, 'total_experience', 'Не удалось распознать общий стаж', total_exp_cell)
+    pos_exp_cell = row_value(row, column_map, 'position_experience')
+    pos_exp = _parse_experience(pos_exp_cell)
+    if pos_exp_cell and pos_exp is None:
+        _add_issue(issues, 'warning', row_idx, 'position_experience', 'Не удалось распознать стаж по должности', pos_exp_cell)
+
+    # Дата последнего медосмотра
+    last_exam = None
+    exam_cell = row_value(row, column_map, 'last_examination')
+    if exam_cell:
+        if isinstance(exam_cell, datetime):
+            last_exam = exam_cell.date()
+        elif isinstance(exam_cell, str):
+            try:
+                last_exam = datetime.strptime(exam_cell.replace('г', '').strip(), '%d.%m.%Y').date()
+            except ValueError:
+                pass
+        if last_exam is None:
+            _add_issue(issues, 'error', row_idx, 'last_examination', 'Не удалось распознать дату последнего медосмотра (ожидается ДД.ММ.ГГГГ)', exam_cell)
+
+    # Вредные факторы (могут быть через запятую или точку с запятой) приводятся к формулировкам справочника,
+    # нераспознанные отбрасываются
+    harmful_factors = []
+    factors_cell = row_value(row, column_map, 'harmful_factors')
+    if factors_cell:
+        harmful_factors, unknown_factors = parse_harmful_factors(factors_cell)
+        for factor in unknown_factors:
+            _add_issue(issues, 'warning', row_idx, 'harmful_factors', 'Вредный фактор не найден в справочнике и не будет сохранен', factor)
+
+    # ИИН (необязательное поле)
+    iin_cell = row_value(row, column_map, 'iin')
+    if not iin_cell:
+        # Пробуем найти ИИН в других колонках (может быть в другой позиции)
+        for value in row:
+            cell_val = str(value or '').strip()
+            if len(cell_val) >= 10 and cell_val.isdigit():
+                iin_cell = cell_val
+                break
+
+    iin = ''
+    if iin_cell:
+        # Очищаем ИИН от пробелов и других символов, оставляем только цифры (максимум 20 символов)
+        iin = ''.join(filter(str.isdigit, str(iin_cell).strip()))
+        iin = iin[:20] if len(iin) >= 10 else ''
+
+    # Если ИИН не указан, генерируем уникальный идентификатор на основе ФИО и даты рождения
+    if not iin:
+        _add_issue(issues, 'warning', row_idx, 'iin', 'ИИН не указан или некорректен - будет сгенерирован временный идентификатор', iin_cell)
+        unique_string = f"{name}_{birth_date or 'unknown'}_{row_idx}"
+        iin = hashlib.md5(unique_string.encode()).hexdigest()[:12]  # Используем первые 12 символов MD5
+
+    department = str(row_value(row, column_map, 'department') or '').strip()
+    position = str(row_value(row, column_map, 'position') or '').strip()
+    if not department:
+        _add_issue(issues, 'warning', row_idx, 'department', 'Не указан объект/участок')
+    if not position:
+        _add_issue(issues, 'warning', row_idx, 'position', 'Не указана должность')
+
+    phone_cell = row_value(row, column_map, 'phone')
+    phone = normalize_phone(phone_cell)
+    if phone and not is_valid_phone(phone):
+        _add_issue(issues, 'warning', row_idx, 'phone', 'Некорректный формат телефона (ожидается 7XXXXXXXXXX)', phone_cell)
+
+    return {
+        'name': name,
+        'birth_date': birth_date,
+        'gender': gender,
+        'department': department,
+        'position': position,
+        'total_experience_years': total_exp,
+        'position_experience_years': pos_exp,
+        'last_examination_date': last_exam,
+        'harmful_factors': harmful_factors,
+        'notes': str(row_value(row, column_map, 'notes') or '').strip(),
+        'iin': iin,
+        'phone': phone,
+        'quarter': str(row_value(row, column_map, 'quarter') or '').strip(),
+    }
+
+
+def _parse_experience(value):
+    if not value:
+        return None
+    try:
+        return int(str(value).replace('лет', '').replace('года', '').strip())
+    except ValueError:
+        return None
+
+
+def normalize_phone(value):
+    """Нормализуем телефон для GreenAPI (формат 7XXXXXXXXXX)"""
+    phone_raw = str(value or '').strip()
+    if not phone_raw:
+        return ''
+    # Убираем все символы кроме цифр
+    phone_digits = ''.join(filter(str.isdigit, phone_raw))
+    # Если начинается с 8, заменяем на 7
+    if phone_digits.startswith('8') and len(phone_digits) == 11:
+        return '7' + phone_digits[1:]
+    # Если начинается с 7 и длина 11 цифр
+    if phone_digits.startswith('7') and len(phone_digits) == 11:
+        return phone_digits
+    # Если 10 цифр без кода страны, добавляем 7
+    if len(phone_digits) == 10:
+        return '7' + phone_digits
+    # Иначе оставляем как есть (может быть международный номер)
+    return phone_digits
+
+
+def is_valid_phone(phone):
+    """Нормализованный номер пригоден для отправки через GreenAPI"""
+    return len(phone) == 11 and phone.startswith('7')
+
+
+def normalize_rows(rows, column_map):
+    """
+    Разбор пачки строк [(номер строки, кортеж значений), ...] -> [(номер строки, поля или None), ...].
+    Выполняется в процессах ProcessPoolExecutor при параллельной загрузке.
+    """
+    return [(row_idx, parse_employee_row(row, column_map, row_idx)) for row_idx, row in rows]
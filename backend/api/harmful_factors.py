@@ -0,0 +1,178 @@
+"""
+Справочник вредных производственных факторов (приказ № ҚР ДСМ-131/2020).
+Единый источник для загрузки контингента, шаблона Excel, API и генерации маршрутных листов.
+"""
+from types import MappingProxyType
+from typing import NamedTuple, Tuple
+
+
+class HarmfulFactor(NamedTuple):
+    code: str  # 'п.5'
+    label: str  # 'п.5 «Работы, выполняемые в условиях повышенного шума»' - как хранится в БД
+    title: str  # 'Работы, выполняемые в условиях повышенного шума'
+    specializations: Tuple[str, ...] = ()  # Дополнительные специалисты в маршрутном листе
+    lab_tests: Tuple[Tuple[str, str], ...] = ()  # (test_type, test_name)
+    functional_tests: Tuple[Tuple[str, str], ...] = ()  # (test_type, test_name)
+
+
+# (номер пункта, наименование, специалисты, лабораторные исследования, функциональные исследования)
+_FACTORS = [
+    (1, 'Работы, связанные с воздействием химических факторов', ('Терапевт', 'Профпатолог'), (), ()),
+    (2, 'Работы с канцерогенными веществами', (), (), ()),
+    (3, 'Работы с пестицидами и агрохимикатами', (), (), ()),
+    (4, 'Работы, связанные с воздействием биологических факторов', (), (), ()),
+    (5, 'Работы, выполняемые в условиях повышенного шума', ('ЛОР',), (), (('Аудиометрия', 'Проверка слуха'),)),
+    (6, 'Работы, выполняемые в условиях вибрации', ('Невропатолог',), (), (('Спирометрия', 'Функция дыхания'),)),
+    (7, 'Работы, выполняемые в условиях ионизирующего излучения', ('Окулист', 'Рентгенолог'), (), ()),
+    (8, 'Работы, выполняемые в условиях неионизирующих излучений', ('Окулист', 'Рентгенолог'), (), ()),
+    (9, 'Работы, выполняемые при повышенной или пониженной температуре воздуха', (), (), ()),
+    (10, 'Работы в замкнутых пространствах', (), (), ()),
+    (11, 'Работы на высоте', ('Невропатолог', 'Окулист'), (), ()),
+    (12, 'Работы, связанные с подъемом и перемещением тяжестей', (), (), ()),
+    (13, 'Работы в ночное время', (), (), ()),
+    (14, 'Работа на ПК', (), (), ()),
+    (15, 'Работы, связанные с эмоциональным и умственным перенапряжением', (), (), ()),
+    (16, 'Работы, связанные с повышенной ответственностью', (), (), ()),
+    (17, 'Работы вахтовым методом', (), (), ()),
+    (18, 'Подземные работы', (), (), ()),
+    (19, 'Работы на транспорте', (), (), ()),
+    (20, 'Работы, связанные с воздействием пыли', ('ЛОР', 'Рентгенолог'), (('Анализ мокроты', 'Мокрота'),), ()),
+    (21, 'Работы с горюче-смазочными материалами', (), (), ()),
+    (22, 'Работы, связанные с воздействием нефти и нефтепродуктов', (), (), ()),
+    (23, 'Работы в условиях повышенной загазованности', (), (), ()),
+    (24, 'Работы в условиях недостатка кислорода', (), (), ()),
+    (25, 'Работы в условиях повышенной влажности', (), (), ()),
+    (26, 'Работы, связанные с виброинструментом', ('Невропатолог',), (), (('Спирометрия', 'Функция дыхания'),)),
+    (27, 'Работы на конвейерах', (), (), ()),
+    (28, 'Работы на строительных площадках', (), (), ()),
+    (29, 'Работы в металлургическом производстве', (), (), ()),
+    (30, 'Работы в горнодобывающей промышленности', (), (), ()),
+    (31, 'Работы в деревообрабатывающем производстве', (), (), ()),
+    (32, 'Работы в текстильной и швейной промышленности', (), (), ()),
+    (33, 'Профессии и работы', (), (), ()),
+]
+
+# Ключевые слова для свободных формулировок (например, «шум», «пыль» в маршрутных листах,
+# созданных вручную) -> пункт справочника. Проверяются по порядку
+_KEYWORDS = {
+    'шум': 'п.5',
+    'вибрац': 'п.6',
+    'виброинструмент': 'п.26',
+    'пыль': 'п.20',
+    'пыли': 'п.20',
+    'химическ': 'п.1',
+    'неионизирующ': 'п.8',
+    'ионизирующ': 'п.7',
+    'излучени': 'п.8',
+    'высот': 'п.11',
+}
+
+
+def normalize_factor_key(value):
+    """Ключ для сравнения: без кавычек, лишних пробелов и регистра"""
+    text = str(value or '').replace('«', ' ').replace('»', ' ').replace('"', ' ')
+    return ' '.join(text.split()).casefold()
+
+
+HARMFUL_FACTORS = MappingProxyType({
+    f'п.{number}': HarmfulFactor(
+        code=f'п.{number}',
+        label=f'п.{number} «{title}»',
+        title=title,
+        specializations=specializations,
+        lab_tests=lab_tests,
+        functional_tests=functional_tests,
+    )
+    for number, title, specializations, lab_tests, functional_tests in _FACTORS
+})
+
+# Полные формулировки в порядке пунктов (для шаблона и API)
+HARMFUL_FACTOR_LABELS = tuple(factor.label for factor in HARMFUL_FACTORS.values())
+
+# Нормализованный ключ (полная формулировка, наименование без пункта, код) -> фактор
+_LOOKUP = MappingProxyType({
+    key: factor
+    for factor in HARMFUL_FACTORS.values()
+    for key in (normalize_factor_key(factor.label), normalize_factor_key(factor.title), factor.code)
+})
+
+
+def _code_prefix(key):
+    """'п. 5 работы...' / 'п5' / '5' -> 'п.5' (или None)"""
+    rest = key[2:] if key.startswith('п.') else key[1:] if key.startswith('п') else key
+    rest = rest.lstrip()
+    digits = ''
+    for char in rest:
+        if not char.isdigit():
+            break
+        digits += char
+    if not digits:
+        return None
+    # Только номер или номер + наименование
+    tail = rest[len(digits):]
+    if tail and not tail[0].isspace() and tail[0] not in '.,)':
+        return None
+    return f'п.{int(digits)}'
+
+
+def resolve_harmful_factor(value):
+    """
+    Найти пункт справочника по введенному значению: полная формулировка (в любом регистре),
+    наименование без пункта, номер пункта ('п.5', 'п5') или ключевое слово. Возвращает HarmfulFactor или None.
+    """
+    key = normalize_factor_key(value)
+    if not key:
+        return None
+    factor = _LOOKUP.get(key)
+    if factor is not None:
+        return factor
+    code = _code_prefix(key)
+    if code is not None:
+        return HARMFUL_FACTORS.get(code)
+    for keyword, code in _KEYWORDS.items():
+        if keyword in key:
+            return HARMFUL_FACTORS[code]
+    return None
+
+
+def split_harmful_factors(text):
+    """
+    Разбить ячейку со списком факторов (через запятую или точку с запятой).
+    Запятые внутри «...» разделителем не считаются.
+    """
+    parts = []
+    current = ''
+    for piece in str(text or '').replace(';', ',').split(','):
+        current = f'{current},{piece}' if current else piece
+        if current.count('«') <= current.count('»'):
+            if current.strip():
+                parts.append(current.strip())
+            current = ''
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def parse_harmful_factors(text):
+    """
+    Разбор ячейки с факторами: (канонические формулировки без повторов, нераспознанные значения)
+    """
+    factors = []
+    unknown = []
+    for part in split_harmful_factors(text):
+        factor = resolve_harmful_factor(part)
+        if factor is None:
+            unknown.append(part)
+        elif factor.label not in factors:
+            factors.append(factor.label)
+    return factors, unknown
+
+
+def resolve_harmful_factors(values):
+    """Пункты справочника для списка факторов (нераспознанные пропускаются, порядок сохраняется)"""
+    resolved = []
+    for value in values or []:
+        factor = resolve_harmful_factor(value)
+        if factor is not None and factor not in resolved:
+            resolved.append(factor)
+    return resolved
@@ -1,5 +1,5 @@
 from django.core.management.base import BaseCommand
-from api.models import User, Contract, ContractHistory
+from api.models import User, Contract, ContractHistory, normalize_bin
 
 
 class Command(BaseCommand):
@@ -11,10 +11,8 @@ class Command(BaseCommand):
         parser.add_argument('--dry-run', action='store_true', help='Только показать что будет изменено')
 
     def normalize_bin(self, bin_number):
-        """Нормализует БИН для сравнения"""
-        if not bin_number:
-            return ''
-        return ''.join(str(bin_number).strip().split())
+        """Нормализует БИН для сравнения (так же, как User.bin)"""
+        return normalize_bin(bin_number)
 
     def handle(self, *args, **options):
         user_id = options['user_id']
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from api.background_jobs import claim_next_job, requeue_stale_jobs, run_job
+
+
+class Command(BaseCommand):
+    help = 'Выполняет фоновые задачи из очереди в БД (загрузка контингента и т.п.)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Выполнить все задачи из очереди и завершиться')
+        parser.add_argument('--sleep', type=float, default=2.0, help='Пауза между проверками очереди (сек)')
+        parser.add_argument('--stale-minutes', type=int, default=30, help='Через сколько минут задача в статусе running считается зависшей')
+
+    def handle(self, *args, **options):
+        once = options['once']
+        sleep_seconds = options['sleep']
+
+        requeued = requeue_stale_jobs(options['stale_minutes'])
+        if requeued:
+            self.stdout.write(self.style.WARNING(f"Возвращено в очередь зависших задач: {requeued}"))
+
+        self.stdout.write("Обработчик фоновых задач запущен")
+        while True:
+            # Как между HTTP-запросами: закрываем соединения с ошибкой или старше CONN_MAX_AGE,
+            # чтобы сбой БД в одной задаче не ломал следующие
+            close_old_connections()
+            job = claim_next_job()
+            if job is None:
+                if once:
+                    break
+                time.sleep(sleep_seconds)
+                continue
+
+            self.stdout.write(f"Задача #{job.id} ({job.job_type}): выполнение...")
+            job = run_job(job)
+            if job.status == 'completed':
+                self.stdout.write(self.style.SUCCESS(f"Задача #{job.id} завершена"))
+            elif job.status == 'pending':
+                self.stdout.write(self.style.WARNING(
+                    f"Задача #{job.id}: попытка {job.attempts} из {job.max_attempts} завершилась с ошибкой, "
+                    f"повтор после {job.run_after:%H:%M:%S}: {job.errors[-1]}"
+                ))
+            else:
+                self.stdout.write(self.style.ERROR(f"Задача #{job.id} завершилась с ошибкой: {'; '.join(job.errors)}"))
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_contingentemployee_contingent_contract_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackgroundJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_type', models.CharField(choices=[('contingent_import', 'Загрузка контингента из Excel')], max_length=50, verbose_name='Тип задачи')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Выполняется'), ('completed', 'Завершена'), ('failed', 'Ошибка')], default='pending', max_length=20, verbose_name='Статус')),
+                ('payload', models.JSONField(blank=True, default=dict, verbose_name='Параметры задачи')),
+                ('progress', models.JSONField(blank=True, default=dict, help_text='Промежуточные счетчики, обновляются во время выполнения', verbose_name='Прогресс')),
+                ('result', models.JSONField(blank=True, default=dict, verbose_name='Результат')),
+                ('errors', models.JSONField(blank=True, default=list, verbose_name='Ошибки')),
+                ('file_name', models.CharField(blank=True, max_length=255, verbose_name='Имя файла')),
+                ('file_data', models.BinaryField(blank=True, help_text='Хранится до обработки задачи, затем очищается', null=True, verbose_name='Содержимое файла')),
+                ('attempts', models.IntegerField(default=0, verbose_name='Количество попыток')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата начала')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата завершения')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('contract', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='background_jobs', to='api.contract', verbose_name='Договор')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='background_jobs', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Фоновая задача',
+                'verbose_name_plural': 'Фоновые задачи',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', 'created_at'], name='api_backgro_status_489a04_idx'), models.Index(fields=['job_type', 'user', '-created_at'], name='api_backgro_job_typ_ace28f_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_backgroundjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendarplan',
+            name='route_sheets_job',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.backgroundjob', verbose_name='Задача создания маршрутных листов'),
+        ),
+        migrations.AddField(
+            model_name='calendarplan',
+            name='route_sheets_progress',
+            field=models.JSONField(blank=True, default=dict, help_text='По участкам: {"Участок 1": {"status": "completed", "created": 10, "existing": 0}, ...}', verbose_name='Прогресс создания маршрутных листов'),
+        ),
+        migrations.AddField(
+            model_name='calendarplan',
+            name='route_sheets_status',
+            field=models.CharField(blank=True, choices=[('pending', 'В очереди'), ('running', 'Выполняется'), ('completed', 'Завершено'), ('failed', 'Ошибка')], max_length=20, verbose_name='Создание маршрутных листов'),
+        ),
+        migrations.AlterField(
+            model_name='backgroundjob',
+            name='job_type',
+            field=models.CharField(choices=[('contingent_import', 'Загрузка контингента из Excel'), ('plan_route_sheets', 'Создание маршрутных листов по календарному плану')], max_length=50, verbose_name='Тип задачи'),
+        ),
+    ]
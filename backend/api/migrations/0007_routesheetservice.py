@@ -0,0 +1,107 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+BATCH_SIZE = 5000
+
+
+def copy_services_to_rows(apps, schema_editor):
+    """Перенос услуг из RouteSheet.services (JSON) в RouteSheetService"""
+    RouteSheet = apps.get_model('api', 'RouteSheet')
+    RouteSheetService = apps.get_model('api', 'RouteSheetService')
+    Doctor = apps.get_model('api', 'Doctor')
+    doctor_ids = set(Doctor.objects.values_list('id', flat=True))
+
+    rows = []
+    for route_sheet in RouteSheet.objects.only('id', 'visit_date', 'services').iterator(chunk_size=2000):
+        services = route_sheet.services if isinstance(route_sheet.services, list) else []
+        seen = set()
+        for order, service in enumerate(services):
+            if not isinstance(service, dict):
+                continue
+            service_id = str(service.get('id', order))
+            if service_id in seen:
+                continue
+            seen.add(service_id)
+            doctor_id = str(service.get('doctorId') or service.get('doctor_id') or '')
+            doctor_id = int(doctor_id) if doctor_id.isdigit() else None
+            rows.append(RouteSheetService(
+                route_sheet_id=route_sheet.id,
+                service_id=service_id,
+                order=order,
+                name=service.get('name') or service.get('specialization') or '',
+                specialization=service.get('specialization') or service.get('name') or '',
+                cabinet=str(service.get('cabinet') or '')[:50],
+                doctor_id=doctor_id if doctor_id in doctor_ids else None,
+                visit_date=route_sheet.visit_date,
+                time=str(service.get('time') or '')[:5],
+                status='completed' if service.get('status') == 'completed' else 'pending',
+            ))
+        if len(rows) >= BATCH_SIZE:
+            RouteSheetService.objects.bulk_create(rows)
+            rows = []
+    RouteSheetService.objects.bulk_create(rows)
+
+
+def copy_rows_to_services(apps, schema_editor):
+    """Обратный перенос: RouteSheetService -> RouteSheet.services"""
+    RouteSheet = apps.get_model('api', 'RouteSheet')
+    RouteSheetService = apps.get_model('api', 'RouteSheetService')
+    services_by_sheet = {}
+    for service in RouteSheetService.objects.order_by('route_sheet_id', 'order').iterator(chunk_size=BATCH_SIZE):
+        services_by_sheet.setdefault(service.route_sheet_id, []).append({
+            'id': service.service_id,
+            'name': service.name,
+            'cabinet': service.cabinet,
+            'doctorId': str(service.doctor_id) if service.doctor_id else '',
+            'specialization': service.specialization or service.name,
+            'time': service.time,
+            'status': service.status,
+        })
+    route_sheets = []
+    for route_sheet in RouteSheet.objects.only('id').iterator(chunk_size=2000):
+        route_sheet.services = services_by_sheet.get(route_sheet.id, [])
+        route_sheets.append(route_sheet)
+    RouteSheet.objects.bulk_update(route_sheets, ['services'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_calendarplan_route_sheets_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteSheetService',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service_id', models.CharField(help_text='Идентификатор услуги внутри маршрутного листа (поле id в JSON)', max_length=50, verbose_name='ID услуги')),
+                ('order', models.PositiveIntegerField(default=0, verbose_name='Порядок')),
+                ('name', models.CharField(max_length=255, verbose_name='Наименование')),
+                ('specialization', models.CharField(blank=True, max_length=255, verbose_name='Специализация')),
+                ('cabinet', models.CharField(blank=True, max_length=50, verbose_name='Кабинет')),
+                ('visit_date', models.DateField(help_text='Копия даты визита маршрутного листа для индексов', verbose_name='Дата визита')),
+                ('time', models.CharField(blank=True, max_length=5, verbose_name='Время приема')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает'), ('completed', 'Выполнено')], default='pending', max_length=20, verbose_name='Статус')),
+                ('doctor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='route_sheet_services', to='api.doctor', verbose_name='Врач')),
+                ('route_sheet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='service_items', to='api.routesheet', verbose_name='Маршрутный лист')),
+            ],
+            options={
+                'verbose_name': 'Услуга маршрутного листа',
+                'verbose_name_plural': 'Услуги маршрутных листов',
+                'ordering': ['route_sheet', 'order'],
+                'indexes': [models.Index(fields=['doctor', 'status', 'visit_date'], name='rs_service_doctor_idx'), models.Index(fields=['route_sheet', 'status'], name='rs_service_sheet_status_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='routesheetservice',
+            constraint=models.UniqueConstraint(fields=('route_sheet', 'service_id'), name='route_sheet_service_unique'),
+        ),
+        migrations.RunPython(copy_services_to_rows, copy_rows_to_services),
+        migrations.RemoveField(
+            model_name='routesheet',
+            name='services',
+        ),
+    ]
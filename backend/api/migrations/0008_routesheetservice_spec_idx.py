@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_routesheetservice'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='routesheetservice',
+            index=models.Index(fields=['specialization', 'status', 'visit_date'], name='rs_service_spec_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_routesheetservice_spec_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='routesheetservice',
+            name='version',
+            field=models.PositiveIntegerField(default=1, help_text='Увеличивается при каждом изменении статуса (оптимистическая блокировка, ETag)', verbose_name='Версия'),
+        ),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:26
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+# Связанные с маршрутным листом записи (CASCADE) - при слиянии переносятся на оставшийся лист
+RELATED_MODELS = ('LaboratoryTest', 'FunctionalTest', 'PatientQueue')
+
+
+def merge_duplicate_route_sheets(apps, schema_editor):
+    """
+    Перед добавлением ограничения сливаем дубликаты (пациент, дата визита) в клинике.
+    Остается лист с наибольшим числом выполненных услуг, при равенстве - созданный первым.
+    С остальных листов на него переносятся услуги, которых в нем нет (по service_id), статус
+    выполненных услуг, анализы, исследования и записи в очереди; затем дубликаты удаляются.
+    Итоги слияния выводятся в отчет миграции.
+    """
+    RouteSheet = apps.get_model('api', 'RouteSheet')
+    RouteSheetService = apps.get_model('api', 'RouteSheetService')
+    duplicates = list(
+        RouteSheet.objects.values('user_id', 'patient_id', 'visit_date')
+        .annotate(count=Count('id'))
+        .filter(count__gt=1)
+        .order_by()
+    )
+    if not duplicates:
+        return
+
+    report = {'groups': len(duplicates), 'removed': 0, 'services_moved': 0, 'services_completed': 0, 'related_moved': 0}
+    for duplicate in duplicates:
+        sheet_ids = list(
+            RouteSheet.objects.filter(
+                user_id=duplicate['user_id'], patient_id=duplicate['patient_id'], visit_date=duplicate['visit_date'],
+            )
+            .annotate(completed=Count('service_items', filter=Q(service_items__status='completed')))
+            .order_by('-completed', 'id')
+            .values_list('id', flat=True)
+        )
+        survivor_id, duplicate_ids = sheet_ids[0], sheet_ids[1:]
+        survivor_services = {service.service_id: service for service in RouteSheetService.objects.filter(route_sheet_id=survivor_id)}
+        next_order = max((service.order for service in survivor_services.values()), default=-1) + 1
+
+        for service in RouteSheetService.objects.filter(route_sheet_id__in=duplicate_ids).order_by('route_sheet_id', 'order'):
+            kept = survivor_services.get(service.service_id)
+            if kept is None:
+                service.route_sheet_id = survivor_id
+                service.order = next_order
+                service.save(update_fields=['route_sheet', 'order'])
+                survivor_services[service.service_id] = service
+                next_order += 1
+                report['services_moved'] += 1
+            elif service.status == 'completed' and kept.status != 'completed':
+                kept.status = 'completed'
+                kept.version += 1
+                kept.save(update_fields=['status', 'version'])
+                report['services_completed'] += 1
+
+        for model_name in RELATED_MODELS:
+            report['related_moved'] += apps.get_model('api', model_name).objects.filter(
+                route_sheet_id__in=duplicate_ids
+            ).update(route_sheet_id=survivor_id)
+
+        RouteSheet.objects.filter(id__in=duplicate_ids).delete()
+        report['removed'] += len(duplicate_ids)
+
+    if schema_editor.connection.vendor == 'postgresql':
+        # Удаление листов оставляет отложенные проверки внешних ключей, а с ними PostgreSQL
+        # не выполнит ALTER TABLE (AddConstraint) в той же транзакции - проверяем их сейчас
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+    print(
+        f"\n  route_sheet_unique_visit: merged {report['groups']} duplicate (patient, visit date) groups - "
+        f"removed {report['removed']} route sheets, moved {report['services_moved']} services, "
+        f"marked {report['services_completed']} services completed, reassigned {report['related_moved']} "
+        f"laboratory/functional tests and queue entries"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_routesheetservice_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_route_sheets, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='routesheet',
+            constraint=models.UniqueConstraint(fields=('user', 'patient_id', 'visit_date'), name='route_sheet_unique_visit'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:28
+
+from django.db import migrations, models
+
+
+def fill_user_bin(apps, schema_editor):
+    """Заполнение User.bin из registration_data (bin, иначе inn) - как в User.save"""
+    User = apps.get_model('api', 'User')
+    users = []
+    for user in User.objects.only('id', 'registration_data').iterator(chunk_size=2000):
+        registration_data = user.registration_data if isinstance(user.registration_data, dict) else {}
+        user.bin = ''.join(str(registration_data.get('bin') or registration_data.get('inn') or '').split())[:20]
+        if user.bin:
+            users.append(user)
+    User.objects.bulk_update(users, ['bin'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_routesheet_unique_visit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='bin',
+            field=models.CharField(blank=True, default='', help_text='Нормализованный БИН из registration_data (bin или inn), заполняется при сохранении', max_length=20, verbose_name='БИН/ИИН'),
+        ),
+        migrations.RunPython(fill_user_bin, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['role', 'bin'], name='user_role_bin_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_user_bin'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='contingentemployee',
+            index=models.Index(fields=['contract', 'iin'], name='contingent_contract_iin_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contingentemployee',
+            index=models.Index(fields=['user', 'iin'], name='contingent_user_iin_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expertise',
+            index=models.Index(fields=['user', 'iin'], name='expertise_user_iin_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:34
+
+from django.db import migrations, models
+
+
+def fill_occupational_disease(apps, schema_editor):
+    """Заполнение Expertise.occupational_disease по заключениям врачей - как в Expertise.save"""
+    Expertise = apps.get_model('api', 'Expertise')
+    expertises = []
+    for expertise in Expertise.objects.only('id', 'doctor_conclusions').iterator(chunk_size=2000):
+        conclusions = expertise.doctor_conclusions if isinstance(expertise.doctor_conclusions, list) else []
+        if any(
+            isinstance(conclusion, dict) and 'профзаболевание' in str(conclusion.get('notes') or '').lower()
+            for conclusion in conclusions
+        ):
+            expertise.occupational_disease = True
+            expertises.append(expertise)
+    Expertise.objects.bulk_update(expertises, ['occupational_disease'], batch_size=1000)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_contract_completion_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expertise',
+            name='occupational_disease',
+            field=models.BooleanField(default=False, help_text='Отметка о профзаболевании в заключениях врачей, заполняется при сохранении', verbose_name='Профзаболевание'),
+        ),
+        migrations.RunPython(fill_occupational_disease, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='expertise',
+            index=models.Index(fields=['user', 'department'], name='expertise_user_dept_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_expertise_occupational_disease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='max_attempts',
+            field=models.IntegerField(default=3, help_text='После ошибки задача возвращается в очередь, пока не исчерпаны попытки', verbose_name='Максимум попыток'),
+        ),
+        migrations.AddField(
+            model_name='backgroundjob',
+            name='run_after',
+            field=models.DateTimeField(blank=True, help_text='Задержка перед повторной попыткой', null=True, verbose_name='Не запускать до'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 05:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_background_job_retry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='routesheet',
+            name='creation_token',
+            field=models.UUIDField(blank=True, db_index=True, editable=False, null=True, verbose_name='Метка пакета создания'),
+        ),
+    ]
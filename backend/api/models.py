@@ -1,7 +1,21 @@
 from django.db import models
+from django.db.models import Exists, OuterRef, Q
 from django.contrib.auth.models import AbstractUser
 
 
+def normalize_bin(value):
+    """БИН/ИИН организации для хранения и сравнения: строка без пробелов"""
+    return ''.join(str(value or '').split())
+
+
+def has_occupational_disease(doctor_conclusions):
+    """Есть ли в заключениях врачей отметка о профзаболевании (поле notes)"""
+    for conclusion in doctor_conclusions or []:
+        if isinstance(conclusion, dict) and 'профзаболевание' in str(conclusion.get('notes') or '').lower():
+            return True
+    return False
+
+
 class User(AbstractUser):
     phone = models.CharField(max_length=20, unique=True)
     role = models.CharField(max_length=20, choices=[
@@ -16,6 +30,7 @@ class User(AbstractUser):
     ])
     registration_completed = models.BooleanField(default=False)
     registration_data = models.JSONField(default=dict, blank=True)
+    bin = models.CharField(max_length=20, blank=True, default='', verbose_name='БИН/ИИН', help_text='Нормализованный БИН из registration_data (bin или inn), заполняется при сохранении')
     created_at = models.DateTimeField(auto_now_add=True)
     last_login_at = models.DateTimeField(null=True, blank=True)
 
@@ -40,6 +55,20 @@ class User(AbstractUser):
         related_query_name='crm_user',
     )
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            models.Index(fields=['role', 'bin'], name='user_role_bin_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # БИН дублируется в отдельное индексированное поле для поиска организаций
+        registration_data = self.registration_data or {}
+        self.bin = normalize_bin(registration_data.get('bin') or registration_data.get('inn'))[:20]
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'registration_data' in update_fields and 'bin' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['bin']
+        super().save(*args, **kwargs)
+
 
 class ContingentEmployee(models.Model):
     """Список контингента - лица, подлежащие обязательному медосмотру по приказу №131"""
@@ -67,6 +96,9 @@ class ContingentEmployee(models.Model):
             models.Index(fields=['contract'], name='contingent_contract_idx'),
             models.Index(fields=['user'], name='contingent_user_idx'),
             models.Index(fields=['contract', 'id'], name='contingent_contract_id_idx'),
+            # Сопоставление экспертиз с контингентом договора/работодателя по ИИН (исполнение договора)
+            models.Index(fields=['contract', 'iin'], name='contingent_contract_iin_idx'),
+            models.Index(fields=['user', 'iin'], name='contingent_user_iin_idx'),
         ]
 
 
@@ -79,6 +111,13 @@ class CalendarPlan(models.Model):
         ('rejected', 'Отклонен работодателем'),
         ('sent_to_ses', 'Отправлен в СЭС'),
     ]
+
+    ROUTE_SHEETS_STATUS_CHOICES = [
+        ('pending', 'В очереди'),
+        ('running', 'Выполняется'),
+        ('completed', 'Завершено'),
+        ('failed', 'Ошибка'),
+    ]
     
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='calendar_plans')
     contract = models.ForeignKey('Contract', on_delete=models.CASCADE, related_name='calendar_plans', null=True, blank=True, verbose_name='Договор', help_text='Договор, по которому создан календарный план')
@@ -101,6 +140,10 @@ class CalendarPlan(models.Model):
     approved_by_clinic_at = models.DateTimeField(null=True, blank=True)
     approved_by_employer_at = models.DateTimeField(null=True, blank=True)
     sent_to_ses_at = models.DateTimeField(null=True, blank=True)
+    # Создание маршрутных листов после утверждения выполняется фоновой задачей
+    route_sheets_status = models.CharField(max_length=20, choices=ROUTE_SHEETS_STATUS_CHOICES, blank=True, verbose_name='Создание маршрутных листов')
+    route_sheets_progress = models.JSONField(default=dict, blank=True, verbose_name='Прогресс создания маршрутных листов', help_text='По участкам: {"Участок 1": {"status": "completed", "created": 10, "existing": 0}, ...}')
+    route_sheets_job = models.ForeignKey('BackgroundJob', on_delete=models.SET_NULL, null=True, blank=True, related_name='+', verbose_name='Задача создания маршрутных листов')
 
 
 class RouteSheet(models.Model):
@@ -111,8 +154,120 @@ class RouteSheet(models.Model):
     position = models.CharField(max_length=255)
     department = models.CharField(max_length=255)
     visit_date = models.DateField()
-    services = models.JSONField(default=list)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Метка пакета, в котором лист создан (bulk_create с ignore_conflicts не возвращает ID вставленных строк)
+    creation_token = models.UUIDField(null=True, blank=True, editable=False, db_index=True, verbose_name='Метка пакета создания')
+
+    class Meta:
+        constraints = [
+            # Один маршрутный лист на пациента и дату визита в клинике (повторное создание - ON CONFLICT DO NOTHING)
+            models.UniqueConstraint(fields=['user', 'patient_id', 'visit_date'], name='route_sheet_unique_visit'),
+        ]
+
+    @property
+    def services(self):
+        """Услуги в формате JSON: [{id, name, cabinet, doctorId, specialization, time, status}]"""
+        return [service.to_dict() for service in self.service_items.all()]
+
+    def set_services(self, services):
+        """Заменить услуги маршрутного листа (список в формате JSON)"""
+        self.service_items.all().delete()
+        RouteSheetService.objects.bulk_create(RouteSheetService.build(self, services))
+        # Сбрасываем prefetch, чтобы services вернул новые данные
+        getattr(self, '_prefetched_objects_cache', {}).pop('service_items', None)
+
+
+class RouteSheetService(models.Model):
+    """Услуга (кабинет) маршрутного листа - отдельная строка для индексированных выборок по врачу и статусу"""
+    STATUS_CHOICES = [
+        ('pending', 'Ожидает'),
+        ('completed', 'Выполнено'),
+    ]
+
+    route_sheet = models.ForeignKey(RouteSheet, on_delete=models.CASCADE, related_name='service_items', verbose_name='Маршрутный лист')
+    service_id = models.CharField(max_length=50, verbose_name='ID услуги', help_text='Идентификатор услуги внутри маршрутного листа (поле id в JSON)')
+    order = models.PositiveIntegerField(default=0, verbose_name='Порядок')
+    name = models.CharField(max_length=255, verbose_name='Наименование')
+    specialization = models.CharField(max_length=255, blank=True, verbose_name='Специализация')
+    cabinet = models.CharField(max_length=50, blank=True, verbose_name='Кабинет')
+    doctor = models.ForeignKey('Doctor', on_delete=models.SET_NULL, null=True, blank=True, related_name='route_sheet_services', verbose_name='Врач')
+    visit_date = models.DateField(verbose_name='Дата визита', help_text='Копия даты визита маршрутного листа для индексов')
+    time = models.CharField(max_length=5, blank=True, verbose_name='Время приема')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name='Статус')
+    version = models.PositiveIntegerField(default=1, verbose_name='Версия', help_text='Увеличивается при каждом изменении статуса (оптимистическая блокировка, ETag)')
+
+    class Meta:
+        verbose_name = 'Услуга маршрутного листа'
+        verbose_name_plural = 'Услуги маршрутных листов'
+        ordering = ['route_sheet', 'order']
+        constraints = [
+            models.UniqueConstraint(fields=['route_sheet', 'service_id'], name='route_sheet_service_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['doctor', 'status', 'visit_date'], name='rs_service_doctor_idx'),
+            models.Index(fields=['route_sheet', 'status'], name='rs_service_sheet_status_idx'),
+            models.Index(fields=['specialization', 'status', 'visit_date'], name='rs_service_spec_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.get_status_display()}) - {self.route_sheet_id}"
+
+    @property
+    def etag(self):
+        """ETag услуги: маршрутный лист, услуга и версия"""
+        return f'"{self.route_sheet_id}-{self.service_id}-{self.version}"'
+
+    def to_dict(self):
+        return {
+            'id': self.service_id,
+            'name': self.name,
+            'cabinet': self.cabinet,
+            'doctorId': str(self.doctor_id) if self.doctor_id else '',
+            'specialization': self.specialization or self.name,
+            'time': self.time,
+            'status': self.status,
+            'version': self.version,
+        }
+
+    @classmethod
+    def build(cls, route_sheet, services, doctor_ids=None):
+        """
+        Несохраненные строки услуг из списка в формате JSON (для bulk_create).
+        doctor_ids - известные ID врачей; ссылки на несуществующих врачей не сохраняются.
+        Без doctor_ids существующие врачи проверяются одним запросом.
+        """
+        services = [service for service in services or [] if isinstance(service, dict)]
+        referenced = {}
+        for service in services:
+            doctor_id = str(service.get('doctorId') or service.get('doctor_id') or '')
+            if doctor_id.isdigit():
+                referenced[doctor_id] = int(doctor_id)
+        if doctor_ids is None:
+            doctor_ids = set(Doctor.objects.filter(id__in=referenced.values()).values_list('id', flat=True)) if referenced else set()
+        else:
+            doctor_ids = {int(doctor_id) for doctor_id in doctor_ids}
+
+        items = []
+        seen = set()
+        for order, service in enumerate(services):
+            service_id = str(service.get('id', order))
+            if service_id in seen:
+                continue
+            seen.add(service_id)
+            doctor_id = referenced.get(str(service.get('doctorId') or service.get('doctor_id') or ''))
+            items.append(cls(
+                route_sheet=route_sheet,
+                service_id=service_id,
+                order=order,
+                name=service.get('name') or service.get('specialization') or '',
+                specialization=service.get('specialization') or service.get('name') or '',
+                cabinet=str(service.get('cabinet') or '')[:50],
+                doctor_id=doctor_id if doctor_id in doctor_ids else None,
+                visit_date=route_sheet.visit_date,
+                time=str(service.get('time') or '')[:5],
+                status='completed' if service.get('status') == 'completed' else 'pending',
+            ))
+        return items
 
 
 class DoctorExamination(models.Model):
@@ -170,8 +325,23 @@ class Expertise(models.Model):
     ], verbose_name='Тип направления')
     referral_sent = models.BooleanField(default=False, verbose_name='Направление отправлено')
     referral_date = models.DateField(null=True, blank=True, verbose_name='Дата направления')
+    occupational_disease = models.BooleanField(default=False, verbose_name='Профзаболевание', help_text='Отметка о профзаболевании в заключениях врачей, заполняется при сохранении')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'iin'], name='expertise_user_iin_idx'),
+            models.Index(fields=['user', 'department'], name='expertise_user_dept_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Признак профзаболевания вычисляется при записи, чтобы отчеты считали его агрегатом в БД
+        self.occupational_disease = has_occupational_disease(self.doctor_conclusions)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'doctor_conclusions' in update_fields and 'occupational_disease' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['occupational_disease']
+        super().save(*args, **kwargs)
+
 
 class EmergencyNotification(models.Model):
     """Экстренное извещение при инфекционных заболеваниях (п. 19)"""
@@ -469,6 +639,24 @@ class Contract(models.Model):
     def __str__(self):
         return f"Договор №{self.contract_number} от {self.contract_date} ({self.get_status_display()})"
 
+    def contingent_by_iin(self, iin):
+        """Сотрудники договора с указанным ИИН: контингент договора или контингент, загруженный работодателем"""
+        condition = Q(contract_id=self.pk)
+        if self.employer_id:
+            condition |= Q(user_id=self.employer_id)
+        return ContingentEmployee.objects.filter(condition, iin=iin)
+
+    def completed_examinations_count(self):
+        """
+        Количество пациентов по договору с завершенным медосмотром (экспертиза клиники с заключением профпатолога).
+        Один агрегирующий запрос: экспертизы клиники соединяются с контингентом договора по ИИН.
+        """
+        return Expertise.objects.filter(
+            Exists(self.contingent_by_iin(OuterRef('iin'))),
+            user_id=self.clinic_id,
+            final_verdict__isnull=False,
+        ).exclude(iin='').values('patient_id').distinct().count()
+
 
 class ContractHistory(models.Model):
     """История изменений договора для журналирования всех действий"""
@@ -507,3 +695,47 @@ class ContractHistory(models.Model):
     def __str__(self):
         return f"{self.get_action_display()} - {self.contract.contract_number} ({self.created_at.strftime('%d.%m.%Y %H:%M')})"
 
+
+class BackgroundJob(models.Model):
+    """Фоновая задача (очередь в БД, выполняется командой run_background_jobs)"""
+    JOB_TYPE_CHOICES = [
+        ('contingent_import', 'Загрузка контингента из Excel'),
+        ('plan_route_sheets', 'Создание маршрутных листов по календарному плану'),
+    ]
+
+    STATUS_CHOICES = [
+        ('pending', 'В очереди'),
+        ('running', 'Выполняется'),
+        ('completed', 'Завершена'),
+        ('failed', 'Ошибка'),
+    ]
+
+    job_type = models.CharField(max_length=50, choices=JOB_TYPE_CHOICES, verbose_name='Тип задачи')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name='Статус')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='background_jobs', null=True, blank=True, verbose_name='Пользователь')
+    contract = models.ForeignKey(Contract, on_delete=models.CASCADE, related_name='background_jobs', null=True, blank=True, verbose_name='Договор')
+    payload = models.JSONField(default=dict, blank=True, verbose_name='Параметры задачи')
+    progress = models.JSONField(default=dict, blank=True, verbose_name='Прогресс', help_text='Промежуточные счетчики, обновляются во время выполнения')
+    result = models.JSONField(default=dict, blank=True, verbose_name='Результат')
+    errors = models.JSONField(default=list, blank=True, verbose_name='Ошибки')
+    file_name = models.CharField(max_length=255, blank=True, verbose_name='Имя файла')
+    file_data = models.BinaryField(null=True, blank=True, verbose_name='Содержимое файла', help_text='Хранится до обработки задачи, затем очищается')
+    attempts = models.IntegerField(default=0, verbose_name='Количество попыток')
+    max_attempts = models.IntegerField(default=3, verbose_name='Максимум попыток', help_text='После ошибки задача возвращается в очередь, пока не исчерпаны попытки')
+    run_after = models.DateTimeField(null=True, blank=True, verbose_name='Не запускать до', help_text='Задержка перед повторной попыткой')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='Дата начала')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='Дата завершения')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата обновления')
+
+    class Meta:
+        verbose_name = 'Фоновая задача'
+        verbose_name_plural = 'Фоновые задачи'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+            models.Index(fields=['job_type', 'user', '-created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.get_job_type_display()} #{self.id} ({self.get_status_display()})"
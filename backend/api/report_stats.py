@@ -0,0 +1,57 @@
+"""
+Статистика по результатам медосмотров (экспертизы с заключением профпатолога) для заключительного акта
+и сводного отчета. Итоги по заключениям, профзаболеваниям и отделам считаются одним запросом
+GROUP BY department с условной агрегацией; профзаболевание - поле Expertise.occupational_disease.
+"""
+from typing import List, NamedTuple
+
+from django.db.models import Count, Min, Q
+
+from .models import Expertise
+
+# Счетчик -> условие (для каждого отдела и для итогов; None - все экспертизы)
+COUNTERS = {
+    'total': None,
+    'healthy': Q(final_verdict='fit'),
+    'temporary': Q(final_verdict='temporary_unfit'),
+    'permanent': Q(final_verdict='permanent_unfit'),
+    'occupational_diseases': Q(occupational_disease=True),
+}
+
+
+class ExaminationStats(NamedTuple):
+    total: int
+    healthy: int
+    temporary: int
+    permanent: int
+    occupational_diseases: int
+    # [{'department', 'total', 'healthy', 'temporary', 'permanent', 'occupational_diseases'}] в порядке первой экспертизы
+    departments: List[dict]
+
+
+def finished_expertises(user_id, department=None, start_date=None, end_date=None):
+    """Экспертизы клиники с вынесенным заключением (с фильтрами отчета)"""
+    queryset = Expertise.objects.filter(user_id=user_id, final_verdict__isnull=False)
+    if department:
+        queryset = queryset.filter(department=department)
+    if start_date:
+        queryset = queryset.filter(verdict_date__gte=start_date)
+    if end_date:
+        queryset = queryset.filter(verdict_date__lte=end_date)
+    return queryset
+
+
+def examination_stats(queryset):
+    """Итоги и статистика по отделам для выборки экспертиз - один запрос"""
+    rows = list(
+        queryset.order_by()
+        .values('department')
+        .annotate(
+            first_id=Min('id'),
+            **{name: Count('id', filter=condition) for name, condition in COUNTERS.items()}
+        )
+        .order_by('first_id')
+    )
+    departments = [{'department': row['department'], **{name: row[name] for name in COUNTERS}} for row in rows]
+    totals = {name: sum(row[name] for row in departments) for name in COUNTERS}
+    return ExaminationStats(departments=departments, **totals)
@@ -0,0 +1,621 @@
+"""
+Формирование маршрутных листов: услуги по должности и вредным факторам, обязательные исследования
+и пакетное создание маршрутных листов для календарного плана.
+"""
+import json
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .harmful_factors import resolve_harmful_factors
+from .models import (
+    CalendarPlan, ContingentEmployee, Doctor, FunctionalTest, LaboratoryTest, RouteSheet, RouteSheetService,
+)
+from .route_sheet_scheduler import SlotScheduler
+
+logger = logging.getLogger('api')
+
+
+# Специалисты по должности (для остальных должностей - только терапевт)
+POSITION_SPECIALIZATIONS = {
+    'Бухгалтер': ['Терапевт', 'Окулист', 'Невропатолог'],
+    'Сварщик': ['Профпатолог', 'ЛОР', 'Окулист', 'Хирург', 'Невропатолог', 'Терапевт', 'Рентгенолог'],
+    'Водитель': ['Профпатолог', 'Окулист', 'Невропатолог', 'Терапевт'],
+}
+
+# Базовые лабораторные исследования для всех
+BASE_LAB_TESTS = [
+    {'test_type': 'Общий анализ крови', 'test_name': 'ОАК'},
+    {'test_type': 'Общий анализ мочи', 'test_name': 'ОАМ'},
+]
+
+# Лабораторные исследования на основе должности
+POSITION_LAB_TESTS = {
+    'Сварщик': [
+        {'test_type': 'Биохимия крови', 'test_name': 'Биохимия'},
+        {'test_type': 'Анализ на тяжелые металлы', 'test_name': 'Тяжелые металлы'},
+    ],
+    'Водитель': [
+        {'test_type': 'Анализ на алкоголь и наркотики', 'test_name': 'Алкоголь/наркотики'},
+    ],
+}
+
+# Функциональные исследования на основе должности
+POSITION_FUNCTIONAL_TESTS = {
+    'Сварщик': [
+        {'test_type': 'Рентген легких', 'test_name': 'Флюорография'},
+    ],
+    'Водитель': [
+        {'test_type': 'ЭКГ', 'test_name': 'Электрокардиограмма'},
+    ],
+}
+
+
+DOCTOR_FIELDS = ('id', 'name', 'specialization', 'cabinet', 'work_schedule', 'updated_at')
+
+
+def load_clinic_doctors(clinic_user, doctors=None):
+    """
+    Врачи клиники, сгруппированные по специализации (один запрос).
+    doctors - уже загруженные строки Doctor.objects.values(*DOCTOR_FIELDS), чтобы не запрашивать их повторно.
+    """
+    doctors_by_specialization = {}
+    if clinic_user is None or clinic_user.role != 'clinic':
+        return doctors_by_specialization
+    if doctors is None:
+        doctors = Doctor.objects.filter(user=clinic_user).values(*DOCTOR_FIELDS)
+    for doctor in doctors:
+        doctors_by_specialization.setdefault(doctor['specialization'], []).append({
+            'id': str(doctor['id']),
+            'name': doctor['name'],
+            'cabinet': doctor['cabinet'] or '',
+            'specialization': doctor['specialization'],
+        })
+    return doctors_by_specialization
+
+
+def build_services_for_position(position, harmful_factors, doctors_by_specialization):
+    """
+    Услуги маршрутного листа на основе должности и вредных факторов.
+    Используются реальные врачи клиники (doctors_by_specialization), при их отсутствии - заглушки.
+    Вредные факторы имеют приоритет - если указаны, добавляются дополнительные услуги.
+    """
+    def service_for_specialization(specialization):
+        """Первый доступный врач по специализации или заглушка"""
+        doctors = doctors_by_specialization.get(specialization)
+        if doctors:
+            doctor = doctors[0]
+            return {
+                'name': doctor['specialization'],
+                'cabinet': doctor['cabinet'] or 'Не указан',
+                'doctorId': doctor['id'],
+                'specialization': doctor['specialization'],
+            }
+        return {'name': specialization, 'cabinet': 'Не указан', 'doctorId': '', 'specialization': specialization}
+
+    # Услуги на основе должности
+    services = [service_for_specialization(spec) for spec in POSITION_SPECIALIZATIONS.get(position, ['Терапевт'])]
+
+    # Добавляем услуги на основе вредных факторов (специалисты берутся из справочника факторов).
+    # Факторы обходятся в порядке, указанном у сотрудника - от него зависит порядок дополнительных услуг
+    added_services = []
+    for factor in resolve_harmful_factors(harmful_factors):
+        for spec in factor.specializations:
+            # Проверяем, нет ли уже такой услуги
+            if not any(s['specialization'] == spec for s in services):
+                added_services.append(service_for_specialization(spec))
+    services.extend(added_services)
+
+    # Удаляем дубликаты по специализации
+    seen = set()
+    unique_services = []
+    for service in services:
+        if service['specialization'] not in seen:
+            seen.add(service['specialization'])
+            unique_services.append(service)
+
+    # Генерируем время для каждого кабинета (начиная с 9:00, по 15 минут на кабинет)
+    start_time = datetime.strptime('09:00', '%H:%M')
+    result_services = []
+    for idx, service in enumerate(unique_services):
+        service_time = start_time + timedelta(minutes=idx * 15)
+        result_services.append({
+            'id': str(idx),
+            'name': service['name'],
+            'cabinet': service['cabinet'],
+            'doctorId': service['doctorId'],
+            'specialization': service.get('specialization', service['name']),
+            'time': service_time.strftime('%H:%M'),
+            'status': 'pending',
+        })
+    return result_services
+
+
+def clinic_roster_version(clinic_user, doctors=None):
+    """
+    Версия состава врачей клиники: (количество, последнее изменение).
+    Меняется при добавлении, изменении и удалении врачей - в том числе из других процессов.
+    doctors - уже загруженные строки Doctor.objects.values(*DOCTOR_FIELDS): версия вычисляется по ним без запроса
+    (один раз на создание маршрутных листов, а не на каждого сотрудника).
+    """
+    if doctors is not None:
+        return len(doctors), max((doctor['updated_at'] for doctor in doctors), default=None)
+    roster = Doctor.objects.filter(user=clinic_user).aggregate(count=Count('id'), updated=Max('updated_at'))
+    return roster['count'], roster['updated']
+
+
+class ServiceTemplateCache:
+    """
+    Кеш шаблонов услуг маршрутного листа по ключу (клиника, версия состава врачей, должность, факторы).
+    Сотрудники с одинаковой должностью и набором вредных факторов получают один и тот же список услуг,
+    поэтому он вычисляется один раз; вытесняются давно не использованные шаблоны (LRU).
+    Возвращаются копии - их можно изменять (назначение врачей плана и т.п.).
+    """
+
+    def __init__(self, max_size=512):
+        self.max_size = max_size
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(clinic_id, roster_version, position, harmful_factors):
+        # Коды факторов в исходном порядке (без повторов): порядок влияет на порядок услуг
+        factor_codes = tuple(factor.code for factor in resolve_harmful_factors(harmful_factors))
+        return clinic_id, roster_version, position, factor_codes
+
+    def get_services(self, clinic_user, roster_version, position, harmful_factors, load_doctors):
+        """
+        Услуги для должности и факторов. load_doctors() вызывается только при отсутствии шаблона
+        и должен вернуть врачей клиники по специализации (см. load_clinic_doctors).
+        """
+        key = self.make_key(clinic_user.id if clinic_user else None, roster_version, position, harmful_factors)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+        if template is None:
+            template = tuple(build_services_for_position(position, harmful_factors, load_doctors()))
+            with self._lock:
+                self.misses += 1
+                self._templates[key] = template
+                self._templates.move_to_end(key)
+                while len(self._templates) > self.max_size:
+                    self._templates.popitem(last=False)
+        return [dict(service) for service in template]
+
+    def invalidate_clinic(self, clinic_id):
+        """Удалить шаблоны клиники (при изменении ее врачей)"""
+        with self._lock:
+            for key in [key for key in self._templates if key[0] == clinic_id]:
+                del self._templates[key]
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+
+service_templates = ServiceTemplateCache(max_size=getattr(settings, 'ROUTE_SHEET_TEMPLATE_CACHE_SIZE', 512))
+
+
+@receiver([post_save, post_delete], sender=Doctor)
+def _invalidate_service_templates(sender, instance, **kwargs):
+    # Шаблоны с устаревшим составом врачей не будут найдены и так (версия в ключе),
+    # здесь они удаляются сразу, чтобы не занимать место в кеше
+    service_templates.invalidate_clinic(instance.user_id)
+
+
+def required_tests_for(position, harmful_factors):
+    """Лабораторные и функциональные исследования по должности и вредным факторам: (lab_tests, func_tests)"""
+    lab_tests = list(BASE_LAB_TESTS) + POSITION_LAB_TESTS.get(position, [])
+    func_tests = list(POSITION_FUNCTIONAL_TESTS.get(position, []))
+
+    # Добавляем на основе вредных факторов (исследования берутся из справочника факторов)
+    for factor in resolve_harmful_factors(harmful_factors):
+        for test_type, test_name in factor.lab_tests:
+            if not any(t['test_type'] == test_type for t in lab_tests):
+                lab_tests.append({'test_type': test_type, 'test_name': test_name})
+        for test_type, test_name in factor.functional_tests:
+            if not any(t['test_type'] == test_type for t in func_tests):
+                func_tests.append({'test_type': test_type, 'test_name': test_name})
+    return lab_tests, func_tests
+
+
+def provision_required_tests(entries):
+    """
+    Создать лабораторные и функциональные исследования для нескольких маршрутных листов сразу.
+    entries - [(сохраненный маршрутный лист, должность, вредные факторы)]. Набор исследований вычисляется
+    один раз на сочетание (должность, пункты факторов), все строки записываются двумя bulk_create.
+    Возвращает (количество лабораторных, количество функциональных исследований).
+    """
+    required = {}
+    laboratory = []
+    functional = []
+    for route_sheet, position, harmful_factors in entries:
+        # Порядок пунктов сохраняется - от него зависит порядок исследований
+        key = (position, tuple(factor.code for factor in resolve_harmful_factors(harmful_factors)))
+        tests = required.get(key)
+        if tests is None:
+            tests = required[key] = required_tests_for(position, harmful_factors)
+        lab_tests, func_tests = tests
+        for test in lab_tests:
+            laboratory.append(LaboratoryTest(
+                route_sheet=route_sheet,
+                patient_id=route_sheet.patient_id,
+                patient_name=route_sheet.patient_name,
+                test_type=test['test_type'],
+                test_name=test['test_name'],
+                status='pending',
+            ))
+        for test in func_tests:
+            functional.append(FunctionalTest(
+                route_sheet=route_sheet,
+                patient_id=route_sheet.patient_id,
+                patient_name=route_sheet.patient_name,
+                test_type=test['test_type'],
+                test_name=test['test_name'],
+                status='pending',
+            ))
+    LaboratoryTest.objects.bulk_create(laboratory)
+    FunctionalTest.objects.bulk_create(functional)
+    return len(laboratory), len(functional)
+
+
+def employee_harmful_factors(employee):
+    """Вредные факторы сотрудника списком (в старых записях могут храниться строкой)"""
+    factors = employee.harmful_factors
+    if not factors:
+        return []
+    if isinstance(factors, str):
+        try:
+            return json.loads(factors)
+        except ValueError:
+            return [f.strip() for f in factors.split(',') if f.strip()]
+    if isinstance(factors, list):
+        return factors
+    return []
+
+
+def _parse_plan_date(value):
+    if isinstance(value, str):
+        return datetime.strptime(value.split('T')[0], '%Y-%m-%d').date()
+    return value
+
+
+def plan_departments(plan):
+    """
+    Участки календарного плана: [(участок, дата начала, дата окончания, ID сотрудников)].
+    Участки с некорректными датами пропускаются; без даты окончания период осмотра - один день.
+    """
+    departments_info = plan.departments_info or []
+    if not departments_info:
+        # Если нет информации по участкам, используем общие даты
+        departments_info = [{
+            'department': plan.department,
+            'startDate': plan.start_date,
+            'endDate': plan.end_date,
+            'employeeIds': plan.employee_ids or [],
+        }]
+
+    departments = []
+    for dept_info in departments_info:
+        department = dept_info.get('department', plan.department)
+        try:
+            start_date = _parse_plan_date(dept_info.get('startDate') or dept_info.get('start_date', ''))
+        except ValueError:
+            logger.warning(f"Plan {plan.id}: department {department} has invalid start date, skipped")
+            continue
+        if not start_date:
+            continue
+        try:
+            end_date = _parse_plan_date(dept_info.get('endDate') or dept_info.get('end_date') or start_date)
+        except ValueError:
+            end_date = start_date
+        end_date = max(start_date, end_date or start_date)
+        employee_ids = []
+        for eid in dept_info.get('employeeIds') or dept_info.get('employee_ids', []):
+            try:
+                employee_ids.append(int(eid))
+            except (ValueError, TypeError):
+                pass
+        departments.append((department, start_date, end_date, employee_ids))
+    return departments
+
+
+def clinic_scheduler(clinic_user, start_date, end_date, doctors=None):
+    """
+    Планировщик времени приема (см. api.route_sheet_scheduler) с учетом уже созданных
+    маршрутных листов клиники за период. doctors - строки Doctor.objects.values(*DOCTOR_FIELDS).
+    """
+    if doctors is None:
+        doctors = list(Doctor.objects.filter(user=clinic_user).values(*DOCTOR_FIELDS))
+    scheduler = SlotScheduler(doctors, slot_minutes=getattr(settings, 'ROUTE_SHEET_SLOT_MINUTES', 15))
+    day_load = dict(
+        RouteSheet.objects.filter(user=clinic_user, visit_date__range=(start_date, end_date))
+        .values_list('visit_date').annotate(count=Count('id')).order_by()
+    )
+    scheduler.load_bookings(
+        RouteSheetService.objects.filter(
+            route_sheet__user=clinic_user, visit_date__range=(start_date, end_date), doctor__isnull=False,
+        ).values_list('visit_date', 'doctor_id', 'time').iterator(),
+        day_load,
+    )
+    return scheduler
+
+
+def schedule_route_sheet(clinic_user, visit_date, services, doctors=None):
+    """
+    Назначить врачей и время услугам одного маршрутного листа на заданную дату (services изменяются на месте).
+    doctors - уже загруженные строки Doctor.objects.values(*DOCTOR_FIELDS).
+    """
+    if clinic_user is None or clinic_user.role != 'clinic' or not visit_date:
+        return services
+    scheduler = clinic_scheduler(clinic_user, visit_date, visit_date, doctors)
+    scheduler.schedule(services, scheduler.day_queue(visit_date, visit_date))
+    return services
+
+
+class PlanRouteSheetMaterializer:
+    """
+    Пакетное создание маршрутных листов для утвержденного календарного плана.
+    Сотрудники, врачи и уже существующие маршрутные листы загружаются по одному запросу,
+    маршрутные листы, их услуги и исследования собираются в памяти и записываются четырьмя
+    bulk_create в одной транзакции. Пациенты распределяются по дням периода участка и по врачам
+    (SlotScheduler); повторный запуск не создает дубликатов (проверка по пациенту и периоду участка).
+    """
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.clinic_user = plan.user
+
+    def _scheduled_doctors(self, doctors):
+        """
+        Врачи, между которыми распределяются пациенты: по специализациям, выбранным в плане, -
+        только выбранные врачи, по остальным - все врачи клиники
+        """
+        selected_doctor_ids = {str(doctor_id) for doctor_id in self.plan.selected_doctors or []}
+        if not selected_doctor_ids:
+            return doctors
+        selected = [doctor for doctor in doctors if str(doctor['id']) in selected_doctor_ids]
+        selected_specializations = {doctor['specialization'] for doctor in selected}
+        return selected + [
+            doctor for doctor in doctors
+            if doctor['specialization'] not in selected_specializations
+        ]
+
+    def _resolve_inserted(self, route_sheets, route_sheet_services, route_sheet_factors, creation_token):
+        """
+        ID вставленных маршрутных листов (bulk_create с ignore_conflicts их не возвращает):
+        выбираются строки с меткой пакета creation_token. Листы, которые уже были созданы
+        другим запросом (конфликт по пациенту и дате), метки не имеют и пропускаются.
+        Возвращает [(маршрутный лист, услуги, (должность, факторы))].
+        """
+        if not route_sheets:
+            return []
+        inserted = {
+            (patient_id, visit_date): route_sheet_id
+            for route_sheet_id, patient_id, visit_date in RouteSheet.objects.filter(
+                creation_token=creation_token
+            ).values_list('id', 'patient_id', 'visit_date')
+        }
+        created = []
+        for route_sheet, services, factors in zip(route_sheets, route_sheet_services, route_sheet_factors):
+            route_sheet_id = inserted.get((route_sheet.patient_id, route_sheet.visit_date))
+            if route_sheet_id is not None:
+                route_sheet.pk = route_sheet_id
+                created.append((route_sheet, services, factors))
+        return created
+
+    def run(self, departments=None):
+        """
+        Создать маршрутные листы. departments - список названий участков (по умолчанию все участки плана).
+        Возвращает dict: created, existing, missing_employees, overbooked, unscheduled, departments.
+        """
+        plan = self.plan
+        stats = {'created': 0, 'existing': 0, 'missing_employees': 0, 'overbooked': 0, 'unscheduled': 0, 'departments': 0}
+        if not self.clinic_user or self.clinic_user.role != 'clinic':
+            logger.warning(f"Plan {plan.id} user is not a clinic user: {self.clinic_user}")
+            return stats
+
+        plan_depts = plan_departments(plan)
+        if departments is not None:
+            plan_depts = [dept for dept in plan_depts if dept[0] in departments]
+        stats['departments'] = len(plan_depts)
+
+        all_employee_ids = {eid for _, _, _, employee_ids in plan_depts for eid in employee_ids}
+        # Сотрудники могут быть загружены как работодателем, так и клиникой по договору
+        employees = ContingentEmployee.objects.in_bulk(all_employee_ids)
+
+        # Врачи клиники загружаются одним запросом: для календарей врачей, для шаблонов услуг
+        # и для версии состава врачей (ключ кеша шаблонов) - она вычисляется один раз на запуск
+        doctors = list(Doctor.objects.filter(user=self.clinic_user).values(*DOCTOR_FIELDS))
+        roster_version = clinic_roster_version(self.clinic_user, doctors)
+        if plan_depts:
+            period_start = min(start_date for _, start_date, _, _ in plan_depts)
+            period_end = max(end_date for _, _, end_date, _ in plan_depts)
+        else:
+            period_start = period_end = plan.start_date
+        scheduler = clinic_scheduler(self.clinic_user, period_start, period_end, self._scheduled_doctors(doctors))
+
+        # Уже созданные маршрутные листы сотрудников плана за период: ID пациента -> даты визитов
+        existing = {}
+        for patient_id, visit_date in RouteSheet.objects.filter(
+            user=self.clinic_user,
+            visit_date__range=(period_start, period_end),
+            patient_id__in=[str(eid) for eid in all_employee_ids],
+        ).values_list('patient_id', 'visit_date'):
+            existing.setdefault(patient_id, []).append(visit_date)
+
+        def load_doctors():
+            return load_clinic_doctors(self.clinic_user, doctors)
+
+        plan_factors = plan.harmful_factors or []
+
+        route_sheets = []
+        route_sheet_services = []
+        route_sheet_factors = []
+        for department, start_date, end_date, employee_ids in plan_depts:
+            day_queue = scheduler.day_queue(start_date, end_date)
+            for employee_id in employee_ids:
+                employee = employees.get(employee_id)
+                if employee is None:
+                    stats['missing_employees'] += 1
+                    continue
+                visit_dates = existing.setdefault(str(employee.id), [])
+                if any(start_date <= visit_date <= end_date for visit_date in visit_dates):
+                    stats['existing'] += 1
+                    continue
+
+                # Используем вредные факторы из календарного плана, если они указаны (без дублей, с сохранением
+                # порядка - от него зависят ключ ServiceTemplateCache и порядок услуг)
+                harmful_factors = employee_harmful_factors(employee)
+                if plan_factors:
+                    harmful_factors = list(dict.fromkeys(harmful_factors + plan_factors))
+
+                services = service_templates.get_services(
+                    self.clinic_user, roster_version, employee.position, harmful_factors, load_doctors
+                )
+                # Дата визита, врачи и время - по загрузке врачей участка за период
+                visit_date = scheduler.schedule(services, day_queue)
+                visit_dates.append(visit_date)
+
+                route_sheets.append(RouteSheet(
+                    user=self.clinic_user,
+                    patient_id=str(employee.id),
+                    patient_name=employee.name,
+                    iin=employee.iin or '',
+                    position=employee.position,
+                    department=employee.department,
+                    visit_date=visit_date,
+                ))
+                route_sheet_services.append(services)
+                route_sheet_factors.append((employee.position, harmful_factors))
+
+        doctor_ids = {doctor['id'] for doctor in doctors}
+        creation_token = uuid.uuid4()
+        for route_sheet in route_sheets:
+            route_sheet.creation_token = creation_token
+        with transaction.atomic():
+            # INSERT ... ON CONFLICT DO NOTHING (ограничение route_sheet_unique_visit): листы, созданные
+            # параллельно (create_by_iin, повторный запуск задачи), не дублируются
+            RouteSheet.objects.bulk_create(route_sheets, ignore_conflicts=True)
+            created = self._resolve_inserted(route_sheets, route_sheet_services, route_sheet_factors, creation_token)
+            service_items = []
+            for route_sheet, services, _ in created:
+                service_items.extend(RouteSheetService.build(route_sheet, services, doctor_ids))
+            RouteSheetService.objects.bulk_create(service_items)
+            provision_required_tests(
+                (route_sheet, position, harmful_factors)
+                for route_sheet, _, (position, harmful_factors) in created
+            )
+
+        stats['created'] = len(created)
+        stats['existing'] += len(route_sheets) - len(created)
+        stats['overbooked'] = scheduler.overbooked
+        stats['unscheduled'] = scheduler.unscheduled
+        logger.info(f"Calendar plan {plan.id}: created {stats['created']} route sheets, {stats['existing']} already existed, {stats['missing_employees']} employees not found, {stats['overbooked']} scheduled outside working hours, {stats['unscheduled']} without appointment time")
+        return stats
+
+
+def enqueue_plan_route_sheets(plan, departments=None):
+    """
+    Поставить в очередь создание маршрутных листов по плану (все участки или только указанные).
+    При CALENDAR_PLAN_ROUTE_SHEETS_ASYNC=False задача выполняется сразу в текущем процессе.
+    """
+    from .background_jobs import enqueue_job, run_job
+
+    progress = dict(plan.route_sheets_progress or {})
+    for department, _, _, _ in plan_departments(plan):
+        if departments is None or department in departments:
+            progress[str(department)] = {'status': 'pending'}
+
+    run_now = not getattr(settings, 'CALENDAR_PLAN_ROUTE_SHEETS_ASYNC', True)
+    # Задача становится видна обработчику только вместе с обновленным статусом плана
+    with transaction.atomic():
+        job = enqueue_job(
+            'plan_route_sheets',
+            user=plan.user,
+            contract=plan.contract,
+            payload={'plan_id': plan.id, 'departments': departments},
+            # Без обработчика задач повторять некому - одна попытка, дальше retry_route_sheets
+            max_attempts=1 if run_now else None,
+        )
+        plan.route_sheets_status = 'pending'
+        plan.route_sheets_progress = progress
+        plan.route_sheets_job = job
+        plan.save(update_fields=['route_sheets_status', 'route_sheets_progress', 'route_sheets_job'])
+
+    if run_now:
+        job.status = 'running'
+        job.attempts += 1
+        job.save(update_fields=['status', 'attempts', 'updated_at'])
+        run_job(job)
+        plan.refresh_from_db(fields=['route_sheets_status', 'route_sheets_progress'])
+    return job
+
+
+def run_plan_route_sheets_job(job):
+    """
+    Обработчик фоновой задачи 'plan_route_sheets' (см. api.background_jobs).
+    Участки обрабатываются по отдельности (каждый в своей транзакции): ошибка на одном участке
+    не отменяет остальные, а повторный запуск создает только недостающие маршрутные листы.
+    """
+    from .background_jobs import JobFailed, update_job_progress, will_retry
+
+    try:
+        plan = CalendarPlan.objects.select_related('user').get(id=job.payload.get('plan_id'))
+    except CalendarPlan.DoesNotExist:
+        raise JobFailed(f"Календарный план {job.payload.get('plan_id')} не найден")
+
+    only_departments = job.payload.get('departments')
+    department_names = []
+    for department, _, _, _ in plan_departments(plan):
+        if department not in department_names and (only_departments is None or department in only_departments):
+            department_names.append(department)
+
+    progress = dict(plan.route_sheets_progress or {})
+    CalendarPlan.objects.filter(pk=plan.pk).update(route_sheets_status='running')
+
+    materializer = PlanRouteSheetMaterializer(plan)
+    totals = {'created': 0, 'existing': 0, 'missing_employees': 0, 'overbooked': 0, 'unscheduled': 0}
+    failed = []
+    for done, department in enumerate(department_names, start=1):
+        try:
+            stats = materializer.run(departments=[department])
+            progress[str(department)] = {
+                'status': 'completed',
+                'created': stats['created'],
+                'existing': stats['existing'],
+                'missing_employees': stats['missing_employees'],
+                'overbooked': stats['overbooked'],
+                'unscheduled': stats['unscheduled'],
+            }
+            for key in totals:
+                totals[key] += stats[key]
+        except Exception as e:
+            logger.error(f"Calendar plan {plan.id}: route sheets for department {department} failed: {str(e)}", exc_info=True)
+            progress[str(department)] = {'status': 'failed', 'error': str(e)}
+            failed.append(department)
+        CalendarPlan.objects.filter(pk=plan.pk).update(route_sheets_progress=progress)
+        update_job_progress(job, departments_done=done, departments_failed=len(failed), departments_total=len(department_names), **totals)
+
+    if failed and will_retry(job):
+        # Задача вернется в очередь (см. run_job) - повторяются только участки с ошибкой
+        job.payload = dict(job.payload, departments=failed)
+        CalendarPlan.objects.filter(pk=plan.pk).update(route_sheets_status='pending')
+    else:
+        any_failed = any(info.get('status') == 'failed' for info in progress.values())
+        CalendarPlan.objects.filter(pk=plan.pk).update(route_sheets_status='failed' if any_failed else 'completed')
+    if failed:
+        raise ValueError(f'Не удалось создать маршрутные листы для участков: {", ".join(str(d) for d in failed)}')
+    return dict(totals, departments=len(department_names))
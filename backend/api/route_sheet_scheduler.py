@@ -0,0 +1,289 @@
+"""
+Распределение времени приема в маршрутных листах между врачами клиники.
+Календарь каждого врача строится по его расписанию (Doctor.work_schedule): на каждый день - отсортированный
+список свободных слотов (поиск bisect). Пациенты распределяются по дням периода осмотра и по всем врачам
+нужной специализации с помощью очередей с приоритетом (heapq); заполненные дни удаляются из очереди,
+поэтому стоимость записи пациента не растет с заполнением периода.
+"""
+import heapq
+import logging
+from bisect import bisect_left
+from datetime import timedelta
+
+logger = logging.getLogger('api')
+
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+# Расписание по умолчанию (врач без заполненного расписания): пн-пт, 09:00-18:00
+DEFAULT_WORK_HOURS = (9 * 60, 18 * 60)
+DEFAULT_WORK_SCHEDULE = {weekday: DEFAULT_WORK_HOURS for weekday in range(5)}
+# Запись сверх рабочего времени - не позже конца суток
+DAY_END = 24 * 60
+
+
+def parse_time(value):
+    """'09:30' -> 570 (минуты от начала дня) или None"""
+    try:
+        hours, minutes = str(value).strip().split(':')[:2]
+        result = int(hours) * 60 + int(minutes)
+    except (ValueError, AttributeError):
+        return None
+    return result if 0 <= result <= 24 * 60 else None
+
+
+def format_time(minutes):
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+
+def parse_work_schedule(schedule):
+    """
+    {"monday": {"start": "09:00", "end": "18:00"}, ...} -> {0: (540, 1080), ...} (день недели -> часы работы).
+    Пустые дни - выходные; если расписание не заполнено совсем, используется DEFAULT_WORK_SCHEDULE.
+    """
+    hours = {}
+    if isinstance(schedule, dict):
+        for weekday, name in enumerate(WEEKDAYS):
+            day = schedule.get(name)
+            if not isinstance(day, dict):
+                continue
+            start, end = parse_time(day.get('start')), parse_time(day.get('end'))
+            if start is not None and end is not None and start < end:
+                hours[weekday] = (start, end)
+    return hours or dict(DEFAULT_WORK_SCHEDULE)
+
+
+class DayQueue:
+    """
+    Очередь дней периода для SlotScheduler.schedule() (создается через SlotScheduler.day_queue).
+    Для каждого набора специализаций пациента (с учетом порядка услуг) - своя куча (загрузка, день).
+    Если пациента с таким набором не удалось записать на день, день удаляется из этой кучи насовсем:
+    свободного времени у врачей со временем только меньше, поэтому следующий пациент с тем же набором
+    туда тоже не поместится. Загрузка дней общая (SlotScheduler._day_load), устаревшие записи кучи
+    обновляются при извлечении.
+    """
+
+    def __init__(self, days, day_load):
+        self.days = days
+        self._day_load = day_load
+        self._heaps = {}
+
+    def heap(self, key):
+        heap = self._heaps.get(key)
+        if heap is None:
+            heap = [(self._day_load.get(day, 0), day) for day in self.days]
+            heapq.heapify(heap)
+            self._heaps[key] = heap
+        return heap
+
+    def least_loaded(self):
+        """Наименее загруженный день периода"""
+        heap = self.heap(None)
+        while True:
+            load, day = heap[0]
+            current = self._day_load.get(day, 0)
+            if load == current:
+                return day
+            heapq.heapreplace(heap, (current, day))
+
+
+class SlotScheduler:
+    """
+    Календари врачей клиники и распределение пациентов по ним.
+
+    Для каждого врача и дня хранится отсортированный список свободных слотов (от начала приема
+    до конца суток), для каждой пары (специализация, день) - куча (ближайший свободный слот, врач):
+    услуга получает врача, который раньше всех свободен не раньше окончания предыдущей услуги пациента.
+    Дни периода выбираются по количеству уже записанных пациентов (см. DayQueue), поэтому пациенты
+    равномерно распределяются по датам. Уже занятое время (существующие маршрутные листы)
+    учитывается через load_bookings.
+    Если пациента не удалось записать ни в рабочее время, ни сверх него (нет врачей нужной
+    специализации в эти дни или сутки заполнены), время услуг не назначается (счетчик unscheduled).
+    """
+
+    def __init__(self, doctors, slot_minutes=15):
+        # doctors: [{'id', 'specialization', 'cabinet', 'work_schedule'}]
+        self.slot_minutes = slot_minutes
+        self._doctors = {}
+        self._pool = {}
+        for doctor in doctors:
+            doctor_id = str(doctor['id'])
+            self._doctors[doctor_id] = {
+                'cabinet': doctor.get('cabinet') or '',
+                'hours': parse_work_schedule(doctor.get('work_schedule')),
+            }
+            self._pool.setdefault(doctor['specialization'], []).append(doctor_id)
+        self._bookings = {}  # (doctor_id, дата) -> [минута] - занятое время, еще не перенесенное в _free
+        self._free = {}  # (doctor_id, дата) -> отсортированный список свободных слотов
+        self._day_load = {}  # дата -> количество пациентов
+        self._heaps = {}  # (специализация, дата) -> [(ближайший свободный слот, doctor_id)]
+        self.overbooked = 0
+        self.unscheduled = 0
+
+    def load_bookings(self, bookings, day_load=None):
+        """
+        Учесть уже записанных пациентов: bookings - [(дата визита, ID врача, время)] по услугам,
+        day_load - {дата визита: количество маршрутных листов}
+        """
+        for visit_date, patients in (day_load or {}).items():
+            self._day_load[visit_date] = self._day_load.get(visit_date, 0) + patients
+        for visit_date, doctor_id, time in bookings:
+            doctor_id = str(doctor_id or '')
+            minute = parse_time(time)
+            if doctor_id in self._doctors and minute is not None:
+                self._bookings.setdefault((doctor_id, visit_date), []).append(minute)
+
+    def working_days(self, start_date, end_date):
+        """Дни периода, в которые работает хотя бы один врач (без врачей - будни, в крайнем случае дата начала)"""
+        end_date = max(start_date, end_date or start_date)
+        weekdays = set()
+        for doctor in self._doctors.values():
+            weekdays.update(doctor['hours'])
+        weekdays = weekdays or set(DEFAULT_WORK_SCHEDULE)
+        days = []
+        day = start_date
+        while day <= end_date:
+            if day.weekday() in weekdays:
+                days.append(day)
+            day += timedelta(days=1)
+        return days or [start_date]
+
+    def day_queue(self, start_date, end_date):
+        """Очередь дней периода по загрузке - передается в schedule() для всех пациентов участка"""
+        return DayQueue(self.working_days(start_date, end_date), self._day_load)
+
+    def _free_slots(self, doctor_id, day):
+        """Свободные слоты врача на день: сетка от начала приема до конца суток без занятого времени"""
+        key = (doctor_id, day)
+        free = self._free.get(key)
+        if free is None:
+            start = self._doctors[doctor_id]['hours'][day.weekday()][0]
+            slot = self.slot_minutes
+            taken = set()
+            for minute in self._bookings.pop(key, ()):
+                # Слоты сетки, пересекающиеся с уже записанной услугой
+                slot_start = start + (minute - start) // slot * slot
+                taken.add(slot_start)
+                if minute > slot_start:
+                    taken.add(slot_start + slot)
+            free = [minute for minute in range(start, DAY_END - slot + 1, slot) if minute not in taken]
+            self._free[key] = free
+        return free
+
+    def _day_heap(self, specialization, day):
+        key = (specialization, day)
+        heap = self._heaps.get(key)
+        if heap is None:
+            heap = []
+            for doctor_id in self._pool[specialization]:
+                if day.weekday() in self._doctors[doctor_id]['hours']:
+                    free = self._free_slots(doctor_id, day)
+                    if free:
+                        heap.append((free[0], doctor_id))
+            heapq.heapify(heap)
+            self._heaps[key] = heap
+        return heap
+
+    def _pick(self, specialization, day, cursor, overtime):
+        """
+        Самый ранний слот не раньше cursor у врачей специализации: (минута, doctor_id) или None.
+        Ключ кучи - ближайший свободный слот врача (нижняя граница: после записи он может устареть
+        и обновляется здесь), поэтому просматриваются только врачи, которые могут оказаться раньше
+        уже найденного. Врачи, занятые до конца суток, из кучи удаляются.
+        """
+        heap = self._day_heap(specialization, day)
+        popped = []
+        best = None
+        while heap and (best is None or heap[0][0] < best[0]):
+            entry = heapq.heappop(heap)
+            popped.append(entry)
+            doctor_id = entry[1]
+            free = self._free_slots(doctor_id, day)
+            index = bisect_left(free, cursor)
+            if index == len(free):
+                continue
+            minute = free[index]
+            day_end = DAY_END if overtime else self._doctors[doctor_id]['hours'][day.weekday()][1]
+            if minute + self.slot_minutes <= day_end and (best is None or minute < best[0]):
+                best = (minute, doctor_id)
+        for _, doctor_id in popped:
+            free = self._free_slots(doctor_id, day)
+            if free:
+                heapq.heappush(heap, (free[0], doctor_id))
+        return best
+
+    def _book(self, doctor_id, day, minute):
+        """Занять слот врача (запись врача в куче специализации обновится в _pick)"""
+        free = self._free_slots(doctor_id, day)
+        del free[bisect_left(free, minute)]
+
+    def _assign(self, services, day, overtime=False):
+        """
+        Записать пациента на день: врач и время для каждой услуги по порядку.
+        Если у какой-то специализации в этот день нет свободного времени, ничего не меняется
+        и возвращается False. overtime=True - допускается запись после окончания рабочего дня (до конца суток).
+        """
+        cursor = None
+        chosen = []  # (услуга, минута, doctor_id)
+        placeholders = []  # (услуга, минута) - специализации без врачей в клинике
+        for service in services:
+            specialization = service.get('specialization') or service.get('name')
+            if specialization not in self._pool:
+                minute = cursor if cursor is not None else DEFAULT_WORK_HOURS[0]
+                placeholders.append((service, minute))
+                cursor = minute + self.slot_minutes
+                continue
+
+            found = self._pick(specialization, day, cursor or 0, overtime)
+            if found is None:
+                return False
+            minute, doctor_id = found
+            chosen.append((service, minute, doctor_id))
+            cursor = minute + self.slot_minutes
+
+        for service, minute, doctor_id in chosen:
+            self._book(doctor_id, day, minute)
+            service['doctorId'] = doctor_id
+            service['cabinet'] = self._doctors[doctor_id]['cabinet'] or service.get('cabinet') or 'Не указан'
+            service['time'] = format_time(minute)
+        for service, minute in placeholders:
+            service['time'] = format_time(minute)
+        return True
+
+    def _schedule_in(self, services, day_queue, overtime):
+        """Записать пациента на наименее загруженный подходящий день очереди; заполненные дни удаляются"""
+        key = (tuple(service.get('specialization') or service.get('name') for service in services), overtime)
+        heap = day_queue.heap(key)
+        while heap:
+            load, day = heap[0]
+            current = self._day_load.get(day, 0)
+            if load != current:
+                heapq.heapreplace(heap, (current, day))
+                continue
+            if self._assign(services, day, overtime):
+                heapq.heapreplace(heap, (current + 1, day))
+                return day
+            # Для этого набора специализаций день заполнен - насовсем
+            heapq.heappop(heap)
+        return None
+
+    def schedule(self, services, day_queue):
+        """
+        Назначить врачей и время услугам пациента (services изменяются на месте) и вернуть дату визита.
+        Выбирается наименее загруженный день, в который есть свободное время у всех нужных специалистов;
+        если весь период заполнен - запись сверх рабочего времени (overbooked). Если и это невозможно,
+        время услугам не назначается (unscheduled): пациент получает наименее загруженный день без записи
+        к врачам, чтобы не занимать чужое время.
+        """
+        day = self._schedule_in(services, day_queue, overtime=False)
+        if day is None:
+            day = self._schedule_in(services, day_queue, overtime=True)
+            if day is not None:
+                self.overbooked += 1
+        if day is None:
+            day = day_queue.least_loaded()
+            for service in services:
+                service['time'] = ''
+            self.unscheduled += 1
+
+        self._day_load[day] = self._day_load.get(day, 0) + 1
+        return day
@@ -1,12 +1,37 @@
+from django.db import connection, transaction
+from django.db.models import Prefetch
 from rest_framework import serializers
 from decimal import Decimal, InvalidOperation
 from .models import (
     User, ContingentEmployee, CalendarPlan, RouteSheet, DoctorExamination, Expertise,
     EmergencyNotification, HealthImprovementPlan, RecommendationTracking, Doctor,
-    LaboratoryTest, FunctionalTest, Referral, PatientQueue, Contract, ContractHistory
+    LaboratoryTest, FunctionalTest, Referral, PatientQueue, Contract, ContractHistory, BackgroundJob,
+    RouteSheetService
 )
 
 
+def latest_route_sheets(employee_ids):
+    """
+    Последние маршрутные листы сотрудников вместе с услугами и врачами: {str(ID сотрудника): RouteSheet}.
+    Постоянное количество запросов независимо от числа сотрудников (для списка передается
+    в ContingentEmployeeSerializer через context['route_sheets']).
+    """
+    patient_ids = [str(employee_id) for employee_id in employee_ids]
+    if not patient_ids:
+        return {}
+    route_sheets = RouteSheet.objects.filter(patient_id__in=patient_ids)
+    if connection.vendor == 'postgresql':
+        # DISTINCT ON (patient_id) - последний лист каждого сотрудника одним запросом
+        route_sheets = route_sheets.order_by('patient_id', '-visit_date', '-id').distinct('patient_id')
+    else:
+        latest = {}
+        for route_sheet_id, patient_id in route_sheets.order_by('-visit_date', '-id').values_list('id', 'patient_id'):
+            latest.setdefault(patient_id, route_sheet_id)
+        route_sheets = RouteSheet.objects.filter(id__in=latest.values())
+    service_items = Prefetch('service_items', queryset=RouteSheetService.objects.select_related('doctor'))
+    return {route_sheet.patient_id: route_sheet for route_sheet in route_sheets.prefetch_related(service_items)}
+
+
 class SafeDecimalField(serializers.DecimalField):
     """DecimalField с безопасной обработкой некорректных значений"""
     def to_representation(self, value):
@@ -59,43 +84,40 @@ class ContingentEmployeeSerializer(serializers.ModelSerializer):
     
     def get_route_sheet_info(self, obj):
         """Получение информации о маршрутных листах для сотрудника"""
-        from .models import RouteSheet, Doctor
+        # Для списка последние листы загружаются заранее (см. latest_route_sheets), иначе - запрос для одного сотрудника
+        route_sheets = self.context.get('route_sheets')
+        if route_sheets is None:
+            route_sheets = latest_route_sheets([obj.id])
         
-        # Находим все маршрутные листы для этого сотрудника
-        route_sheets = RouteSheet.objects.filter(patient_id=str(obj.id)).order_by('-visit_date')
-        
-        if not route_sheets.exists():
+        # Последний (самый актуальный) маршрутный лист
+        latest_route_sheet = route_sheets.get(str(obj.id))
+        if latest_route_sheet is None:
             return None
         
-        # Берем последний (самый актуальный) маршрутный лист
-        latest_route_sheet = route_sheets.first()
-        
-        # Получаем информацию о врачах из услуг
+        # Получаем информацию о врачах из услуг (врачи загружены вместе с услугами)
         doctors_info = []
-        services = latest_route_sheet.services if isinstance(latest_route_sheet.services, list) else []
+        services = list(latest_route_sheet.service_items.all())
         
         for service in services:
-            doctor_id = service.get('doctorId') or service.get('doctor_id', '')
-            if doctor_id:
-                try:
-                    doctor = Doctor.objects.get(id=doctor_id)
-                    doctors_info.append({
-                        'name': doctor.name,
-                        'specialization': doctor.specialization,
-                        'cabinet': doctor.cabinet or service.get('cabinet', ''),
-                        'time': service.get('time', ''),
-                    })
-                except Doctor.DoesNotExist:
-                    # Если врач не найден, используем данные из услуги
-                    doctors_info.append({
-                        'name': service.get('name', ''),
-                        'specialization': service.get('specialization', service.get('name', '')),
-                        'cabinet': service.get('cabinet', ''),
-                        'time': service.get('time', ''),
-                    })
+            if service.doctor is not None:
+                doctor = service.doctor
+                doctors_info.append({
+                    'name': doctor.name,
+                    'specialization': doctor.specialization,
+                    'cabinet': doctor.cabinet or service.cabinet,
+                    'time': service.time,
+                })
+            else:
+                # Врач не назначен или не найден - используем данные из услуги
+                doctors_info.append({
+                    'name': service.name,
+                    'specialization': service.specialization or service.name,
+                    'cabinet': service.cabinet,
+                    'time': service.time,
+                })
         
         # Определяем время начала и конца
-        times = [s.get('time', '') for s in services if s.get('time')]
+        times = [s.time for s in services if s.time]
         time_range = None
         if times:
             sorted_times = sorted([t for t in times if t])
@@ -137,11 +159,14 @@ class CalendarPlanSerializer(serializers.ModelSerializer):
         model = CalendarPlan
         fields = ['id', 'user', 'contract', 'contract_number', 'department', 'start_date', 'end_date', 'employee_ids', 'departments_info', 'harmful_factors', 'selected_doctors', 'status',
                   'clinic_name', 'clinic_director', 'employer_name', 'employer_representative',
-                  'ses_representative', 'rejection_reason', 'rejected_by_employer_at', 'created_at', 'approved_by_clinic_at', 'approved_by_employer_at', 'sent_to_ses_at', 'employer_name_field']
-        read_only_fields = ['id', 'created_at', 'contract_number', 'employer_name_field', 'rejected_by_employer_at']
+                  'ses_representative', 'rejection_reason', 'rejected_by_employer_at', 'created_at', 'approved_by_clinic_at', 'approved_by_employer_at', 'sent_to_ses_at', 'employer_name_field',
+                  'route_sheets_status', 'route_sheets_progress', 'route_sheets_job']
+        read_only_fields = ['id', 'created_at', 'contract_number', 'employer_name_field', 'rejected_by_employer_at',
+                            'route_sheets_status', 'route_sheets_progress', 'route_sheets_job']
 
 
 class RouteSheetSerializer(serializers.ModelSerializer):
+    # Услуги хранятся в RouteSheetService, в API - прежний список в формате JSON
     services = serializers.JSONField()
     
     def validate_iin(self, value):
@@ -153,6 +178,28 @@ class RouteSheetSerializer(serializers.ModelSerializer):
             return cleaned
         return value
     
+    def validate_services(self, value):
+        if not isinstance(value, list) or not all(isinstance(service, dict) for service in value):
+            raise serializers.ValidationError('services должен быть списком услуг')
+        return value
+    
+    def create(self, validated_data):
+        services = validated_data.pop('services', [])
+        with transaction.atomic():
+            route_sheet = super().create(validated_data)
+            route_sheet.set_services(services)
+        return route_sheet
+    
+    def update(self, instance, validated_data):
+        services = validated_data.pop('services', None)
+        with transaction.atomic():
+            route_sheet = super().update(instance, validated_data)
+            if services is not None:
+                route_sheet.set_services(services)
+            elif 'visit_date' in validated_data:
+                route_sheet.service_items.update(visit_date=route_sheet.visit_date)
+        return route_sheet
+    
     class Meta:
         model = RouteSheet
         fields = ['id', 'patient_id', 'patient_name', 'iin', 'position', 'department', 'visit_date', 'services', 'created_at']
@@ -323,6 +370,14 @@ class ContractHistorySerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at']
 
 
+class BackgroundJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BackgroundJob
+        fields = ['id', 'job_type', 'status', 'user', 'contract', 'file_name', 'progress', 'result', 'errors',
+                  'attempts', 'max_attempts', 'run_after', 'created_at', 'started_at', 'finished_at', 'updated_at']
+        read_only_fields = fields
+
+
 class ContractSerializer(serializers.ModelSerializer):
     scan_files = serializers.JSONField(required=False, allow_null=True, default=list)
     employer_name = serializers.SerializerMethodField()
@@ -0,0 +1,150 @@
+import csv
+import datetime
+import io
+from unittest import mock, skipUnless
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from . import background_jobs
+from .access_context import invalidate_access_context
+from .background_jobs import claim_next_job, enqueue_job, run_job
+from .contingent_import import ContingentImporter
+from .models import Contract, ContingentEmployee, Doctor, RouteSheet, User
+
+
+class ContingentRouteSheetInfoTests(TestCase):
+    """Список контингента с информацией о маршрутных листах (route_sheet_info)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.clinic = User.objects.create(
+            phone='1', username='clinic', role='clinic', registration_data={'name': 'Клиника', 'bin': '111111111111'}
+        )
+        cls.employer = User.objects.create(
+            phone='2', username='employer', role='employer', registration_data={'name': 'Работодатель', 'bin': '222222222222'}
+        )
+        cls.contract = Contract.objects.create(
+            employer=cls.employer, clinic=cls.clinic, employer_bin='222222222222', contract_number='1',
+            contract_date=datetime.date(2026, 1, 1), amount=1, people_count=1,
+            execution_date=datetime.date(2026, 12, 31), status='approved',
+        )
+        cls.doctors = [
+            Doctor.objects.create(user=cls.clinic, name=f'Врач {i}', specialization=specialization, cabinet=str(100 + i))
+            for i, specialization in enumerate(['Терапевт', 'Оториноларинголог'])
+        ]
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def create_employees(self, count):
+        """Сотрудники с двумя маршрутными листами (в списке - последний)"""
+        for i in range(count):
+            employee = ContingentEmployee.objects.create(
+                user=self.employer, contract=self.contract, name=f'Сотрудник {i}', position='Слесарь'
+            )
+            for visit_date in (datetime.date(2026, 2, 2), datetime.date(2026, 2, 9)):
+                route_sheet = RouteSheet.objects.create(
+                    user=self.clinic, patient_id=str(employee.id), patient_name=employee.name,
+                    position=employee.position, visit_date=visit_date,
+                )
+                route_sheet.set_services([
+                    {'id': str(k), 'name': doctor.specialization, 'specialization': doctor.specialization,
+                     'doctorId': str(doctor.id), 'cabinet': '', 'time': f'09:{k * 15:02d}'}
+                    for k, doctor in enumerate(self.doctors)
+                ])
+
+    def get_list(self):
+        # Контекст доступа не кешируется между замерами
+        invalidate_access_context(self.employer.id)
+        response = self.client.get('/api/contingent-employees/', {'user_id': self.employer.id})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def test_list_query_count_does_not_depend_on_employee_count(self):
+        self.create_employees(5)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(self.get_list()), 5)
+
+        self.create_employees(15)
+        with self.assertNumQueries(len(queries)):
+            results = self.get_list()
+        self.assertEqual(len(results), 20)
+        for employee in results:
+            info = employee['route_sheet_info']
+            self.assertEqual(info['visit_date'], '2026-02-09')
+            self.assertEqual(info['services_count'], 2)
+            self.assertEqual(info['time_range'], '09:00 - 09:15')
+            self.assertEqual([doctor['name'] for doctor in info['doctors']], ['Врач 0', 'Врач 1'])
+
+    def test_service_without_doctor_uses_service_data(self):
+        employee = ContingentEmployee.objects.create(
+            user=self.employer, contract=self.contract, name='Сотрудник', position='Слесарь'
+        )
+        route_sheet = RouteSheet.objects.create(
+            user=self.clinic, patient_id=str(employee.id), patient_name=employee.name,
+            position=employee.position, visit_date=datetime.date(2026, 2, 2),
+        )
+        route_sheet.set_services([
+            {'id': '1', 'name': 'Терапевт', 'specialization': 'Терапевт',
+             'doctorId': str(self.doctors[0].id), 'cabinet': '', 'time': '09:00'},
+            {'id': '2', 'name': 'Флюорография', 'specialization': '', 'doctorId': '', 'cabinet': '5', 'time': '09:30'},
+        ])
+
+        [result] = self.get_list()
+        self.assertEqual(result['route_sheet_info']['doctors'], [
+            {'name': 'Врач 0', 'specialization': 'Терапевт', 'cabinet': '100', 'time': '09:00'},
+            {'name': 'Флюорография', 'specialization': 'Флюорография', 'cabinet': '5', 'time': '09:30'},
+        ])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'COPY есть только в PostgreSQL')
+class ContingentCopyImportJobTests(TransactionTestCase):
+    """Фоновая загрузка контингента через COPY (строки задачи должны быть видны другим соединениям)"""
+
+    HEADER = [
+        '№ п/п', 'ФИО', 'Дата рождения', 'Пол', 'Объект или участок', 'Занимаемая должность', 'Общий стаж',
+        'Стаж по занимаемой должности', 'Дата последнего медосмотра', 'Профессиональная вредность',
+        'Примечание', 'ИИН', 'Телефон',
+    ]
+
+    def setUp(self):
+        self.clinic = User.objects.create(
+            phone='1', username='clinic', role='clinic', registration_data={'name': 'Клиника', 'bin': '111111111111'}
+        )
+        self.contract = Contract.objects.create(
+            clinic=self.clinic, employer_bin='222222222222', contract_number='1',
+            contract_date=datetime.date(2026, 1, 1), amount=1, people_count=1,
+            execution_date=datetime.date(2026, 12, 31), status='approved',
+        )
+
+    def make_csv(self, count):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=';')
+        writer.writerow(self.HEADER)
+        for i in range(count):
+            writer.writerow([
+                i + 1, f'Сотрудник {i}', '01.02.1990', 'Женский', 'Цех', 'Сварщик', '5', '3', '01.01.2023',
+                'п.14', '', '', '',
+            ])
+        return buffer.getvalue().encode('utf-8')
+
+    def test_copy_import_job_reports_progress(self):
+        enqueue_job(
+            'contingent_import', user=self.clinic, contract=self.contract, payload={'loader': 'copy'},
+            file_name='contingent.csv', file_data=self.make_csv(50),
+        )
+        # Прогресс сообщается несколько раз во время COPY
+        with mock.patch.object(ContingentImporter, 'PROGRESS_EVERY', 10), \
+                mock.patch.object(background_jobs, 'update_job_progress', wraps=background_jobs.update_job_progress) as progress:
+            job = run_job(claim_next_job())
+
+        self.assertEqual(job.status, 'completed', job.errors)
+        self.assertEqual(job.result['loader'], 'copy')
+        self.assertEqual(job.result['created'], 50)
+        self.assertGreater(progress.call_count, 5)
+        job.refresh_from_db()
+        self.assertEqual(job.progress['rows_processed'], 50)
+        self.assertEqual(ContingentEmployee.objects.filter(contract=self.contract).count(), 50)
@@ -9,7 +9,7 @@ from django.core.cache import cache
 from django.http import HttpResponse, FileResponse
 import sys
 from django.contrib.auth.hashers import make_password, check_password
-from openpyxl import Workbook, load_workbook
+from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
 from openpyxl.utils import get_column_letter
 from openpyxl.worksheet.datavalidation import DataValidation
@@ -38,20 +38,35 @@ import json
 import os
 import logging
 from datetime import datetime
-from django.db.models import Q
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, F, OuterRef, Q
 
 logger = logging.getLogger('api')
 from .models import (
-    User, ContingentEmployee, CalendarPlan, RouteSheet, DoctorExamination, Expertise,
+    normalize_bin, User, ContingentEmployee, CalendarPlan, RouteSheet, RouteSheetService, DoctorExamination, Expertise,
     EmergencyNotification, HealthImprovementPlan, RecommendationTracking, Doctor,
-    LaboratoryTest, FunctionalTest, Referral, PatientQueue, Contract, ContractHistory
+    LaboratoryTest, FunctionalTest, Referral, PatientQueue, Contract, ContractHistory, BackgroundJob
 )
 from .serializers import (
     UserSerializer, ContingentEmployeeSerializer, CalendarPlanSerializer,
     RouteSheetSerializer, DoctorExaminationSerializer, ExpertiseSerializer,
     EmergencyNotificationSerializer, HealthImprovementPlanSerializer, RecommendationTrackingSerializer,
     DoctorSerializer, LaboratoryTestSerializer, FunctionalTestSerializer, ReferralSerializer,
-    PatientQueueSerializer, ContractSerializer, ContractHistorySerializer
+    PatientQueueSerializer, ContractSerializer, ContractHistorySerializer, BackgroundJobSerializer,
+    latest_route_sheets,
+)
+from .contingent_import import (
+    ContingentFileError, ContingentImporter, file_content_hash, get_cached_validation,
+    open_contingent_file, validate_contingent_file,
+)
+from .access_context import CONTRACT_ACCESS_STATUSES, get_access_context, invalidate_access_context
+from .background_jobs import enqueue_job
+from .report_stats import examination_stats, finished_expertises
+from .harmful_factors import HARMFUL_FACTOR_LABELS
+from .route_sheet_builder import (
+    DOCTOR_FIELDS, build_services_for_position, enqueue_plan_route_sheets, clinic_roster_version, load_clinic_doctors,
+    schedule_route_sheet,
+    provision_required_tests, service_templates,
 )
 
 
@@ -329,6 +344,8 @@ class UserViewSet(viewsets.ModelViewSet):
                     contracts_updated = unlinked_contracts.update(employer=user)
                     
                     logger.info(f"[REGISTRATION] Linked {contracts_updated} contracts to employer {user.id} with BIN {bin_normalized}")
+                    # update() не вызывает сигналы - сбрасываем контекст доступа явно
+                    invalidate_access_context(user.id)
                     
                     # Создаем записи в истории для каждого связанного договора
                     for contract in unlinked_contracts:
@@ -358,26 +375,10 @@ class UserViewSet(viewsets.ModelViewSet):
         
         try:
             # Нормализуем БИН (убираем пробелы, приводим к строке)
-            bin_normalized = ''.join(str(bin_number).strip().split())
-            
-            # Ищем пользователя с указанным БИН в registration_data
-            # Ищем по полям 'bin' и 'inn' (так как при регистрации может быть сохранено как 'inn')
-            employers = User.objects.filter(role='employer')
+            bin_normalized = normalize_bin(bin_number)
             
-            employer = None
-            for emp in employers:
-                reg_data = emp.registration_data or {}
-                # Проверяем оба варианта: bin и inn
-                emp_bin = str(reg_data.get('bin', '')).strip()
-                emp_inn = str(reg_data.get('inn', '')).strip()
-                
-                # Нормализуем для сравнения
-                emp_bin_normalized = ''.join(emp_bin.split())
-                emp_inn_normalized = ''.join(emp_inn.split())
-                
-                if emp_bin_normalized == bin_normalized or emp_inn_normalized == bin_normalized:
-                    employer = emp
-                    break
+            # Поиск по индексированному полю bin (заполняется из registration_data при сохранении)
+            employer = User.objects.filter(role='employer', bin=bin_normalized).first() if bin_normalized else None
             
             if employer:
                 serializer = UserSerializer(employer)
@@ -412,25 +413,10 @@ class UserViewSet(viewsets.ModelViewSet):
         
         try:
             # Нормализуем БИН (убираем пробелы, приводим к строке)
-            bin_normalized = ''.join(str(bin_number).strip().split())
+            bin_normalized = normalize_bin(bin_number)
             
-            # Ищем клинику с указанным БИН в registration_data
-            clinics = User.objects.filter(role='clinic')
-            
-            clinic = None
-            for cl in clinics:
-                reg_data = cl.registration_data or {}
-                # Проверяем оба варианта: bin и inn
-                clinic_bin = str(reg_data.get('bin', '')).strip()
-                clinic_inn = str(reg_data.get('inn', '')).strip()
-                
-                # Нормализуем для сравнения
-                clinic_bin_normalized = ''.join(clinic_bin.split())
-                clinic_inn_normalized = ''.join(clinic_inn.split())
-                
-                if clinic_bin_normalized == bin_normalized or clinic_inn_normalized == bin_normalized:
-                    clinic = cl
-                    break
+            # Поиск по индексированному полю bin (заполняется из registration_data при сохранении)
+            clinic = User.objects.filter(role='clinic', bin=bin_normalized).first() if bin_normalized else None
             
             if clinic:
                 serializer = UserSerializer(clinic)
@@ -664,56 +650,51 @@ class UserViewSet(viewsets.ModelViewSet):
 class ContingentEmployeeViewSet(viewsets.ModelViewSet):
     serializer_class = ContingentEmployeeSerializer
 
+    def get_serializer(self, *args, **kwargs):
+        # Для списка (страницы) последние маршрутные листы сотрудников и их врачи загружаются
+        # заранее постоянным числом запросов, а не отдельными запросами для каждого сотрудника
+        if kwargs.get('many') and args:
+            employees = list(args[0])
+            kwargs.setdefault('context', self.get_serializer_context())
+            kwargs['context']['route_sheets'] = latest_route_sheets(employee.id for employee in employees)
+            return self.get_serializer_class()(employees, *args[1:], **kwargs)
+        return super().get_serializer(*args, **kwargs)
+
     def get_queryset(self):
         user_id = self.request.query_params.get('user_id')
         contract_id = self.request.query_params.get('contract_id')
         
         if user_id:
-            try:
-                user = User.objects.get(id=user_id)
-                
-                # Если указан contract_id, фильтруем только по этому договору
-                if contract_id:
-                    try:
-                        contract = Contract.objects.select_related('clinic', 'employer').get(id=contract_id)
-                        # Проверяем права доступа к договору
-                        if user.role == 'clinic' and contract.clinic == user:
-                            return ContingentEmployee.objects.filter(contract=contract).select_related('user', 'contract')
-                        elif user.role == 'employer' and (contract.employer == user or contract.employer_bin == user.registration_data.get('bin')):
-                            return ContingentEmployee.objects.filter(contract=contract).select_related('user', 'contract')
-                        else:
-                            return ContingentEmployee.objects.none()
-                    except Contract.DoesNotExist:
-                        return ContingentEmployee.objects.none()
-                
-                # Если пользователь - клиника, возвращаем контингент всех работодателей И контингент, загруженный самой клиникой
-                if user.role == 'clinic':
-                    # Объединяем все варианты в один оптимизированный запрос
-                    return ContingentEmployee.objects.filter(
-                        Q(user__role='employer') | Q(user=user) | Q(contract__clinic=user)
-                    ).select_related('user', 'contract').distinct()
-                    print(f"DEBUG: Итоговый queryset: {queryset.count()} записей", file=sys.stderr)
-                    
-                    return queryset
-                # Если пользователь - работодатель, возвращаем его контингент И контингент, загруженный клиникой по договору
-                elif user.role == 'employer':
-                    # Находим все договоры с этим работодателем (не только approved, но и активные)
-                    user_bin = user.registration_data.get('bin') or user.registration_data.get('inn') if user.registration_data else None
-                    allowed_statuses = ['approved', 'active', 'in_progress', 'sent', 'pending_approval']
-                    contracts = Contract.objects.filter(
-                        Q(employer=user) | (Q(employer_bin=user_bin) if user_bin else Q()),
-                        status__in=allowed_statuses
-                    ).select_related('clinic', 'employer')
-                    
-                    # Объединяем все варианты в один оптимизированный запрос
-                    return ContingentEmployee.objects.filter(
-                        Q(user=user) | Q(contract__in=contracts)
-                    ).select_related('user', 'contract').distinct()
-                else:
-                    return ContingentEmployee.objects.filter(user=user).select_related('user', 'contract')
-            except User.DoesNotExist:
+            # Роль и доступные договоры - из кешированного контекста доступа (без запросов к User и Contract)
+            context = get_access_context(user_id)
+            if context is None:
+                return ContingentEmployee.objects.none()
+            
+            # Если указан contract_id, фильтруем только по этому договору
+            if contract_id:
+                # Проверяем права доступа к договору
+                if context.can_access_contract(contract_id):
+                    return ContingentEmployee.objects.filter(contract_id=contract_id).select_related('user', 'contract__employer')
                 return ContingentEmployee.objects.none()
-        return ContingentEmployee.objects.all().select_related('user', 'contract')
+            
+            # Если пользователь - клиника, возвращаем контингент всех работодателей И контингент, загруженный самой клиникой
+            if context.is_clinic:
+                # Объединяем все варианты в один оптимизированный запрос
+                return ContingentEmployee.objects.filter(
+                    Q(user__role='employer') | Q(user_id=context.user_id) | Q(contract__clinic_id=context.user_id)
+                ).select_related('user', 'contract__employer').distinct()
+            # Если пользователь - работодатель, возвращаем его контингент И контингент, загруженный клиникой по договору
+            elif context.is_employer:
+                # Договоры с этим работодателем (не только approved, но и активные)
+                contract_ids = context.contract_ids(CONTRACT_ACCESS_STATUSES)
+                
+                # Объединяем все варианты в один оптимизированный запрос
+                return ContingentEmployee.objects.filter(
+                    Q(user_id=context.user_id) | Q(contract_id__in=contract_ids)
+                ).select_related('user', 'contract__employer').distinct()
+            else:
+                return ContingentEmployee.objects.filter(user_id=context.user_id).select_related('user', 'contract__employer')
+        return ContingentEmployee.objects.all().select_related('user', 'contract__employer')
 
     @action(detail=False, methods=['get'])
     def by_contract_optimized(self, request):
@@ -727,17 +708,13 @@ class ContingentEmployeeViewSet(viewsets.ModelViewSet):
             return Response({'error': 'user_id и contract_id обязательны'}, status=400)
         
         try:
-            user = User.objects.get(id=user_id)
+            context = get_access_context(user_id)
+            if context is None:
+                raise User.DoesNotExist
             contract = Contract.objects.select_related('clinic', 'employer').get(id=contract_id)
             
             # Проверяем права доступа
-            has_access = False
-            if user.role == 'clinic' and contract.clinic == user:
-                has_access = True
-            elif user.role == 'employer' and (contract.employer == user or contract.employer_bin == user.registration_data.get('bin')):
-                has_access = True
-            
-            if not has_access:
+            if not context.can_access_contract(contract.id):
                 return Response({'error': 'Нет доступа к этому договору'}, status=403)
             
             # Оптимизированный запрос с пагинацией
@@ -821,17 +798,13 @@ class ContingentEmployeeViewSet(viewsets.ModelViewSet):
             return Response({'error': 'user_id and contract_id are required'}, status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            user = User.objects.get(id=user_id)
+            context = get_access_context(user_id)
+            if context is None:
+                raise User.DoesNotExist
             contract = Contract.objects.get(id=contract_id)
             
             # Проверяем права доступа к договору
-            has_access = False
-            if user.role == 'clinic' and contract.clinic == user:
-                has_access = True
-            elif user.role == 'employer' and (contract.employer == user or contract.employer_bin == user.registration_data.get('bin')):
-                has_access = True
-            
-            if not has_access:
+            if not context.can_access_contract(contract.id):
                 return Response({'error': 'Access denied'}, status=status.HTTP_403_FORBIDDEN)
             
             # Быстрый подсчет без загрузки данных
@@ -959,8 +932,16 @@ class ContingentEmployeeViewSet(viewsets.ModelViewSet):
             contract_id = request.data.get('contract_id')  # ID договора
             excel_file = request.FILES.get('file')
             replace_existing = request.data.get('replace_existing', 'false').lower() == 'true'  # Флаг замены существующих записей
+            async_mode = str(request.data.get('async', 'false')).lower() == 'true'  # Обработка в фоновой задаче
+            # mode=merge: обновление списка без удаления (изменившиеся записи обновляются, новые добавляются)
+            merge_mode = str(request.data.get('mode', '')).lower() == 'merge'
+            delete_missing = str(request.data.get('delete_missing', 'false')).lower() == 'true'  # При слиянии удалить отсутствующих в файле
+            # Способ записи: orm (bulk_create), copy (PostgreSQL COPY), auto - по размеру файла
+            loader = str(request.data.get('loader', 'auto')).lower()
+            if loader not in ('auto', 'orm', 'copy'):
+                return Response({'error': 'loader должен быть одним из: auto, orm, copy'}, status=status.HTTP_400_BAD_REQUEST)
             
-            print(f"DEBUG UPLOAD: user_id={user_id}, contract_id={contract_id}, file={excel_file.name if excel_file else None}, replace_existing={replace_existing}", file=sys.stderr)
+            print(f"DEBUG UPLOAD: user_id={user_id}, contract_id={contract_id}, file={excel_file.name if excel_file else None}, replace_existing={replace_existing}, merge={merge_mode}", file=sys.stderr)
             
             if not excel_file:
                 return Response({'error': 'Excel file is required'}, status=status.HTTP_400_BAD_REQUEST)
@@ -1021,101 +1002,22 @@ class ContingentEmployeeViewSet(viewsets.ModelViewSet):
                         contract = contracts
                     else:
                         return Response({'error': f'Необходимо выбрать активный договор для загрузки контингента. Разрешенные статусы: {", ".join(allowed_statuses)}'}, status=status.HTTP_400_BAD_REQUEST)
-            workbook = load_workbook(excel_file)
-            worksheet = workbook.active
-            
-            # ВАЛИДАЦИЯ СТРУКТУРЫ ФАЙЛА
-            # Проверяем, что это наш шаблон по характерным признакам
-            
-            # 1. Проверяем заголовок документа в первой строке
-            first_cell = worksheet['A1'].value
-            if not first_cell or 'СПИСОК лиц, подлежащих обязательному медицинскому осмотру' not in str(first_cell):
-                return Response({
-                    'error': 'Загружаемый файл не соответствует шаблону',
-                    'detail': 'Пожалуйста, скачайте последний действующий шаблон и заполните его'
-                }, status=status.HTTP_400_BAD_REQUEST)
-            
-            # 2. Проверяем наличие ссылки на приказ во второй строке
-            second_cell = worksheet['A2'].value
-            if not second_cell or '№ ҚР ДСМ-131/2020' not in str(second_cell):
-                return Response({
-                    'error': 'Загружаемый файл не соответствует шаблону',
-                    'detail': 'Пожалуйста, скачайте последний действующий шаблон и заполните его'
-                }, status=status.HTTP_400_BAD_REQUEST)
-            
-            # Пропускаем заголовки (первые 2-3 строки могут быть заголовками)
-            # Ищем строку с заголовками колонок
-            header_row = None
-            for idx, row in enumerate(worksheet.iter_rows(min_row=1, max_row=5), start=1):
-                row_values = [cell.value for cell in row if cell.value]
-                if any('ФИО' in str(val) or '№ п/п' in str(val) for val in row_values):
-                    header_row = idx
-                    break
-            
-            if not header_row:
-                return Response({
-                    'error': 'Не найдены заголовки таблицы в шаблоне',
-                    'detail': 'Пожалуйста, скачайте последний действующий шаблон и заполните его'
-                }, status=status.HTTP_400_BAD_REQUEST)
-            
-            # Маппинг колонок (поиск по заголовкам)
-            column_map = {}
-            header_cells = worksheet[header_row]
-            for idx, cell in enumerate(header_cells, start=1):
-                val = str(cell.value).lower() if cell.value else ''
-                if '№ п/п' in val or 'номер' in val:
-                    column_map['number'] = idx
-                elif 'фио' in val or 'ф.и.о' in val:
-                    column_map['name'] = idx
-                elif 'дата рождения' in val:
-                    column_map['birth_date'] = idx
-                elif 'пол' in val:
-                    column_map['gender'] = idx
-                elif 'объект' in val or 'участок' in val:
-                    column_map['department'] = idx
-                elif 'должность' in val:
-                    column_map['position'] = idx
-                elif 'общий стаж' in val:
-                    column_map['total_experience'] = idx
-                elif 'стаж по должности' in val or 'стаж по занимаемой' in val:
-                    column_map['position_experience'] = idx
-                elif 'последний медосмотр' in val or 'дата последнего' in val:
-                    column_map['last_examination'] = idx
-                elif 'вредность' in val or 'профессиональная' in val:
-                    column_map['harmful_factors'] = idx
-                elif 'примечание' in val:
-                    column_map['notes'] = idx
-                elif 'иин' in val or 'иип' in val:
-                    column_map['iin'] = idx
-                elif 'телефон' in val:
-                    column_map['phone'] = idx
-                elif 'квартал' in val:
-                    column_map['quarter'] = idx
-            
-            # 3. Проверяем наличие обязательных колонок
-            required_columns = ['name', 'department', 'position']
-            missing_columns = []
-            for col in required_columns:
-                if col not in column_map:
-                    col_names = {
-                        'name': 'ФИО',
-                        'department': 'Объект/участок',
-                        'position': 'Занимаемая должность'
-                    }
-                    missing_columns.append(col_names.get(col, col))
-            
-            if missing_columns:
-                return Response({
-                    'error': 'Загружаемый файл не соответствует шаблону',
-                    'detail': f'Отсутствуют обязательные колонки: {", ".join(missing_columns)}. Пожалуйста, скачайте последний действующий шаблон и заполните его'
-                }, status=status.HTTP_400_BAD_REQUEST)
+            # ВАЛИДАЦИЯ СТРУКТУРЫ ФАЙЛА (заголовок шаблона, строка заголовков, обязательные колонки)
+            # Файл читается потоково в режиме read-only: в памяти не материализуются все ячейки и стили.
+            # Если этот же файл уже проверялся через validate_excel, структура и число строк берутся из результата проверки
+            content_hash = file_content_hash(excel_file)
+            validation = get_cached_validation(content_hash)
+            # CSV/TSV (по расширению) разбираются модулем csv
+            sheet = open_contingent_file(excel_file, max_rows=getattr(settings, 'CONTINGENT_IMPORT_MAX_ROWS', 50000), validation=validation)
             
             # ВАЖНО: Проверяем наличие существующих записей
             existing_employees_count = ContingentEmployee.objects.filter(contract=contract).count()
             print(f"DEBUG UPLOAD START: Договор {contract.contract_number} (ID: {contract.id}) содержит {existing_employees_count} сотрудников ПЕРЕД загрузкой", file=sys.stderr)
             
             # Если есть существующие записи и не установлен флаг замены, предупреждаем пользователя
-            if existing_employees_count > 0 and not replace_existing:
+            # (при слиянии существующие записи сохраняются, предупреждение не требуется)
+            if existing_employees_count > 0 and not replace_existing and not merge_mode:
+                sheet.close()
                 return Response({
                     'warning': 'existing_data',
                     'message': f'В договоре уже есть {existing_employees_count} сотрудников. Загрузка нового файла заменит все существующие записи.',
@@ -1123,259 +1025,71 @@ class ContingentEmployeeViewSet(viewsets.ModelViewSet):
                     'action_required': 'confirm_replacement'
                 }, status=status.HTTP_409_CONFLICT)
             
-            # Если пользователь подтвердил замену, удаляем существующие записи
-            if existing_employees_count > 0 and replace_existing:
-                deleted_count = ContingentEmployee.objects.filter(contract=contract).count()
-                ContingentEmployee.objects.filter(contract=contract).delete()
-                print(f"DEBUG REPLACE: Удалено {deleted_count} существующих записей для замены", file=sys.stderr)
-            
-            created_employees = []
-            skipped = 0
-            skipped_reasons = {'duplicate': 0, 'no_name': 0}  # Убрали no_iin, так как ИИН теперь необязателен
-            
-            # Парсим данные начиная со строки после заголовков
-            for row_idx, row in enumerate(worksheet.iter_rows(min_row=header_row + 1), start=header_row + 1):
-                print(f"DEBUG ROW {row_idx}: Обрабатываем строку", file=sys.stderr)
-                
-                # Пропускаем пустые строки
-                if not any(cell.value for cell in row):
-                    print(f"DEBUG ROW {row_idx}: Пустая строка, пропускаем", file=sys.stderr)
-                    continue
-                
-                # Извлекаем данные
-                name = str(row[column_map.get('name', 2) - 1].value or '').strip()
-                print(f"DEBUG ROW {row_idx}: ФИО = '{name}'", file=sys.stderr)
-                
-                if not name or name == 'None':
-                    print(f"DEBUG ROW {row_idx}: Нет ФИО, пропускаем", file=sys.stderr)
-                    skipped_reasons['no_name'] += 1
-                    skipped += 1
-                    continue
-                
-                # Парсим дату рождения
-                birth_date = None
-                birth_cell = row[column_map.get('birth_date', 3) - 1].value if column_map.get('birth_date') else None
-                if birth_cell:
-                    if isinstance(birth_cell, datetime):
-                        birth_date = birth_cell.date()
-                    elif isinstance(birth_cell, str):
-                        try:
-                            birth_date = datetime.strptime(birth_cell, '%d.%m.%Y').date()
-                        except:
-                            pass
-                
-                # Пол
-                gender = None
-                gender_cell = row[column_map.get('gender', 4) - 1].value if column_map.get('gender') else None
-                if gender_cell:
-                    gender_str = str(gender_cell).lower()
-                    if 'муж' in gender_str or 'male' in gender_str:
-                        gender = 'male'
-                    elif 'жен' in gender_str or 'female' in gender_str:
-                        gender = 'female'
-                
-                # Стаж
-                total_exp = None
-                pos_exp = None
-                if column_map.get('total_experience'):
-                    exp_val = row[column_map['total_experience'] - 1].value
-                    if exp_val:
-                        try:
-                            total_exp = int(str(exp_val).replace('лет', '').replace('года', '').strip())
-                        except:
-                            pass
-                
-                if column_map.get('position_experience'):
-                    exp_val = row[column_map['position_experience'] - 1].value
-                    if exp_val:
-                        try:
-                            pos_exp = int(str(exp_val).replace('лет', '').replace('года', '').strip())
-                        except:
-                            pass
-                
-                # Дата последнего медосмотра
-                last_exam = None
-                exam_cell = row[column_map.get('last_examination', 9) - 1].value if column_map.get('last_examination') else None
-                if exam_cell:
-                    if isinstance(exam_cell, datetime):
-                        last_exam = exam_cell.date()
-                    elif isinstance(exam_cell, str):
-                        try:
-                            last_exam = datetime.strptime(exam_cell.replace('г', '').strip(), '%d.%m.%Y').date()
-                        except:
-                            pass
-                
-                # Вредные факторы
-                harmful_factors = []
-                factors_cell = row[column_map.get('harmful_factors', 10) - 1].value if column_map.get('harmful_factors') else None
-                if factors_cell:
-                    factors_str = str(factors_cell)
-                    # Парсим список вредных факторов (могут быть через запятую или точку с запятой)
-                    parsed_factors = [f.strip() for f in factors_str.replace(';', ',').split(',') if f.strip()]
-                    
-                    # Стандартный список вредных факторов (только 33 пункта)
-                    standard_factors = [
-                        "п.1 «Работы, связанные с воздействием химических факторов»",
-                        "п.2 «Работы с канцерогенными веществами»",
-                        "п.3 «Работы с пестицидами и агрохимикатами»",
-                        "п.4 «Работы, связанные с воздействием биологических факторов»",
-                        "п.5 «Работы, выполняемые в условиях повышенного шума»",
-                        "п.6 «Работы, выполняемые в условиях вибрации»",
-                        "п.7 «Работы, выполняемые в условиях ионизирующего излучения»",
-                        "п.8 «Работы, выполняемые в условиях неионизирующих излучений»",
-                        "п.9 «Работы, выполняемые при повышенной или пониженной температуре воздуха»",
-                        "п.10 «Работы в замкнутых пространствах»",
-                        "п.11 «Работы на высоте»",
-                        "п.12 «Работы, связанные с подъемом и перемещением тяжестей»",
-                        "п.13 «Работы в ночное время»",
-                        "п.14 «Работа на ПК»",
-                        "п.15 «Работы, связанные с эмоциональным и умственным перенапряжением»",
-                        "п.16 «Работы, связанные с повышенной ответственностью»",
-                        "п.17 «Работы вахтовым методом»",
-                        "п.18 «Подземные работы»",
-                        "п.19 «Работы на транспорте»",
-                        "п.20 «Работы, связанные с воздействием пыли»",
-                        "п.21 «Работы с горюче-смазочными материалами»",
-                        "п.22 «Работы, связанные с воздействием нефти и нефтепродуктов»",
-                        "п.23 «Работы в условиях повышенной загазованности»",
-                        "п.24 «Работы в условиях недостатка кислорода»",
-                        "п.25 «Работы в условиях повышенной влажности»",
-                        "п.26 «Работы, связанные с виброинструментом»",
-                        "п.27 «Работы на конвейерах»",
-                        "п.28 «Работы на строительных площадках»",
-                        "п.29 «Работы в металлургическом производстве»",
-                        "п.30 «Работы в горнодобывающей промышленности»",
-                        "п.31 «Работы в деревообрабатывающем производстве»",
-                        "п.32 «Работы в текстильной и швейной промышленности»",
-                        "п.33 «Профессии и работы»"
-                    ]
-                    
-                    # Фильтруем только стандартные факторы
-                    harmful_factors = [f for f in parsed_factors if f in standard_factors]
-                
-                # ИИН (необязательное поле)
-                iin_cell = row[column_map.get('iin', 5) - 1].value if column_map.get('iin') else None
-                if not iin_cell:
-                    # Пробуем найти ИИН в других колонках (может быть в другой позиции)
-                    for col_idx in range(len(row)):
-                        cell_val = str(row[col_idx].value or '').strip()
-                        if len(cell_val) >= 10 and cell_val.isdigit():
-                            iin_cell = cell_val
-                            break
-                
-                iin = ''
-                if iin_cell:
-                    iin = str(iin_cell).strip()
-                    # Очищаем ИИН от пробелов и других символов, оставляем только цифры
-                    iin = ''.join(filter(str.isdigit, iin))
-                    # Обрезаем до максимума 20 символов
-                    iin = iin[:20] if len(iin) >= 10 else ''
-                
-                # Если ИИН не указан, генерируем уникальный идентификатор на основе ФИО и даты рождения
-                if not iin:
-                    import hashlib
-                    unique_string = f"{name}_{birth_date or 'unknown'}_{row_idx}"
-                    iin = hashlib.md5(unique_string.encode()).hexdigest()[:12]  # Используем первые 12 символов MD5
-                
-                # КРИТИЧЕСКИ ВАЖНО: Проверяем, существует ли уже сотрудник в рамках этого договора
-                print(f"DEBUG ROW {row_idx}: Проверяем дубликаты для {name}, contract_id={contract.id if contract else 'None'}", file=sys.stderr)
-                
-                # Сначала получаем количество существующих записей в договоре
-                existing_count = ContingentEmployee.objects.filter(contract=contract).count()
-                print(f"DEBUG ROW {row_idx}: Существующих записей в договоре: {existing_count}", file=sys.stderr)
-                
-                existing = None
-                
-                # 1. Проверяем по ИИН в рамках этого договора (если ИИН валидный)
-                if iin and len(iin) >= 10 and iin.isdigit():
-                    existing = ContingentEmployee.objects.filter(contract=contract, iin=iin).first()
-                    if existing:
-                        print(f"DEBUG ROW {row_idx}: Найден дубликат по ИИН {iin} - {existing.name} (ID: {existing.id})", file=sys.stderr)
-                
-                # 2. Если не найден по ИИН, проверяем по ФИО + дате рождения в рамках этого договора
-                if not existing:
-                    existing = ContingentEmployee.objects.filter(
-                        contract=contract, 
-                        name__iexact=name,  # Используем iexact для регистронезависимого сравнения
-                        birth_date=birth_date
-                    ).first()
-                    if existing:
-                        print(f"DEBUG ROW {row_idx}: Найден дубликат по ФИО+дате рождения - {existing.name} (ID: {existing.id})", file=sys.stderr)
-                
-                # 3. Дополнительная проверка по ФИО (без даты рождения) для более строгого контроля
-                if not existing:
-                    name_duplicates = ContingentEmployee.objects.filter(
-                        contract=contract, 
-                        name__iexact=name
-                    )
-                    if name_duplicates.exists():
-                        print(f"DEBUG ROW {row_idx}: Найдены записи с таким же ФИО: {[emp.id for emp in name_duplicates]}", file=sys.stderr)
-                        # Если есть точное совпадение по ФИО, считаем дубликатом
-                        existing = name_duplicates.first()
-                
-                if existing:
-                    print(f"DEBUG ROW {row_idx}: ДУБЛИКАТ НАЙДЕН - {name} (существующий ID: {existing.id}), пропускаем", file=sys.stderr)
-                    skipped_reasons['duplicate'] += 1
-                    skipped += 1
-                    continue
-                
-                print(f"DEBUG ROW {row_idx}: Дубликат не найден, создаем сотрудника", file=sys.stderr)
-                
-                # Нормализуем телефон для GreenAPI (формат 7XXXXXXXXXX)
-                phone_raw = str(row[column_map.get('phone', 6) - 1].value or '').strip() if column_map.get('phone') else ''
-                phone_normalized = ''
-                if phone_raw:
-                    # Убираем все символы кроме цифр
-                    phone_digits = ''.join(filter(str.isdigit, phone_raw))
-                    # Если начинается с 8, заменяем на 7
-                    if phone_digits.startswith('8') and len(phone_digits) == 11:
-                        phone_normalized = '7' + phone_digits[1:]
-                    # Если начинается с 7 и длина 11 цифр
-                    elif phone_digits.startswith('7') and len(phone_digits) == 11:
-                        phone_normalized = phone_digits
-                    # Если 10 цифр без кода страны, добавляем 7
-                    elif len(phone_digits) == 10:
-                        phone_normalized = '7' + phone_digits
-                    # Иначе оставляем как есть (может быть международный номер)
-                    else:
-                        phone_normalized = phone_digits
-                
-                print(f"DEBUG CREATE: Создаем сотрудника {name} для пользователя {user.username} (ID: {user.id}) и договора {contract.contract_number if contract else 'None'} (ID: {contract.id if contract else 'None'})", file=sys.stderr)
-                
-                employee = ContingentEmployee.objects.create(
+            # Асинхронный режим: файл сохраняется в очередь задач, обработка выполняется фоновым обработчиком
+            if async_mode:
+                sheet.close()
+                excel_file.seek(0)
+                job = enqueue_job(
+                    'contingent_import',
                     user=user,
                     contract=contract,
-                    name=name,
-                    birth_date=birth_date,
-                    gender=gender,
-                    department=str(row[column_map.get('department', 5) - 1].value or '').strip(),
-                    position=str(row[column_map.get('position', 6) - 1].value or '').strip(),
-                    total_experience_years=total_exp,
-                    position_experience_years=pos_exp,
-                    last_examination_date=last_exam,
-                    harmful_factors=harmful_factors,
-                    notes=str(row[column_map.get('notes', 11) - 1].value or '').strip() if column_map.get('notes') else '',
-                    iin=iin,
-                    phone=phone_normalized,
-                    quarter=str(row[column_map.get('quarter', 1) - 1].value or '').strip() if column_map.get('quarter') else '',
-                    requires_examination=True,
+                    payload={
+                        'replace_existing': replace_existing,
+                        'mode': 'merge' if merge_mode else None,
+                        'delete_missing': delete_missing,
+                        'validation': validation,
+                        'loader': loader,
+                    },
+                    file_name=excel_file.name,
+                    file_data=excel_file.read(),
                 )
-                print(f"DEBUG CREATE: Сотрудник создан с ID: {employee.id}", file=sys.stderr)
-                created_employees.append(employee)
+                return Response({
+                    'job_id': job.id,
+                    'status': job.status,
+                    'message': 'Файл принят в обработку. Статус загрузки можно получить через import_status',
+                }, status=status.HTTP_202_ACCEPTED)
+            
+            importer = ContingentImporter(
+                user, contract, replace_existing=replace_existing, merge=merge_mode, delete_missing=delete_missing, loader=loader
+            )
+            result = importer.run(sheet)
+            created_employees = list(importer.created_employees)
             
             # ВАЖНО: Логируем состояние ПОСЛЕ загрузки
             final_employees_count = ContingentEmployee.objects.filter(contract=contract).count()
             print(f"DEBUG UPLOAD END: Договор {contract.contract_number} (ID: {contract.id}) содержит {final_employees_count} сотрудников ПОСЛЕ загрузки", file=sys.stderr)
-            print(f"DEBUG UPLOAD SUMMARY: Было {existing_employees_count}, создано {len(created_employees)}, пропущено {skipped}, итого должно быть {existing_employees_count + len(created_employees)}, фактически {final_employees_count}", file=sys.stderr)
-            
-            serializer = ContingentEmployeeSerializer(created_employees, many=True)
-            return Response({
-                'created': len(created_employees),
-                'skipped': skipped,
-                'skipped_reasons': skipped_reasons,
+            print(f"DEBUG UPLOAD SUMMARY: Было {existing_employees_count}, создано {len(created_employees)}, пропущено {result['skipped']}, фактически {final_employees_count}", file=sys.stderr)
+            
+            # Новые сотрудники еще не имеют маршрутных листов
+            serializer = ContingentEmployeeSerializer(created_employees, many=True, context={'route_sheets': {}})
+            response_data = {
+                'mode': result['mode'],
+                'loader': result['loader'],
+                'content_hash': content_hash,
+                'prevalidated': validation is not None,
+                'created': result['created'],
+                'skipped': result['skipped'],
+                'skipped_reasons': result['skipped_reasons'],
+                'rows_processed': result['rows_processed'],
+                'elapsed_seconds': result['elapsed_seconds'],
+                'rows_per_second': result['rows_per_second'],
                 'employees': serializer.data
-            }, status=status.HTTP_201_CREATED)
+            }
+            if validation:
+                # Сводка сохраненной проверки (validate_excel) этого файла
+                response_data['validation'] = {key: validation[key] for key in ('valid', 'rows_total', 'error_count')}
+            if merge_mode:
+                # Сводка изменений при слиянии
+                response_data.update({
+                    'updated': result['updated'],
+                    'unchanged': result['unchanged'],
+                    'deleted': result['deleted'],
+                    'updated_fields': result['updated_fields'],
+                })
+            return Response(response_data, status=status.HTTP_201_CREATED)
             
+        except ContingentFileError as e:
+            return Response(e.as_response_data(), status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             import traceback
             import sys
@@ -1388,44 +1102,60 @@ class ContingentEmployeeViewSet(viewsets.ModelViewSet):
                 'traceback': error_trace if settings.DEBUG else None
             }, status=status.HTTP_400_BAD_REQUEST)
     
+    @action(detail=False, methods=['post'])
+    def validate_excel(self, request):
+        """
+        Проверка Excel файла контингента без загрузки (dry-run).
+        Возвращает ошибки и предупреждения по строкам и хеш содержимого файла.
+        """
+        excel_file = request.FILES.get('file')
+        contract_id = request.data.get('contract_id')  # Необязательно: для поиска дубликатов среди уже загруженных
+
+        if not excel_file:
+            return Response({'error': 'Excel file is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        contract = None
+        if contract_id:
+            try:
+                contract = Contract.objects.get(id=contract_id)
+            except Contract.DoesNotExist:
+                return Response({'error': 'Договор не найден'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            report = validate_contingent_file(
+                excel_file,
+                contract=contract,
+                max_rows=getattr(settings, 'CONTINGENT_IMPORT_MAX_ROWS', 50000),
+            )
+        except Exception as e:
+            logger.error(f"Error in validate_excel: {e}", exc_info=True)
+            return Response({'error': f'Не удалось прочитать файл: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(report, status=status.HTTP_200_OK)
+    
+    @action(detail=False, methods=['get'])
+    def import_status(self, request):
+        """Статус фоновой загрузки контингента (upload_excel с async=true)"""
+        job_id = request.query_params.get('job_id')
+        user_id = request.query_params.get('user_id')
+        
+        if not job_id:
+            return Response({'error': 'job_id is required'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            job = BackgroundJob.objects.defer('file_data').get(id=job_id, job_type='contingent_import')
+        except (BackgroundJob.DoesNotExist, ValueError):
+            return Response({'error': 'Задача не найдена'}, status=status.HTTP_404_NOT_FOUND)
+        
+        if user_id and str(job.user_id) != str(user_id):
+            return Response({'error': 'Нет доступа к этой задаче'}, status=status.HTTP_403_FORBIDDEN)
+        
+        return Response(BackgroundJobSerializer(job).data, status=status.HTTP_200_OK)
+    
     @action(detail=False, methods=['get'])
     def harmful_factors(self, request):
         """Получение списка стандартных вредных факторов"""
-        harmful_factors = [
-            "п.1 «Работы, связанные с воздействием химических факторов»",
-            "п.2 «Работы с канцерогенными веществами»",
-            "п.3 «Работы с пестицидами и агрохимикатами»",
-            "п.4 «Работы, связанные с воздействием биологических факторов»",
-            "п.5 «Работы, выполняемые в условиях повышенного шума»",
-            "п.6 «Работы, выполняемые в условиях вибрации»",
-            "п.7 «Работы, выполняемые в условиях ионизирующего излучения»",
-            "п.8 «Работы, выполняемые в условиях неионизирующих излучений»",
-            "п.9 «Работы, выполняемые при повышенной или пониженной температуре воздуха»",
-            "п.10 «Работы в замкнутых пространствах»",
-            "п.11 «Работы на высоте»",
-            "п.12 «Работы, связанные с подъемом и перемещением тяжестей»",
-            "п.13 «Работы в ночное время»",
-            "п.14 «Работа на ПК»",
-            "п.15 «Работы, связанные с эмоциональным и умственным перенапряжением»",
-            "п.16 «Работы, связанные с повышенной ответственностью»",
-            "п.17 «Работы вахтовым методом»",
-            "п.18 «Подземные работы»",
-            "п.19 «Работы на транспорте»",
-            "п.20 «Работы, связанные с воздействием пыли»",
-            "п.21 «Работы с горюче-смазочными материалами»",
-            "п.22 «Работы, связанные с воздействием нефти и нефтепродуктов»",
-            "п.23 «Работы в условиях повышенной загазованности»",
-            "п.24 «Работы в условиях недостатка кислорода»",
-            "п.25 «Работы в условиях повышенной влажности»",
-            "п.26 «Работы, связанные с виброинструментом»",
-            "п.27 «Работы на конвейерах»",
-            "п.28 «Работы на строительных площадках»",
-            "п.29 «Работы в металлургическом производстве»",
-            "п.30 «Работы в горнодобывающей промышленности»",
-            "п.31 «Работы в деревообрабатывающем производстве»",
-            "п.32 «Работы в текстильной и швейной промышленности»",
-            "п.33 «Профессии и работы»"
-        ]
+        harmful_factors = list(HARMFUL_FACTOR_LABELS)
         
         return Response({
             'harmful_factors': harmful_factors
@@ -1787,41 +1517,7 @@ class ContingentEmployeeViewSet(viewsets.ModelViewSet):
         harmful_sheet = wb.create_sheet(title="Ref_Harm")
 
         # Комментарий (RU): наполняем справочник типовыми формулировками согласно приказу № ҚР ДСМ-131/2020
-        harmful_factors = [
-            "п.1 «Работы, связанные с воздействием химических факторов»",
-            "п.2 «Работы с канцерогенными веществами»",
-            "п.3 «Работы с пестицидами и агрохимикатами»",
-            "п.4 «Работы, связанные с воздействием биологических факторов»",
-            "п.5 «Работы, выполняемые в условиях повышенного шума»",
-            "п.6 «Работы, выполняемые в условиях вибрации»",
-            "п.7 «Работы, выполняемые в условиях ионизирующего излучения»",
-            "п.8 «Работы, выполняемые в условиях неионизирующих излучений»",
-            "п.9 «Работы, выполняемые при повышенной или пониженной температуре воздуха»",
-            "п.10 «Работы в замкнутых пространствах»",
-            "п.11 «Работы на высоте»",
-            "п.12 «Работы, связанные с подъемом и перемещением тяжестей»",
-            "п.13 «Работы в ночное время»",
-            "п.14 «Работа на ПК»",
-            "п.15 «Работы, связанные с эмоциональным и умственным перенапряжением»",
-            "п.16 «Работы, связанные с повышенной ответственностью»",
-            "п.17 «Работы вахтовым методом»",
-            "п.18 «Подземные работы»",
-            "п.19 «Работы на транспорте»",
-            "п.20 «Работы, связанные с воздействием пыли»",
-            "п.21 «Работы с горюче-смазочными материалами»",
-            "п.22 «Работы, связанные с воздействием нефти и нефтепродуктов»",
-            "п.23 «Работы в условиях повышенной загазованности»",
-            "п.24 «Работы в условиях недостатка кислорода»",
-            "п.25 «Работы в условиях повышенной влажности»",
-            "п.26 «Работы, связанные с виброинструментом»",
-            "п.27 «Работы на конвейерах»",
-            "п.28 «Работы на строительных площадках»",
-            "п.29 «Работы в металлургическом производстве»",
-            "п.30 «Работы в горнодобывающей промышленности»",
-            "п.31 «Работы в деревообрабатывающем производстве»",
-            "п.32 «Работы в текстильной и швейной промышленности»",
-            "п.33 «Профессии и работы»"
-        ]
+        harmful_factors = HARMFUL_FACTOR_LABELS
 
         for idx, factor in enumerate(harmful_factors, start=1):
             harmful_sheet.cell(row=idx, column=1, value=factor)
@@ -2386,45 +2082,30 @@ class CalendarPlanViewSet(viewsets.ModelViewSet):
         contract_id = self.request.query_params.get('contract_id')
         
         if user_id:
-            try:
-                user = User.objects.get(id=user_id)
-                
-                # Если указан contract_id, фильтруем только по этому договору
-                if contract_id:
-                    import sys
-                    print(f"DEBUG: Запрос календарных планов по договору {contract_id} для пользователя {user.username}", file=sys.stderr)
-                    
-                    try:
-                        contract = Contract.objects.get(id=contract_id)
-                        # Проверяем права доступа к договору
-                        if user.role == 'clinic' and contract.clinic == user:
-                            queryset = CalendarPlan.objects.filter(contract=contract).order_by('-created_at')
-                        elif user.role == 'employer' and (contract.employer == user or contract.employer_bin == user.registration_data.get('bin')):
-                            queryset = CalendarPlan.objects.filter(contract=contract).order_by('-created_at')
-                        else:
-                            queryset = CalendarPlan.objects.none()
-                        
-                        print(f"DEBUG: Найдено {queryset.count()} планов по договору {contract_id}", file=sys.stderr)
-                        return queryset
-                    except Contract.DoesNotExist:
-                        print(f"DEBUG: Договор {contract_id} не найден", file=sys.stderr)
-                        return CalendarPlan.objects.none()
+            context = get_access_context(user_id)
+            if context is None:
+                return CalendarPlan.objects.none()
+            
+            # Если указан contract_id, фильтруем только по этому договору
+            if contract_id:
+                print(f"DEBUG: Запрос календарных планов по договору {contract_id} для пользователя {context.user_id}", file=sys.stderr)
                 
-                # Если пользователь - клиника, показываем планы, созданные этой клиникой
-                if user.role == 'clinic':
-                    return CalendarPlan.objects.filter(user=user).order_by('-created_at')
-                # Если пользователь - работодатель, показываем планы по договорам, где он является стороной
-                elif user.role == 'employer':
-                    user_bin = user.registration_data.get('bin') or user.registration_data.get('inn') if user.registration_data else None
-                    contracts = Contract.objects.filter(
-                        Q(employer=user) | (Q(employer_bin=user_bin) if user_bin else Q()),
-                        status='approved'
-                    )
-                    return CalendarPlan.objects.filter(contract__in=contracts).order_by('-created_at')
-                else:
-                    return CalendarPlan.objects.filter(user=user).order_by('-created_at')
-            except User.DoesNotExist:
+                # Проверяем права доступа к договору
+                if context.can_access_contract(contract_id):
+                    return CalendarPlan.objects.filter(contract_id=contract_id).order_by('-created_at')
+                print(f"DEBUG: Договор {contract_id} не найден или недоступен", file=sys.stderr)
                 return CalendarPlan.objects.none()
+            
+            # Если пользователь - клиника, показываем планы, созданные этой клиникой
+            if context.is_clinic:
+                return CalendarPlan.objects.filter(user_id=context.user_id).order_by('-created_at')
+            # Если пользователь - работодатель, показываем планы по договорам, где он является стороной
+            elif context.is_employer:
+                return CalendarPlan.objects.filter(
+                    contract_id__in=context.contract_ids(('approved',))
+                ).order_by('-created_at')
+            else:
+                return CalendarPlan.objects.filter(user_id=context.user_id).order_by('-created_at')
         return CalendarPlan.objects.all().order_by('-created_at')
     
     def update(self, request, *args, **kwargs):
@@ -2449,25 +2130,7 @@ class CalendarPlanViewSet(viewsets.ModelViewSet):
         
         # Выполняем стандартное обновление
         response = super().update(request, *args, **kwargs)
-        
-        # Получаем обновленный объект из базы данных
-        updated_instance = self.get_object()
-        actual_new_status = updated_instance.status
-        
-        # Если статус изменился на 'approved', создаем маршрутные листы
-        if old_status != 'approved' and actual_new_status == 'approved':
-            try:
-                import logging
-                logger = logging.getLogger(__name__)
-                logger.info(f"Creating route sheets for calendar plan {updated_instance.id} (status changed from {old_status} to {actual_new_status})")
-                self._create_route_sheets_for_plan(updated_instance)
-            except Exception as e:
-                import logging
-                logger = logging.getLogger(__name__)
-                logger.error(f"Error creating route sheets for calendar plan {updated_instance.id}: {str(e)}", exc_info=True)
-                # Не прерываем обновление плана, даже если создание маршрутных листов не удалось
-        
-        return response
+        return self._after_plan_update(response, old_status)
     
     def partial_update(self, request, *args, **kwargs):
         """Частичное обновление календарного плана с автоматическим созданием маршрутных листов при согласовании"""
@@ -2491,22 +2154,33 @@ class CalendarPlanViewSet(viewsets.ModelViewSet):
         
         # Выполняем стандартное частичное обновление
         response = super().partial_update(request, *args, **kwargs)
-        
-        # Получаем обновленный объект из базы данных
-        updated_instance = self.get_object()
+        return self._after_plan_update(response, old_status)
+    
+    def _after_plan_update(self, response, old_status):
+        """
+        Если статус изменился на 'approved', ставим в очередь создание маршрутных листов.
+        Ответ возвращается сразу, в нем - ссылка на фоновую задачу.
+        """
+        # Сохраненный объект берется из perform_update (без повторного чтения из БД)
+        updated_instance = getattr(self, '_updated_plan', None) or self.get_object()
         actual_new_status = updated_instance.status
         
-        # Если статус изменился на 'approved', создаем маршрутные листы
-        if old_status != 'approved' and actual_new_status == 'approved':
+        # partial_update вызывает update - задача ставится в очередь один раз
+        if old_status != 'approved' and actual_new_status == 'approved' and not getattr(self, '_route_sheets_job', None):
             try:
-                import logging
-                logger = logging.getLogger(__name__)
-                logger.info(f"Creating route sheets for calendar plan {updated_instance.id} (status changed from {old_status} to {actual_new_status})")
-                self._create_route_sheets_for_plan(updated_instance)
+                logger.info(f"Queueing route sheets for calendar plan {updated_instance.id} (status changed from {old_status} to {actual_new_status})")
+                job = self._route_sheets_job = self._create_route_sheets_for_plan(updated_instance)
+                response.data['route_sheets_job_id'] = job.id
+                response.data['route_sheets_status'] = updated_instance.route_sheets_status
+                response.data['route_sheets_progress'] = updated_instance.route_sheets_progress
             except Exception as e:
-                import logging
-                logger = logging.getLogger(__name__)
-                logger.error(f"Error creating route sheets for calendar plan {updated_instance.id}: {str(e)}", exc_info=True)
+                logger.error(f"Error queueing route sheets for calendar plan {updated_instance.id}: {str(e)}", exc_info=True)
+                # Не прерываем обновление плана, но фиксируем ошибку: статус 'failed' виден в route_sheets_status,
+                # создание маршрутных листов можно повторить (retry_route_sheets)
+                CalendarPlan.objects.filter(pk=updated_instance.pk).update(route_sheets_status='failed')
+                updated_instance.route_sheets_status = 'failed'
+                response.data['route_sheets_status'] = 'failed'
+                response.data['route_sheets_error'] = str(e)
         
         return response
     
@@ -2532,175 +2206,49 @@ class CalendarPlanViewSet(viewsets.ModelViewSet):
                 raise ValidationError({'user': 'User not found'})
         else:
             serializer.save()
+        self._updated_plan = serializer.instance
     
-    def _create_route_sheets_for_plan(self, plan):
-        """Автоматическое создание маршрутных листов для всех сотрудников календарного плана после согласования"""
-        from datetime import datetime, timedelta
-        import logging
-        import json
-        
-        logger = logging.getLogger(__name__)
-        logger.info(f"Starting route sheets creation for calendar plan {plan.id}")
-        
-        clinic_user = plan.user
-        if not clinic_user or clinic_user.role != 'clinic':
-            logger.warning(f"Plan {plan.id} user is not a clinic user: {clinic_user}")
-            return
-        
-        logger.info(f"Clinic user: {clinic_user.id}, role: {clinic_user.role}")
-        
-        # Получаем список врачей из календарного плана
-        selected_doctor_ids = plan.selected_doctors or []
-        doctors_map = {}
-        if selected_doctor_ids:
-            doctors = Doctor.objects.filter(id__in=selected_doctor_ids, user=clinic_user)
-            for doctor in doctors:
-                doctors_map[doctor.specialization] = {
-                    'id': str(doctor.id),
-                    'name': doctor.name,
-                    'cabinet': doctor.cabinet or '',
-                    'specialization': doctor.specialization,
-                }
-        
-        # Обрабатываем информацию по участкам
-        departments_info = plan.departments_info or []
-        if not departments_info:
-            # Если нет информации по участкам, используем общие даты
-            departments_info = [{
-                'department': plan.department,
-                'startDate': plan.start_date.isoformat() if hasattr(plan.start_date, 'isoformat') else str(plan.start_date),
-                'endDate': plan.end_date.isoformat() if hasattr(plan.end_date, 'isoformat') else str(plan.end_date),
-                'employeeIds': plan.employee_ids or [],
-            }]
-        
-        logger.info(f"Processing {len(departments_info)} departments for plan {plan.id}")
-        
-        harmful_factors = plan.harmful_factors or []
-        created_count = 0
-        
-        # Проверяем, что есть сотрудники для обработки
-        total_employee_ids = set()
-        for dept_info in departments_info:
-            employee_ids = dept_info.get('employeeIds') or dept_info.get('employee_ids', [])
-            total_employee_ids.update([str(eid) for eid in employee_ids])
-        
-        logger.info(f"Total unique employee IDs in plan: {len(total_employee_ids)}, IDs: {list(total_employee_ids)}")
-        
-        # Создаем маршрутные листы для каждого участка
-        for dept_info in departments_info:
-            department = dept_info.get('department', plan.department)
-            start_date_str = dept_info.get('startDate') or dept_info.get('start_date', '')
-            end_date_str = dept_info.get('endDate') or dept_info.get('end_date', '')
-            employee_ids = dept_info.get('employeeIds') or dept_info.get('employee_ids', [])
-            
-            logger.info(f"Processing department {department}, employee_ids from plan: {employee_ids}, types: {[type(eid).__name__ for eid in employee_ids]}")
-            
-            # Парсим даты
-            try:
-                if isinstance(start_date_str, str):
-                    start_date = datetime.strptime(start_date_str.split('T')[0], '%Y-%m-%d').date()
-                else:
-                    start_date = start_date_str
-                
-                if isinstance(end_date_str, str):
-                    end_date = datetime.strptime(end_date_str.split('T')[0], '%Y-%m-%d').date()
-                else:
-                    end_date = end_date_str
-            except:
-                continue
-            
-            # Получаем сотрудников этого участка
-            # Преобразуем employee_ids в строки и числа для поиска
-            employee_ids_str = [str(eid) for eid in employee_ids]
-            employee_ids_int = []
-            for eid in employee_ids:
-                try:
-                    employee_ids_int.append(int(eid))
-                except (ValueError, TypeError):
-                    pass
-            
-            logger.info(f"Searching for employees with IDs: str={employee_ids_str}, int={employee_ids_int}")
-            
-            # Ищем сотрудников по ID независимо от роли пользователя
-            # Сотрудники могут быть загружены как работодателем, так и клиникой по договору
-            employees = ContingentEmployee.objects.filter(
-                Q(id__in=employee_ids_str) | Q(id__in=employee_ids_int)
-            )
-            
-            logger.info(f"Found {employees.count()} employees for department {department} (searching for {len(employee_ids)} IDs)")
-            
-            if employees.count() > 0:
-                logger.info(f"Employee details: IDs={[str(e.id) for e in employees]}, Users={[e.user.id if e.user else 'no user' for e in employees]}, Roles={[e.user.role if e.user else 'no user' for e in employees]}")
-            else:
-                # Если не найдены, проверяем, существуют ли такие ID вообще
-                all_employees_check = ContingentEmployee.objects.all()
-                logger.warning(f"No employees found. Total employees in DB: {all_employees_check.count()}, Sample IDs: {[str(e.id) for e in all_employees_check[:5]]}")
-            
-            # Создаем маршрутный лист для каждого сотрудника на дату начала периода
-            for employee in employees:
-                # Проверяем, не существует ли уже маршрутный лист
-                existing = RouteSheet.objects.filter(
-                    user=clinic_user,
-                    patient_id=str(employee.id),
-                    visit_date=start_date
-                ).first()
-                
-                if existing:
-                    continue
-                
-                # Получаем вредные факторы сотрудника
-                harmful_factors_emp = []
-                if employee.harmful_factors:
-                    if isinstance(employee.harmful_factors, str):
-                        try:
-                            harmful_factors_emp = json.loads(employee.harmful_factors)
-                        except:
-                            harmful_factors_emp = [f.strip() for f in employee.harmful_factors.split(',') if f.strip()]
-                    elif isinstance(employee.harmful_factors, list):
-                        harmful_factors_emp = employee.harmful_factors
-                
-                # Используем вредные факторы из календарного плана, если они указаны
-                if harmful_factors:
-                    harmful_factors_emp = list(set(harmful_factors_emp + harmful_factors))
-                
-                # Генерируем услуги для маршрутного листа
-                route_sheet_viewset = RouteSheetViewSet()
-                route_sheet_viewset.request = type('obj', (object,), {'data': {}, 'query_params': {}, 'user': clinic_user})()
-                services = route_sheet_viewset._generate_services_for_position(
-                    employee.position,
-                    harmful_factors_emp,
-                    user_id=clinic_user.id
-                )
-                
-                # Назначаем врачей из календарного плана
-                if doctors_map:
-                    for service in services:
-                        specialization = service.get('specialization', service.get('name', ''))
-                        if specialization in doctors_map:
-                            doctor_info = doctors_map[specialization]
-                            service['doctorId'] = doctor_info['id']
-                            service['cabinet'] = doctor_info['cabinet'] or service.get('cabinet', 'Не указан')
-                
-                # Создаем маршрутный лист
-                route_sheet = RouteSheet.objects.create(
-                    user=clinic_user,
-                    patient_id=str(employee.id),
-                    patient_name=employee.name,
-                    iin=employee.iin or '',
-                    position=employee.position,
-                    department=employee.department,
-                    visit_date=start_date,
-                    services=services,
-                )
-                
-                # Создаем лабораторные и функциональные исследования
-                route_sheet_viewset._create_required_tests(route_sheet, employee.position, harmful_factors_emp)
-                
-                created_count += 1
-                logger.info(f"Created route sheet ID {route_sheet.id} for employee {employee.id} ({employee.name}) on {start_date}, patient_id={route_sheet.patient_id}")
-        
-        total_employees_in_plan = sum(len(dept_info.get('employeeIds') or dept_info.get('employee_ids', [])) for dept_info in departments_info)
-        logger.info(f"Successfully created {created_count} route sheets for calendar plan {plan.id} (total employees in plan: {total_employees_in_plan})")
+    def _create_route_sheets_for_plan(self, plan, departments=None):
+        """Создание маршрутных листов для сотрудников календарного плана после согласования (фоновая задача)"""
+        return enqueue_plan_route_sheets(plan, departments=departments)
+    
+    @action(detail=True, methods=['get'])
+    def route_sheets_status(self, request, pk=None):
+        """Статус и прогресс создания маршрутных листов по плану"""
+        plan = self.get_object()
+        return Response({
+            'plan_id': plan.id,
+            'route_sheets_status': plan.route_sheets_status,
+            'route_sheets_progress': plan.route_sheets_progress,
+            'job': BackgroundJobSerializer(plan.route_sheets_job).data if plan.route_sheets_job else None,
+        }, status=status.HTTP_200_OK)
+    
+    @action(detail=True, methods=['post'])
+    def retry_route_sheets(self, request, pk=None):
+        """
+        Повторное создание маршрутных листов: по умолчанию только для участков с ошибкой,
+        можно передать departments - список участков. Уже созданные листы не дублируются.
+        """
+        plan = self.get_object()
+        if plan.status != 'approved':
+            return Response({'error': 'Маршрутные листы создаются только для утвержденного плана'}, status=status.HTTP_400_BAD_REQUEST)
+        if plan.route_sheets_status in ('pending', 'running'):
+            return Response({'error': 'Создание маршрутных листов уже выполняется'}, status=status.HTTP_409_CONFLICT)
+        
+        departments = request.data.get('departments')
+        if departments is None:
+            departments = [name for name, info in (plan.route_sheets_progress or {}).items() if info.get('status') == 'failed']
+            # Если ошибок нет (или прогресс не сохранялся), повторяем для всех участков
+            departments = departments or None
+        elif not isinstance(departments, list):
+            return Response({'error': 'departments должен быть списком участков'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        job = self._create_route_sheets_for_plan(plan, departments=departments)
+        return Response({
+            'route_sheets_job_id': job.id,
+            'route_sheets_status': plan.route_sheets_status,
+            'route_sheets_progress': plan.route_sheets_progress,
+        }, status=status.HTTP_202_ACCEPTED)
     
     def perform_destroy(self, instance):
         """Удаление календарного плана - только клиника может удалять свои планы"""
@@ -2802,66 +2350,67 @@ class RouteSheetViewSet(viewsets.ModelViewSet):
         user_id = self.request.query_params.get('user_id')
         if user_id:
             try:
-                user = User.objects.get(id=user_id)
+                context = get_access_context(user_id)
+                if context is None:
+                    return RouteSheet.objects.none()
                 
                 # Если пользователь - клиника, возвращаем маршрутные листы, созданные этой клиникой
-                if user.role == 'clinic':
-                    return RouteSheet.objects.filter(user=user).order_by('-created_at')
+                if context.is_clinic:
+                    return RouteSheet.objects.filter(user_id=context.user_id).prefetch_related('service_items').order_by('-created_at')
                 # Если пользователь - работодатель, возвращаем маршрутные листы для его сотрудников
-                elif user.role == 'employer':
+                elif context.is_employer:
                     try:
-                        # Находим договоры с этим работодателем (используем те же статусы, что и для контингента)
-                        user_bin = user.registration_data.get('bin') or user.registration_data.get('inn') if user.registration_data else None
-                        allowed_statuses = ['approved', 'active', 'in_progress', 'sent', 'pending_approval']
-                        contracts = Contract.objects.filter(
-                            Q(employer=user) | (Q(employer_bin=user_bin) if user_bin else Q()),
-                            status__in=allowed_statuses
-                        )
+                        # Договоры с этим работодателем (те же статусы, что и для контингента)
+                        contract_ids = context.contract_ids(CONTRACT_ACCESS_STATUSES)
                         
-                        # Находим всех сотрудников работодателя (используем ту же логику, что и для контингента)
-                        all_employees = ContingentEmployee.objects.filter(
-                            Q(user=user) | Q(contract__in=contracts)
-                        ).distinct()
-                        
-                        # Получаем ID сотрудников
-                        employee_ids = [str(emp.id) for emp in all_employees]
+                        # ID всех сотрудников работодателя (та же логика, что и для контингента)
+                        employee_ids = [
+                            str(employee_id) for employee_id in ContingentEmployee.objects.filter(
+                                Q(user_id=context.user_id) | Q(contract_id__in=contract_ids)
+                            ).values_list('id', flat=True).distinct()
+                        ]
                         
                         # Возвращаем маршрутные листы для этих сотрудников
                         if employee_ids:
-                            return RouteSheet.objects.filter(patient_id__in=employee_ids).order_by('-created_at')
+                            return RouteSheet.objects.filter(patient_id__in=employee_ids).prefetch_related('service_items').order_by('-created_at')
                         else:
                             return RouteSheet.objects.none()
                     except Exception as e:
-                        logger.error(f"Error getting route sheets for employer {user.id}: {str(e)}")
+                        logger.error(f"Error getting route sheets for employer {context.user_id}: {str(e)}")
                         return RouteSheet.objects.none()
                 else:
-                    return RouteSheet.objects.filter(user=user).order_by('-created_at')
-            except User.DoesNotExist:
-                return RouteSheet.objects.none()
+                    return RouteSheet.objects.filter(user_id=context.user_id).prefetch_related('service_items').order_by('-created_at')
             except Exception as e:
                 logger.error(f"Error in RouteSheetViewSet.get_queryset: {str(e)}")
                 return RouteSheet.objects.none()
-        return RouteSheet.objects.all().order_by('-created_at')
+        return RouteSheet.objects.all().prefetch_related('service_items').order_by('-created_at')
 
     @action(detail=True, methods=['patch'])
     def update_service_status(self, request, pk=None):
-        """Обновление статуса услуги в маршрутном листе. Только врач соответствующей специализации может отмечать услугу."""
+        """
+        Обновление статуса услуги в маршрутном листе. Только врач соответствующей специализации может отмечать услугу.
+        Изменяется только строка услуги (атомарный UPDATE). Для обнаружения конфликтов клиент передает версию услуги
+        (version в теле или заголовок If-Match со значением ETag из предыдущего ответа); если услугу уже изменил
+        другой пользователь, возвращается 409 с актуальным состоянием услуги.
+        """
         service_id = request.data.get('service_id')
         new_status = request.data.get('status')  # Переименовано, чтобы не конфликтовать с импортом
         
         if not service_id or new_status not in ['pending', 'completed']:
             return Response({'error': 'Invalid service_id or status'}, status=status.HTTP_400_BAD_REQUEST)
         
+        expected_version = request.data.get('version') or request.headers.get('If-Match', '').replace('W/', '').strip('"').rsplit('-', 1)[-1] or None
+        if expected_version is not None:
+            try:
+                expected_version = int(expected_version)
+            except (TypeError, ValueError):
+                return Response({'error': 'Некорректная версия услуги'}, status=status.HTTP_400_BAD_REQUEST)
+        
         try:
             route_sheet = self.get_object()
-            services = route_sheet.services if isinstance(route_sheet.services, list) else []
             
-            # Находим услугу
-            target_service = None
-            for service in services:
-                if str(service.get('id')) == str(service_id):
-                    target_service = service
-                    break
+            # Находим услугу (услуги маршрутного листа уже загружены через prefetch_related)
+            target_service = next((item for item in route_sheet.service_items.all() if item.service_id == str(service_id)), None)
             
             if not target_service:
                 return Response({'error': 'Service not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -2897,7 +2446,7 @@ class RouteSheetViewSet(viewsets.ModelViewSet):
                         }, status=status.HTTP_404_NOT_FOUND)
                     
                     doctor_specialization = doctor.specialization
-                    service_specialization = target_service.get('specialization') or target_service.get('name')
+                    service_specialization = target_service.specialization or target_service.name
                     
                     # Проверяем соответствие специализации
                     if doctor_specialization != service_specialization:
@@ -2909,13 +2458,20 @@ class RouteSheetViewSet(viewsets.ModelViewSet):
                         'error': f'Ошибка при проверке прав доступа: {str(e)}'
                     }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
             
-            # Обновляем статус услуги
-            target_service['status'] = new_status
-            route_sheet.services = services
-            route_sheet.save()
+            # Обновляем статус услуги одним UPDATE по строке услуги (с проверкой версии, если она передана)
+            service_rows = RouteSheetService.objects.filter(pk=target_service.pk)
+            if expected_version is not None:
+                service_rows = service_rows.filter(version=expected_version)
+            updated = service_rows.update(status=new_status, version=F('version') + 1)
+            target_service.refresh_from_db(fields=['status', 'version'])
+            if not updated:
+                return Response({
+                    'error': 'Услуга уже изменена другим пользователем. Обновите маршрутный лист.',
+                    'service': target_service.to_dict(),
+                }, status=status.HTTP_409_CONFLICT, headers={'ETag': target_service.etag})
             
             serializer = RouteSheetSerializer(route_sheet)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            return Response(serializer.data, status=status.HTTP_200_OK, headers={'ETag': target_service.etag})
         except Exception as e:
             import traceback
             return Response({
@@ -2923,6 +2479,183 @@ class RouteSheetViewSet(viewsets.ModelViewSet):
                 'traceback': traceback.format_exc() if settings.DEBUG else None
             }, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['post'])
+    def bulk_update_service_status(self, request):
+        """
+        Пакетное обновление статусов услуг: items = [{route_sheet_id, service_id, status, version?}, ...].
+        Права врача проверяются один раз, изменения применяются в одной транзакции - по одному UPDATE
+        на каждый новый статус. Для каждой позиции возвращается результат:
+        updated / conflict (версия не совпала) / forbidden (чужая специализация) / not_found / invalid.
+        """
+        items = request.data.get('items')
+        user_id = request.query_params.get('user_id') or request.data.get('user_id')
+        if not isinstance(items, list) or not items:
+            return Response({'error': 'items должен быть непустым списком'}, status=status.HTTP_400_BAD_REQUEST)
+        max_items = getattr(settings, 'ROUTE_SHEET_BULK_STATUS_MAX_ITEMS', 500)
+        if len(items) > max_items:
+            return Response({'error': f'Не более {max_items} услуг за один запрос'}, status=status.HTTP_400_BAD_REQUEST)
+        if not user_id:
+            return Response({'error': 'user_id is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            current_user = User.objects.get(id=user_id)
+        except User.DoesNotExist:
+            return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        # Те же права, что и в update_service_status, но проверяются один раз на весь пакет
+        if current_user.role == 'clinic' and current_user.clinic_role in ['manager', 'receptionist', None]:
+            return Response({
+                'error': 'Только врач может отмечать услуги как выполненные. Клиника может только просматривать статус.'
+            }, status=status.HTTP_403_FORBIDDEN)
+        doctor_specialization = None
+        if current_user.role == 'clinic' and current_user.clinic_role == 'doctor':
+            doctor = Doctor.objects.filter(user=current_user).first()
+            if not doctor:
+                return Response({
+                    'error': 'Врач не найден в базе данных. Убедитесь, что ваш профиль врача создан.'
+                }, status=status.HTTP_404_NOT_FOUND)
+            doctor_specialization = doctor.specialization
+
+        results = []
+        requested = []  # (результат, ключ строки, новый статус, ожидаемая версия)
+        for item in items:
+            item = item if isinstance(item, dict) else {}
+            result = {
+                'route_sheet_id': item.get('route_sheet_id'),
+                'service_id': str(item.get('service_id', '')),
+                'status': item.get('status'),
+            }
+            results.append(result)
+            version = item.get('version')
+            try:
+                route_sheet_id = int(item.get('route_sheet_id'))
+                version = int(version) if version is not None else None
+            except (TypeError, ValueError):
+                result['result'] = 'invalid'
+                continue
+            if not result['service_id'] or result['status'] not in ['pending', 'completed']:
+                result['result'] = 'invalid'
+                continue
+            requested.append((result, (route_sheet_id, result['service_id']), result['status'], version))
+
+        route_sheet_ids = {key[0] for _, key, _, _ in requested}
+        with transaction.atomic():
+            # Строки услуг блокируются на время транзакции: версии сравниваются без гонок
+            rows = {
+                (row.route_sheet_id, row.service_id): row
+                for row in RouteSheetService.objects.select_for_update().filter(
+                    route_sheet_id__in=self.get_queryset().filter(id__in=route_sheet_ids).values('id'),
+                ).only('id', 'route_sheet_id', 'service_id', 'name', 'specialization', 'status', 'version')
+            }
+            to_update = {}  # новый статус -> ID строк
+            seen = set()
+            for result, key, new_status, version in requested:
+                row = rows.get(key)
+                if row is None:
+                    result['result'] = 'not_found'
+                elif doctor_specialization is not None and (row.specialization or row.name) != doctor_specialization:
+                    result['result'] = 'forbidden'
+                elif version is not None and version != row.version:
+                    result['result'] = 'conflict'
+                    result['version'] = row.version
+                    result['current_status'] = row.status
+                elif row.pk in seen:
+                    result['result'] = 'invalid'  # услуга повторяется в пакете
+                else:
+                    seen.add(row.pk)
+                    to_update.setdefault(new_status, []).append(row.pk)
+                    result['result'] = 'updated'
+                    result['version'] = row.version + 1
+            for new_status, pks in to_update.items():
+                RouteSheetService.objects.filter(pk__in=pks).update(status=new_status, version=F('version') + 1)
+
+        summary = {}
+        for result in results:
+            summary[result['result']] = summary.get(result['result'], 0) + 1
+        return Response({'results': results, 'summary': summary}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'])
+    def worklist(self, request):
+        """
+        Очередь врача: услуги маршрутных листов на дату по врачу (doctor_id) или специализации
+        (specialization + user_id клиники). Для врача клиники (clinic_role='doctor') без параметров
+        используется его профиль врача. Пагинация по ключу (время, id): cursor из next_cursor предыдущей страницы.
+        """
+        doctor_id = request.query_params.get('doctor_id')
+        specialization = request.query_params.get('specialization')
+        user_id = request.query_params.get('user_id')
+        service_status = request.query_params.get('status', 'pending')
+        cursor = request.query_params.get('cursor')
+        try:
+            page_size = min(max(int(request.query_params.get('page_size', 50)), 1), 200)
+            visit_date = datetime.strptime(request.query_params['date'], '%Y-%m-%d').date() if request.query_params.get('date') else timezone.localdate()
+        except ValueError:
+            return Response({'error': 'Некорректные page_size или date (ожидается YYYY-MM-DD)'}, status=status.HTTP_400_BAD_REQUEST)
+        if service_status not in dict(RouteSheetService.STATUS_CHOICES):
+            return Response({'error': 'Некорректный status'}, status=status.HTTP_400_BAD_REQUEST)
+
+        user = None
+        if user_id:
+            try:
+                user = User.objects.get(id=user_id)
+            except User.DoesNotExist:
+                return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+        if not doctor_id and not specialization and user is not None and user.role == 'clinic' and user.clinic_role == 'doctor':
+            doctor = Doctor.objects.filter(user=user).first()
+            if doctor:
+                doctor_id = doctor.id
+
+        # Выборка по индексам (doctor, status, visit_date) / (specialization, status, visit_date)
+        services = RouteSheetService.objects.filter(visit_date=visit_date, status=service_status)
+        if doctor_id:
+            services = services.filter(doctor_id=doctor_id)
+        elif specialization and user is not None:
+            services = services.filter(specialization=specialization, route_sheet__user=user)
+        else:
+            return Response({'error': 'Укажите doctor_id или specialization и user_id'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if cursor:
+            try:
+                cursor_time, cursor_id = cursor.rsplit('|', 1)
+                cursor_id = int(cursor_id)
+            except ValueError:
+                return Response({'error': 'Некорректный cursor'}, status=status.HTTP_400_BAD_REQUEST)
+            services = services.filter(Q(time__gt=cursor_time) | Q(time=cursor_time, id__gt=cursor_id))
+
+        rows = list(
+            services.order_by('time', 'id').values(
+                'id', 'service_id', 'name', 'specialization', 'cabinet', 'doctor_id', 'time', 'status', 'visit_date',
+                'route_sheet_id', 'route_sheet__patient_id', 'route_sheet__patient_name', 'route_sheet__iin',
+                'route_sheet__position', 'route_sheet__department',
+            )[:page_size + 1]
+        )
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+
+        results = [{
+            'route_sheet_id': row['route_sheet_id'],
+            'service_id': row['service_id'],
+            'name': row['name'],
+            'specialization': row['specialization'] or row['name'],
+            'cabinet': row['cabinet'],
+            'doctorId': str(row['doctor_id']) if row['doctor_id'] else '',
+            'time': row['time'],
+            'status': row['status'],
+            'visit_date': row['visit_date'].isoformat(),
+            'patient_id': row['route_sheet__patient_id'],
+            'patient_name': row['route_sheet__patient_name'],
+            'iin': row['route_sheet__iin'],
+            'position': row['route_sheet__position'],
+            'department': row['route_sheet__department'],
+        } for row in rows]
+
+        return Response({
+            'results': results,
+            'page_size': page_size,
+            'has_next': has_next,
+            'next_cursor': f"{rows[-1]['time']}|{rows[-1]['id']}" if has_next else None,
+        })
+
     @action(detail=False, methods=['post'])
     def create_by_iin(self, request):
         phone = request.data.get('phone')  # Поиск по номеру телефона
@@ -2982,17 +2715,6 @@ class RouteSheetViewSet(viewsets.ModelViewSet):
                     'error': 'Для этого сотрудника нет утвержденного календарного плана на указанную дату'
                 }, status=status.HTTP_400_BAD_REQUEST)
             
-            # Check if route sheet already exists
-            existing = RouteSheet.objects.filter(
-                user=user,
-                patient_id=str(employee.id),
-                visit_date=visit_date_obj
-            ).first()
-            
-            if existing:
-                serializer = RouteSheetSerializer(existing)
-                return Response(serializer.data, status=status.HTTP_200_OK)
-            
             # Generate services based on position and harmful factors
             # Обрабатываем harmful_factors - может быть списком или строкой JSON
             harmful_factors_list = []
@@ -3007,8 +2729,13 @@ class RouteSheetViewSet(viewsets.ModelViewSet):
                 elif isinstance(employee.harmful_factors, list):
                     harmful_factors_list = employee.harmful_factors
             
+            # Врачи клиники загружаются один раз - для шаблона услуг и для распределения времени
+            clinic_doctors = list(Doctor.objects.filter(user=user).values(*DOCTOR_FIELDS)) if user.role == 'clinic' else []
+            
             # Передаем user_id в метод генерации услуг через request
-            services = self._generate_services_for_position(employee.position, harmful_factors_list, user_id=user.id)
+            services = self._generate_services_for_position(
+                employee.position, harmful_factors_list, user_id=user.id, doctors=clinic_doctors
+            )
             
             # Убеждаемся, что services не пустой
             if not services:
@@ -3024,20 +2751,31 @@ class RouteSheetViewSet(viewsets.ModelViewSet):
                     'time': start_time.strftime('%H:%M'),
                     'status': 'pending',
                 }]
+            else:
+                # Врачи и время приема - с учетом уже записанных на эту дату пациентов
+                schedule_route_sheet(user, visit_date_obj, services, clinic_doctors)
             
-            route_sheet = RouteSheet.objects.create(
-                user=user,
-                patient_id=str(employee.id),
-                patient_name=employee.name,
-                iin=employee.iin or '',
-                position=employee.position,
-                department=employee.department,
-                visit_date=visit_date_obj,
-                services=services,
-            )
-            
-            # Автоматически создаем лабораторные и функциональные исследования
-            self._create_required_tests(route_sheet, employee.position, harmful_factors_list)
+            # Маршрутный лист уникален по (клиника, пациент, дата визита): если он уже есть
+            # (в том числе создан параллельным запросом), возвращаем существующий
+            try:
+                with transaction.atomic():
+                    route_sheet = RouteSheet.objects.create(
+                        user=user,
+                        patient_id=str(employee.id),
+                        patient_name=employee.name,
+                        iin=employee.iin or '',
+                        position=employee.position,
+                        department=employee.department,
+                        visit_date=visit_date_obj,
+                    )
+                    route_sheet.set_services(services)
+                    
+                    # Автоматически создаем лабораторные и функциональные исследования
+                    provision_required_tests([(route_sheet, employee.position, harmful_factors_list)])
+            except IntegrityError:
+                existing = RouteSheet.objects.get(user=user, patient_id=str(employee.id), visit_date=visit_date_obj)
+                serializer = RouteSheetSerializer(existing)
+                return Response(serializer.data, status=status.HTTP_200_OK)
             
             serializer = RouteSheetSerializer(route_sheet)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -3091,14 +2829,13 @@ class RouteSheetViewSet(viewsets.ModelViewSet):
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    def _generate_services_for_position(self, position, harmful_factors, user_id=None):
+    def _generate_services_for_position(self, position, harmful_factors, user_id=None, doctors=None):
         """
         Генерация услуг на основе должности и вредных факторов.
         Использует реальных врачей из базы данных клиники.
         Вредные факторы имеют приоритет - если указаны, добавляются дополнительные услуги.
+        doctors - уже загруженные врачи клиники (Doctor.objects.values(*DOCTOR_FIELDS)), иначе загружаются здесь.
         """
-        from datetime import datetime, timedelta
-        
         # Получаем user_id из параметра или из запроса
         if not user_id:
             if hasattr(self, 'request') and self.request:
@@ -3110,200 +2847,23 @@ class RouteSheetViewSet(viewsets.ModelViewSet):
                 if self.request.user.role == 'clinic':
                     user_id = self.request.user.id
         
-        # Получаем врачей клиники из базы данных
-        doctors_by_specialization = {}
+        clinic_user = None
         if user_id:
             try:
-                user = User.objects.get(id=user_id)
-                if user.role == 'clinic':
-                    doctors = Doctor.objects.filter(user=user)
-                    for doctor in doctors:
-                        spec = doctor.specialization
-                        if spec not in doctors_by_specialization:
-                            doctors_by_specialization[spec] = []
-                        doctors_by_specialization[spec].append({
-                            'id': str(doctor.id),
-                            'name': doctor.name,
-                            'cabinet': doctor.cabinet or '',
-                            'specialization': doctor.specialization,
-                        })
+                clinic_user = User.objects.get(id=user_id)
             except User.DoesNotExist:
                 pass
-        
-        def get_doctor_for_specialization(specialization):
-            """Получить первого доступного врача по специализации"""
-            if specialization in doctors_by_specialization and doctors_by_specialization[specialization]:
-                doctor = doctors_by_specialization[specialization][0]
-                return {
-                    'name': doctor['specialization'],
-                    'cabinet': doctor['cabinet'] or 'Не указан',
-                    'doctorId': doctor['id'],
-                    'specialization': doctor['specialization'],
-                }
-            return None
-        
-        # Базовые услуги для всех должностей
-        base_services = []
-        therapist = get_doctor_for_specialization('Терапевт')
-        if therapist:
-            base_services.append(therapist)
-        else:
-            base_services.append({'name': 'Терапевт', 'cabinet': 'Не указан', 'doctorId': '', 'specialization': 'Терапевт'})
-        
-        # Услуги на основе должности
-        position_to_specializations = {
-            'Бухгалтер': ['Терапевт', 'Окулист', 'Невропатолог'],
-            'Сварщик': ['Профпатолог', 'ЛОР', 'Окулист', 'Хирург', 'Невропатолог', 'Терапевт', 'Рентгенолог'],
-            'Водитель': ['Профпатолог', 'Окулист', 'Невропатолог', 'Терапевт'],
-        }
-        
-        # Начинаем с базовых услуг для должности
-        required_specializations = position_to_specializations.get(position, ['Терапевт'])
-        services = []
-        for spec in required_specializations:
-            doctor = get_doctor_for_specialization(spec)
-            if doctor:
-                services.append(doctor)
-            else:
-                # Если врача нет в БД, используем заглушку
-                services.append({
-                    'name': spec,
-                    'cabinet': 'Не указан',
-                    'doctorId': '',
-                    'specialization': spec,
-                })
-        
-        # Добавляем услуги на основе вредных факторов
-        harmful_factors_lower = [str(f).lower() for f in harmful_factors] if harmful_factors else []
-        
-        # Маппинг вредных факторов на дополнительные специализации
-        factor_to_specializations = {
-            'шум': ['ЛОР'],
-            'вибрация': ['Невропатолог'],
-            'пыль': ['ЛОР', 'Рентгенолог'],
-            'химические вещества': ['Терапевт', 'Профпатолог'],
-            'излучение': ['Окулист', 'Рентгенолог'],
-            'высотные работы': ['Невропатолог', 'Окулист'],
-        }
-        
-        # Добавляем услуги на основе вредных факторов
-        added_services = []
-        for factor in harmful_factors_lower:
-            for key, specializations in factor_to_specializations.items():
-                if key in factor:
-                    for spec in specializations:
-                        # Проверяем, нет ли уже такой услуги
-                        if not any(s['specialization'] == spec for s in services):
-                            doctor = get_doctor_for_specialization(spec)
-                            if doctor:
-                                added_services.append(doctor)
-                            else:
-                                added_services.append({
-                                    'name': spec,
-                                    'cabinet': 'Не указан',
-                                    'doctorId': '',
-                                    'specialization': spec,
-                                })
-        
-        services.extend(added_services)
-        
-        # Удаляем дубликаты по специализации
-        seen = set()
-        unique_services = []
-        for service in services:
-            if service['specialization'] not in seen:
-                seen.add(service['specialization'])
-                unique_services.append(service)
-        services = unique_services
-        
-        # Генерируем время для каждого кабинета (начиная с 9:00, по 15 минут на кабинет)
-        start_time = datetime.strptime('09:00', '%H:%M')
-        result_services = []
-        for idx, service in enumerate(services):
-            service_time = start_time + timedelta(minutes=idx * 15)
-            result_services.append({
-                'id': str(idx),
-                'name': service['name'],
-                'cabinet': service['cabinet'],
-                'doctorId': service['doctorId'],
-                'specialization': service.get('specialization', service['name']),
-                'time': service_time.strftime('%H:%M'),
-                'status': 'pending',
-            })
-        
-        return result_services
-
-    def _create_required_tests(self, route_sheet, position, harmful_factors):
-        """Автоматическое создание лабораторных и функциональных исследований на основе должности и вредных факторов"""
-        # Базовые лабораторные исследования для всех
-        base_lab_tests = [
-            {'test_type': 'Общий анализ крови', 'test_name': 'ОАК'},
-            {'test_type': 'Общий анализ мочи', 'test_name': 'ОАМ'},
-        ]
-        
-        # Лабораторные исследования на основе должности
-        position_lab_tests = {
-            'Сварщик': [
-                {'test_type': 'Биохимия крови', 'test_name': 'Биохимия'},
-                {'test_type': 'Анализ на тяжелые металлы', 'test_name': 'Тяжелые металлы'},
-            ],
-            'Водитель': [
-                {'test_type': 'Анализ на алкоголь и наркотики', 'test_name': 'Алкоголь/наркотики'},
-            ],
-        }
-        
-        # Функциональные исследования на основе должности
-        position_func_tests = {
-            'Сварщик': [
-                {'test_type': 'Рентген легких', 'test_name': 'Флюорография'},
-            ],
-            'Водитель': [
-                {'test_type': 'ЭКГ', 'test_name': 'Электрокардиограмма'},
-            ],
-        }
-        
-        # Добавляем лабораторные исследования
-        lab_tests = base_lab_tests.copy()
-        if position in position_lab_tests:
-            lab_tests.extend(position_lab_tests[position])
-        
-        # Добавляем на основе вредных факторов
-        harmful_factors_lower = [str(f).lower() for f in harmful_factors] if harmful_factors else []
-        if any('пыль' in f for f in harmful_factors_lower):
-            lab_tests.append({'test_type': 'Анализ мокроты', 'test_name': 'Мокрота'})
-        
-        # Создаем лабораторные исследования
-        for test_data in lab_tests:
-            LaboratoryTest.objects.create(
-                route_sheet=route_sheet,
-                patient_id=route_sheet.patient_id,
-                patient_name=route_sheet.patient_name,
-                test_type=test_data['test_type'],
-                test_name=test_data['test_name'],
-                status='pending',
-            )
-        
-        # Добавляем функциональные исследования
-        func_tests = []
-        if position in position_func_tests:
-            func_tests.extend(position_func_tests[position])
-        
-        # Добавляем на основе вредных факторов
-        if any('шум' in f for f in harmful_factors_lower):
-            func_tests.append({'test_type': 'Аудиометрия', 'test_name': 'Проверка слуха'})
-        if any('вибрация' in f for f in harmful_factors_lower):
-            func_tests.append({'test_type': 'Спирометрия', 'test_name': 'Функция дыхания'})
-        
-        # Создаем функциональные исследования
-        for test_data in func_tests:
-            FunctionalTest.objects.create(
-                route_sheet=route_sheet,
-                patient_id=route_sheet.patient_id,
-                patient_name=route_sheet.patient_name,
-                test_type=test_data['test_type'],
-                test_name=test_data['test_name'],
-                status='pending',
-            )
+        if clinic_user is None or clinic_user.role != 'clinic':
+            return build_services_for_position(position, harmful_factors, {})
+        
+        # Шаблон услуг берется из кеша (по клинике, составу врачей, должности и набору факторов).
+        # Врачи загружаются одним запросом, версия состава вычисляется по ним же
+        if doctors is None:
+            doctors = list(Doctor.objects.filter(user=clinic_user).values(*DOCTOR_FIELDS))
+        return service_templates.get_services(
+            clinic_user, clinic_roster_version(clinic_user, doctors), position, harmful_factors,
+            lambda: load_clinic_doctors(clinic_user, doctors),
+        )
 
 
 class DoctorExaminationViewSet(viewsets.ModelViewSet):
@@ -3360,7 +2920,7 @@ class DoctorExaminationViewSet(viewsets.ModelViewSet):
                 history_by_date[exam_date]['examinations'].append(exam_data)
             
             # Получаем маршрутные листы
-            route_sheets = RouteSheet.objects.filter(patient_id=patient_id).order_by('-visit_date')
+            route_sheets = RouteSheet.objects.filter(patient_id=patient_id).prefetch_related('service_items').order_by('-visit_date')
             for rs in route_sheets:
                 rs_date = rs.visit_date.strftime('%Y-%m-%d') if rs.visit_date else 'Без даты'
                 if rs_date not in history_by_date:
@@ -3371,15 +2931,16 @@ class DoctorExaminationViewSet(viewsets.ModelViewSet):
                     }
                 
                 # Подсчитываем завершенные услуги
-                completed_services = sum(1 for s in (rs.services or []) if s.get('status') == 'completed')
-                total_services = len(rs.services or [])
+                services = rs.services
+                completed_services = sum(1 for s in services if s['status'] == 'completed')
+                total_services = len(services)
                 
                 route_sheet_data = {
                     'id': rs.id,
                     'visit_date': rs.visit_date.isoformat() if rs.visit_date else None,
                     'completed_services': completed_services,
                     'total_services': total_services,
-                    'services': rs.services or [],
+                    'services': services,
                 }
                 history_by_date[rs_date]['route_sheets'].append(route_sheet_data)
             
@@ -3451,10 +3012,9 @@ class ExpertiseViewSet(viewsets.ModelViewSet):
                 return errors
         
         # Проверяем, что все услуги завершены
-        services = route_sheet.services if isinstance(route_sheet.services, list) else []
-        pending_services = [s for s in services if s.get('status') != 'completed']
+        pending_services = route_sheet.service_items.exclude(status='completed').count()
         if pending_services:
-            errors.append(f'Не все врачи завершили осмотр. Осталось: {len(pending_services)}')
+            errors.append(f'Не все врачи завершили осмотр. Осталось: {pending_services}')
         
         # Проверяем лабораторные исследования
         lab_tests = LaboratoryTest.objects.filter(patient_id=patient_id, route_sheet=route_sheet)
@@ -3476,26 +3036,17 @@ class ExpertiseViewSet(viewsets.ModelViewSet):
         department = request.query_params.get('department')
         
         try:
-            user = User.objects.get(id=user_id)
-            queryset = Expertise.objects.filter(user=user, final_verdict__isnull=False)
-            if department:
-                queryset = queryset.filter(department=department)
-            
-            # Calculate occupational diseases
-            occupational_diseases = 0
-            for exp in queryset:
-                if exp.doctor_conclusions:
-                    for conclusion in exp.doctor_conclusions:
-                        if isinstance(conclusion, dict) and conclusion.get('notes', '').lower().find('профзаболевание') != -1:
-                            occupational_diseases += 1
-                            break
+            if get_access_context(user_id) is None:
+                raise User.DoesNotExist
+            # Итоги по заключениям и профзаболеваниям - один агрегирующий запрос
+            report = examination_stats(finished_expertises(user_id, department))
             
             stats = {
-                'totalExamined': queryset.count(),
-                'healthy': queryset.filter(final_verdict='fit').count(),
-                'temporaryContraindications': queryset.filter(final_verdict='temporary_unfit').count(),
-                'permanentContraindications': queryset.filter(final_verdict='permanent_unfit').count(),
-                'occupationalDiseases': occupational_diseases,
+                'totalExamined': report.total,
+                'healthy': report.healthy,
+                'temporaryContraindications': report.temporary,
+                'permanentContraindications': report.permanent,
+                'occupationalDiseases': report.occupational_diseases,
             }
             
             return Response(stats, status=status.HTTP_200_OK)
@@ -3538,41 +3089,25 @@ class ExpertiseViewSet(viewsets.ModelViewSet):
 
     def _update_contract_status(self, expertise):
         """Обновление статуса договора при завершении медосмотра"""
-        # Находим сотрудника по ИИН
-        employee = ContingentEmployee.objects.filter(iin=expertise.iin).first()
-        if not employee or not employee.user:
+        if not expertise.iin:
             return
         
-        # Находим активные договоры работодателя с клиникой
+        # Находим активные договоры клиники, в контингенте которых есть сотрудник с этим ИИН
         contracts = Contract.objects.filter(
-            employer=employee.user,
-            clinic=expertise.user,
-            status__in=['in_progress', 'partially_executed']
+            clinic_id=expertise.user_id,
+            status__in=['in_progress', 'partially_executed'],
+            people_count__gt=0,
+        ).filter(
+            Exists(ContingentEmployee.objects.filter(
+                Q(contract_id=OuterRef('pk')) | Q(user_id=OuterRef('employer_id')),
+                iin=expertise.iin,
+            ))
         )
         
         for contract in contracts:
-            # Подсчитываем завершенные медосмотры
+            # Подсчитываем завершенные медосмотры (один запрос на договор)
             total_people = contract.people_count
-            if total_people == 0:
-                continue
-            
-            # Получаем все экспертизы для сотрудников работодателя
-            expertises = Expertise.objects.filter(
-                user=contract.clinic,
-                final_verdict__isnull=False
-            )
-            
-            # Подсчитываем уникальных пациентов с завершенными экспертизами
-            completed_patients = set()
-            for exp in expertises:
-                emp = ContingentEmployee.objects.filter(
-                    user=contract.employer,
-                    iin=exp.iin
-                ).first()
-                if emp:
-                    completed_patients.add(exp.patient_id)
-            
-            completed_count = len(completed_patients)
+            completed_count = contract.completed_examinations_count()
             percentage = (completed_count / total_people) * 100 if total_people > 0 else 0
             
             # Обновляем статус договора
@@ -3716,30 +3251,13 @@ class ExpertiseViewSet(viewsets.ModelViewSet):
         end_date = request.query_params.get('end_date')
         
         try:
-            user = User.objects.get(id=user_id)
-            queryset = Expertise.objects.filter(user=user, final_verdict__isnull=False)
+            if get_access_context(user_id) is None:
+                raise User.DoesNotExist
             
-            if department:
-                queryset = queryset.filter(department=department)
-            if start_date:
-                queryset = queryset.filter(verdict_date__gte=start_date)
-            if end_date:
-                queryset = queryset.filter(verdict_date__lte=end_date)
-            
-            # Подсчет статистики
-            total = queryset.count()
-            healthy = queryset.filter(final_verdict='fit').count()
-            temporary = queryset.filter(final_verdict='temporary_unfit').count()
-            permanent = queryset.filter(final_verdict='permanent_unfit').count()
-            
-            # Подсчет профзаболеваний
-            occupational_diseases = 0
-            for exp in queryset:
-                if exp.doctor_conclusions:
-                    for conclusion in exp.doctor_conclusions:
-                        if isinstance(conclusion, dict) and conclusion.get('notes', '').lower().find('профзаболевание') != -1:
-                            occupational_diseases += 1
-                            break
+            # Подсчет статистики: итоги, профзаболевания и отделы - один запрос GROUP BY
+            report = examination_stats(finished_expertises(user_id, department, start_date, end_date))
+            total, healthy, temporary, permanent = report.total, report.healthy, report.temporary, report.permanent
+            occupational_diseases = report.occupational_diseases
             
             # Создание PDF
             buffer = io.BytesIO()
@@ -3791,19 +3309,8 @@ class ExpertiseViewSet(viewsets.ModelViewSet):
             elements.append(table)
             elements.append(Spacer(1, 0.3*inch))
             
-            # Статистика по отделам
-            department_stats = {}
-            for exp in queryset:
-                dept = exp.department
-                if dept not in department_stats:
-                    department_stats[dept] = {'total': 0, 'healthy': 0, 'temporary': 0, 'permanent': 0}
-                department_stats[dept]['total'] += 1
-                if exp.final_verdict == 'fit':
-                    department_stats[dept]['healthy'] += 1
-                elif exp.final_verdict == 'temporary_unfit':
-                    department_stats[dept]['temporary'] += 1
-                elif exp.final_verdict == 'permanent_unfit':
-                    department_stats[dept]['permanent'] += 1
+            # Статистика по отделам (посчитана тем же запросом)
+            department_stats = {item['department']: item for item in report.departments}
             
             if department_stats:
                 elements.append(Paragraph('Статистика по отделам', styles['Heading2']))
@@ -3845,30 +3352,13 @@ class ExpertiseViewSet(viewsets.ModelViewSet):
         end_date = request.query_params.get('end_date')
         
         try:
-            user = User.objects.get(id=user_id)
-            queryset = Expertise.objects.filter(user=user, final_verdict__isnull=False)
+            if get_access_context(user_id) is None:
+                raise User.DoesNotExist
             
-            if department:
-                queryset = queryset.filter(department=department)
-            if start_date:
-                queryset = queryset.filter(verdict_date__gte=start_date)
-            if end_date:
-                queryset = queryset.filter(verdict_date__lte=end_date)
-            
-            # Подсчет статистики
-            total = queryset.count()
-            healthy = queryset.filter(final_verdict='fit').count()
-            temporary = queryset.filter(final_verdict='temporary_unfit').count()
-            permanent = queryset.filter(final_verdict='permanent_unfit').count()
-            
-            # Подсчет профзаболеваний
-            occupational_diseases = 0
-            for exp in queryset:
-                if exp.doctor_conclusions:
-                    for conclusion in exp.doctor_conclusions:
-                        if isinstance(conclusion, dict) and conclusion.get('notes', '').lower().find('профзаболевание') != -1:
-                            occupational_diseases += 1
-                            break
+            # Подсчет статистики: итоги, профзаболевания и отделы - один запрос GROUP BY
+            report = examination_stats(finished_expertises(user_id, department, start_date, end_date))
+            total, healthy, temporary, permanent = report.total, report.healthy, report.temporary, report.permanent
+            occupational_diseases = report.occupational_diseases
             
             # Создание Excel
             wb = Workbook()
@@ -3920,18 +3410,7 @@ class ExpertiseViewSet(viewsets.ModelViewSet):
             for col in ['A', 'B', 'C', 'D', 'E']:
                 ws[f'{col}{row}'].font = Font(bold=True)
             
-            department_stats = {}
-            for exp in queryset:
-                dept = exp.department
-                if dept not in department_stats:
-                    department_stats[dept] = {'total': 0, 'healthy': 0, 'temporary': 0, 'permanent': 0}
-                department_stats[dept]['total'] += 1
-                if exp.final_verdict == 'fit':
-                    department_stats[dept]['healthy'] += 1
-                elif exp.final_verdict == 'temporary_unfit':
-                    department_stats[dept]['temporary'] += 1
-                elif exp.final_verdict == 'permanent_unfit':
-                    department_stats[dept]['permanent'] += 1
+            department_stats = {item['department']: item for item in report.departments}
             
             for dept, stats in department_stats.items():
                 row += 1
@@ -3977,25 +3456,13 @@ class ExpertiseViewSet(viewsets.ModelViewSet):
         department = request.query_params.get('department')
         
         try:
-            user = User.objects.get(id=user_id)
-            queryset = Expertise.objects.filter(user=user, final_verdict__isnull=False)
-            if department:
-                queryset = queryset.filter(department=department)
+            if get_access_context(user_id) is None:
+                raise User.DoesNotExist
             
-            # Подсчет статистики
-            total = queryset.count()
-            healthy = queryset.filter(final_verdict='fit').count()
-            temporary = queryset.filter(final_verdict='temporary_unfit').count()
-            permanent = queryset.filter(final_verdict='permanent_unfit').count()
-            
-            # Подсчет профзаболеваний
-            occupational_diseases = 0
-            for exp in queryset:
-                if exp.doctor_conclusions:
-                    for conclusion in exp.doctor_conclusions:
-                        if isinstance(conclusion, dict) and conclusion.get('notes', '').lower().find('профзаболевание') != -1:
-                            occupational_diseases += 1
-                            break
+            # Подсчет статистики (итоги и профзаболевания - один агрегирующий запрос)
+            report = examination_stats(finished_expertises(user_id, department))
+            total, healthy, temporary, permanent = report.total, report.healthy, report.temporary, report.permanent
+            occupational_diseases = report.occupational_diseases
             
             # Создание PDF
             buffer = io.BytesIO()
@@ -4075,25 +3542,13 @@ class ExpertiseViewSet(viewsets.ModelViewSet):
         department = request.query_params.get('department')
         
         try:
-            user = User.objects.get(id=user_id)
-            queryset = Expertise.objects.filter(user=user, final_verdict__isnull=False)
-            if department:
-                queryset = queryset.filter(department=department)
+            if get_access_context(user_id) is None:
+                raise User.DoesNotExist
             
-            # Подсчет статистики
-            total = queryset.count()
-            healthy = queryset.filter(final_verdict='fit').count()
-            temporary = queryset.filter(final_verdict='temporary_unfit').count()
-            permanent = queryset.filter(final_verdict='permanent_unfit').count()
-            
-            # Подсчет профзаболеваний
-            occupational_diseases = 0
-            for exp in queryset:
-                if exp.doctor_conclusions:
-                    for conclusion in exp.doctor_conclusions:
-                        if isinstance(conclusion, dict) and conclusion.get('notes', '').lower().find('профзаболевание') != -1:
-                            occupational_diseases += 1
-                            break
+            # Подсчет статистики (итоги и профзаболевания - один агрегирующий запрос)
+            report = examination_stats(finished_expertises(user_id, department))
+            total, healthy, temporary, permanent = report.total, report.healthy, report.temporary, report.permanent
+            occupational_diseases = report.occupational_diseases
             
             # Создание Excel файла
             wb = Workbook()
@@ -4653,12 +4108,7 @@ class PatientQueueViewSet(viewsets.ModelViewSet):
             route_sheet = RouteSheet.objects.get(id=route_sheet_id)
             user = User.objects.get(id=user_id)
             
-            services = route_sheet.services if isinstance(route_sheet.services, list) else []
-            service = None
-            for s in services:
-                if str(s.get('id')) == str(service_id):
-                    service = s
-                    break
+            service = route_sheet.service_items.filter(service_id=str(service_id)).first()
             
             if not service:
                 return Response({'error': 'Service not found in route sheet'}, status=status.HTTP_404_NOT_FOUND)
@@ -4666,7 +4116,7 @@ class PatientQueueViewSet(viewsets.ModelViewSet):
             existing = PatientQueue.objects.filter(
                 user=user,
                 route_sheet=route_sheet,
-                service_name=service.get('name'),
+                service_name=service.name,
                 status__in=['waiting', 'called', 'in_progress']
             ).first()
             
@@ -4681,13 +4131,7 @@ class PatientQueueViewSet(viewsets.ModelViewSet):
             
             queue_number = (last_queue.queue_number + 1) if last_queue else 1
             
-            doctor_id = service.get('doctorId') or service.get('doctor_id')
-            doctor = None
-            if doctor_id:
-                try:
-                    doctor = Doctor.objects.get(id=doctor_id)
-                except Doctor.DoesNotExist:
-                    pass
+            doctor = service.doctor
             
             queue_entry = PatientQueue.objects.create(
                 user=user,
@@ -4696,8 +4140,8 @@ class PatientQueueViewSet(viewsets.ModelViewSet):
                 patient_id=route_sheet.patient_id,
                 patient_name=route_sheet.patient_name,
                 iin=route_sheet.iin,
-                service_name=service.get('name'),
-                cabinet=service.get('cabinet', ''),
+                service_name=service.name,
+                cabinet=service.cabinet,
                 priority=priority,
                 queue_number=queue_number,
             )
@@ -4726,47 +4170,23 @@ class ContractViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         user_id = self.request.query_params.get('user_id')
         if user_id:
-            try:
-                user = User.objects.get(id=user_id)
-                # Работодатель видит свои договоры
-                if user.role == 'employer':
-                    # Ищем договоры где employer = user ИЛИ employer_bin совпадает с БИН работодателя
-                    reg_data = user.registration_data or {}
-                    employer_bin = reg_data.get('bin') or reg_data.get('inn')
-                    
-                    if employer_bin:
-                        # Нормализуем БИН для поиска
-                        bin_normalized = ''.join(str(employer_bin).strip().split())
-                        
-                        # Ищем договоры по разным вариантам БИН
-                        # 1. employer = user (прямая связь)
-                        # 2. employer_bin совпадает с нормализованным БИН
-                        # 3. employer_bin совпадает с исходным БИН (на случай если в БД хранится с пробелами)
-                        contracts = Contract.objects.filter(
-                            Q(employer=user) | 
-                            Q(employer_bin=bin_normalized) | 
-                            Q(employer_bin=employer_bin) |
-                            Q(employer_bin=str(employer_bin).strip())
-                        ).distinct()
-                        
-                        print(f"[ContractViewSet] Employer {user.id} BIN: {employer_bin}, normalized: {bin_normalized}")
-                        print(f"[ContractViewSet] Found {contracts.count()} contracts")
-                        
-                        return contracts
-                    else:
-                        return Contract.objects.filter(employer=user)
-                # Клиника видит свои договоры
-                elif user.role == 'clinic':
-                    # Клиника видит:
-                    # 1. Договоры где она является основной клиникой (clinic=user)
-                    # 2. Договоры переданные ей на субподряд (subcontractor_clinic=user)
-                    # 3. Договоры которые она передала на субподряд (original_clinic=user)
-                    return Contract.objects.filter(
-                        Q(clinic=user) | Q(subcontractor_clinic=user) | Q(original_clinic=user)
-                    )
-                else:
-                    return Contract.objects.none()
-            except User.DoesNotExist:
+            context = get_access_context(user_id)
+            if context is None:
+                return Contract.objects.none()
+            # Работодатель видит свои договоры: employer = user или employer_bin совпадает с БИН работодателя
+            # (в нормализованном или исходном виде) - список ID уже вычислен в контексте доступа
+            if context.is_employer:
+                return Contract.objects.filter(id__in=context.contract_ids())
+            # Клиника видит свои договоры
+            elif context.is_clinic:
+                # Клиника видит:
+                # 1. Договоры где она является основной клиникой (clinic=user)
+                # 2. Договоры переданные ей на субподряд (subcontractor_clinic=user)
+                # 3. Договоры которые она передала на субподряд (original_clinic=user)
+                return Contract.objects.filter(
+                    Q(clinic_id=context.user_id) | Q(subcontractor_clinic_id=context.user_id) | Q(original_clinic_id=context.user_id)
+                )
+            else:
                 return Contract.objects.none()
         return Contract.objects.all()
     
@@ -4790,27 +4210,14 @@ class ContractViewSet(viewsets.ModelViewSet):
                 # Если указан БИН, ищем работодателя
                 if employer_bin:
                     # Нормализуем БИН
-                    bin_normalized = ''.join(str(employer_bin).strip().split())
+                    bin_normalized = normalize_bin(employer_bin)
                     
                     print(f"[ContractCreate] Searching for employer with BIN: {employer_bin}, normalized: {bin_normalized}")
                     
-                    # Ищем по полям 'bin' и 'inn' в registration_data
-                    employers = User.objects.filter(role='employer')
-                    print(f"[ContractCreate] Total employers in DB: {employers.count()}")
-                    
-                    for emp in employers:
-                        reg_data = emp.registration_data or {}
-                        emp_bin = str(reg_data.get('bin', '')).strip()
-                        emp_inn = str(reg_data.get('inn', '')).strip()
-                        
-                        # Нормализуем для сравнения
-                        emp_bin_normalized = ''.join(emp_bin.split())
-                        emp_inn_normalized = ''.join(emp_inn.split())
-                        
-                        if emp_bin_normalized == bin_normalized or emp_inn_normalized == bin_normalized:
-                            employer = emp
-                            print(f"[ContractCreate] Found employer: {emp.id}, name: {reg_data.get('name', 'N/A')}")
-                            break
+                    # Поиск по индексированному полю bin (заполняется из registration_data при сохранении)
+                    employer = User.objects.filter(role='employer', bin=bin_normalized).first() if bin_normalized else None
+                    if employer:
+                        print(f"[ContractCreate] Found employer: {employer.id}, name: {(employer.registration_data or {}).get('name', 'N/A')}")
                     
                     if not employer:
                         print(f"[ContractCreate] WARNING: Employer not found for BIN: {employer_bin}")
@@ -5650,28 +5057,8 @@ class ContractViewSet(viewsets.ModelViewSet):
         
         # Подсчитываем количество завершенных медосмотров
         # Медосмотр считается завершенным, если есть заключение профпатолога (Expertise с final_verdict)
-        completed_count = 0
-        
-        # Получаем всех сотрудников работодателя по договору
-        if contract.employer:
-            # Получаем все экспертизы для сотрудников работодателя
-            expertises = Expertise.objects.filter(
-                user=contract.clinic,
-                final_verdict__isnull=False
-            )
-            
-            # Подсчитываем уникальных пациентов с завершенными экспертизами
-            completed_patients = set()
-            for expertise in expertises:
-                # Проверяем, что пациент относится к работодателю по договору
-                employee = ContingentEmployee.objects.filter(
-                    user=contract.employer,
-                    iin=expertise.iin
-                ).first()
-                if employee:
-                    completed_patients.add(expertise.patient_id)
-            
-            completed_count = len(completed_patients)
+        # у пациента из контингента договора (сопоставление по ИИН одним запросом)
+        completed_count = contract.completed_examinations_count()
         
         # Вычисляем процент выполнения
         percentage = (completed_count / total_people) * 100 if total_people > 0 else 0
@@ -4,41 +4,54 @@
 from openpyxl import load_workbook
 import sys
 
+# Data Validation доступна только при полной загрузке книги (read-only режим ее не читает),
+# поэтому полная загрузка выполняется только для файлов не больше этого количества строк
+MAX_ROWS_FOR_FULL_LOAD = 5000
+
 def check_excel_file(filename):
     print(f"\n{'='*60}")
     print(f"Проверка файла: {filename}")
     print(f"{'='*60}\n")
     
     try:
-        wb = load_workbook(filename)
+        # Листы и справочники читаем потоково, без материализации всех ячеек и стилей
+        wb = load_workbook(filename, read_only=True, data_only=True)
         
         # Список всех листов
         print(f"📋 Листы в файле:")
         for sheet_name in wb.sheetnames:
             sheet = wb[sheet_name]
             state = sheet.sheet_state
-            print(f"  - {sheet_name} (состояние: {state})")
+            print(f"  - {sheet_name} (состояние: {state}, строк: {sheet.max_row or 'неизвестно'})")
         
         # Проверка основного листа
         main_sheet = wb.active
         print(f"\n📊 Активный лист: {main_sheet.title}")
         
         # Ищем лист "Список контингента"
-        contingent_sheet = None
+        check_sheet_name = main_sheet.title
         for sheet_name in wb.sheetnames:
             if "контингент" in sheet_name.lower():
-                contingent_sheet = wb[sheet_name]
+                check_sheet_name = sheet_name
                 break
         
-        if contingent_sheet and contingent_sheet != main_sheet:
-            print(f"   (Проверяем Data Validation на листе: {contingent_sheet.title})")
-            check_sheet = contingent_sheet
-        else:
-            check_sheet = main_sheet
+        if check_sheet_name != main_sheet.title:
+            print(f"   (Проверяем Data Validation на листе: {check_sheet_name})")
         
         # Проверка Data Validation
         print(f"\n🔍 Data Validation правила:")
-        if hasattr(check_sheet, 'data_validations') and check_sheet.data_validations:
+        check_sheet_rows = wb[check_sheet_name].max_row or 0
+        check_sheet = None
+        if check_sheet_rows > MAX_ROWS_FOR_FULL_LOAD:
+            print(f"  ⚠️  Лист содержит {check_sheet_rows} строк - проверка Data Validation пропущена (лимит {MAX_ROWS_FOR_FULL_LOAD})")
+        else:
+            full_wb = load_workbook(filename)
+            check_sheet = full_wb[check_sheet_name]
+            full_wb.close()
+        
+        if check_sheet is None:
+            pass
+        elif hasattr(check_sheet, 'data_validations') and check_sheet.data_validations:
             if len(check_sheet.data_validations.dataValidation) > 0:
                 for idx, dv in enumerate(check_sheet.data_validations.dataValidation, 1):
                     print(f"\n  Правило #{idx}:")
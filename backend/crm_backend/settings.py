@@ -150,6 +150,42 @@ CACHES = {
         'LOCATION': 'cache_table',
     }
 }
+# Кеш контекста доступа (api.access_context): Redis, если задан ACCESS_CONTEXT_CACHE_URL (нужен пакет redis),
+# иначе память процесса. DatabaseCache не подходит - чтение из него стоит столько же запросов, сколько вычисление.
+# В памяти процесса сброс по сигналам действует только в текущем процессе: в остальных воркерах
+# контекст обновится не позже ACCESS_CONTEXT_CACHE_TIMEOUT
+ACCESS_CONTEXT_CACHE_URL = os.environ.get('ACCESS_CONTEXT_CACHE_URL', '')
+CACHES['access_context'] = (
+    {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': ACCESS_CONTEXT_CACHE_URL}
+    if ACCESS_CONTEXT_CACHE_URL else
+    {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'access-context'}
+)
+
+# Загрузка контингента из Excel
+# Размер пачки для bulk_create при массовой вставке сотрудников
+CONTINGENT_IMPORT_BATCH_SIZE = int(os.environ.get('CONTINGENT_IMPORT_BATCH_SIZE', '1000'))
+# Максимальное количество строк в одном файле (файлы больше отклоняются до чтения данных)
+CONTINGENT_IMPORT_MAX_ROWS = int(os.environ.get('CONTINGENT_IMPORT_MAX_ROWS', '50000'))
+# Начиная с какого количества строк файл загружается через PostgreSQL COPY вместо bulk_create (0 - отключено)
+CONTINGENT_IMPORT_COPY_THRESHOLD = int(os.environ.get('CONTINGENT_IMPORT_COPY_THRESHOLD', '5000'))
+# Параллельный разбор строк: количество процессов и минимальный размер файла (в строках, 0 - отключено)
+CONTINGENT_IMPORT_WORKERS = int(os.environ.get('CONTINGENT_IMPORT_WORKERS', str(min(os.cpu_count() or 1, 4))))
+CONTINGENT_IMPORT_PARALLEL_THRESHOLD = int(os.environ.get('CONTINGENT_IMPORT_PARALLEL_THRESHOLD', '10000'))
+
+# Маршрутные листы: количество шаблонов услуг (клиника, должность, набор вредных факторов) в кеше процесса
+ROUTE_SHEET_TEMPLATE_CACHE_SIZE = int(os.environ.get('ROUTE_SHEET_TEMPLATE_CACHE_SIZE', '512'))
+# Маршрутные листы: длительность приема у одного специалиста (минуты) при распределении времени
+ROUTE_SHEET_SLOT_MINUTES = int(os.environ.get('ROUTE_SHEET_SLOT_MINUTES', '15'))
+# Маршрутные листы: максимум услуг в одном запросе bulk_update_service_status
+ROUTE_SHEET_BULK_STATUS_MAX_ITEMS = int(os.environ.get('ROUTE_SHEET_BULK_STATUS_MAX_ITEMS', '500'))
+# Создание маршрутных листов при утверждении плана фоновой задачей (False - сразу в запросе, например без обработчика задач)
+CALENDAR_PLAN_ROUTE_SHEETS_ASYNC = os.environ.get('CALENDAR_PLAN_ROUTE_SHEETS_ASYNC', 'True') == 'True'
+# Фоновые задачи: количество попыток и задержка перед повтором (секунды, умножается на номер попытки)
+BACKGROUND_JOB_MAX_ATTEMPTS = int(os.environ.get('BACKGROUND_JOB_MAX_ATTEMPTS', '3'))
+BACKGROUND_JOB_RETRY_DELAY = int(os.environ.get('BACKGROUND_JOB_RETRY_DELAY', '60'))
+
+# Контекст доступа пользователя (роль, БИН, доступные договоры): время жизни в кеше, секунды
+ACCESS_CONTEXT_CACHE_TIMEOUT = int(os.environ.get('ACCESS_CONTEXT_CACHE_TIMEOUT', '60'))
 
 # Green API settings
 GREEN_API_ID_INSTANCE = os.environ.get('GREEN_API_ID_INSTANCE', '7105394320')
@@ -1084,7 +1084,7 @@ export default function ContractContingentPage() {
                 </p>
                 <input
                   type="file"
-                  accept=".xlsx,.xls"
+                  accept=".xlsx,.xls,.csv,.tsv"
                   onChange={handleFileUpload}
                   disabled={isUploading}
                   className="hidden"
@@ -1100,7 +1100,7 @@ export default function ContractContingentPage() {
           </div>
           
           <div className="text-sm text-gray-500 dark:text-gray-400">
-            <p>Поддерживаемые форматы: .xlsx, .xls</p>
+            <p>Поддерживаемые форматы: .xlsx, .xls, .csv, .tsv</p>
             <p>Максимальный размер файла: 10 МБ</p>
           </div>
         </div>
@@ -1890,14 +1890,14 @@ export default function ContractsPage() {
                     <input
                       id="clinic-file-upload-input"
                       type="file"
-                      accept=".xlsx,.xls"
+                      accept=".xlsx,.xls,.csv,.tsv"
                       onChange={(e) => handleFileUpload(e, showUploadModal)}
                       className="hidden"
                       disabled={isUploading}
                     />
                   </label>
                   <p className="text-xs text-gray-500 dark:text-gray-400 mt-4">
-                    Поддерживаются файлы .xlsx, .xls. Формат согласно приказу №131: № п/п, ФИО, Дата рождения, Пол, Объект или участок, Занимаемая должность, Общий стаж, Стаж по занимаемой должности, Дата последнего медосмотра, Профессиональная вредность, Примечание
+                    Поддерживаются файлы .xlsx, .xls, .csv, .tsv. Формат согласно приказу №131: № п/п, ФИО, Дата рождения, Пол, Объект или участок, Занимаемая должность, Общий стаж, Стаж по занимаемой должности, Дата последнего медосмотра, Профессиональная вредность, Примечание
                   </p>
                   {isUploading && (
                     <div className="mt-4">
@@ -556,7 +556,8 @@ class ApiClient {
     });
   }
 
-  async updateRouteSheetService(routeSheetId: string, serviceId: string, status: 'pending' | 'completed', userId?: string) {
+  // version - версия услуги из маршрутного листа: при конфликте (услугу уже изменили) сервер вернет 409
+  async updateRouteSheetService(routeSheetId: string, serviceId: string, status: 'pending' | 'completed', userId?: string, version?: number) {
     const url = `/route-sheets/${routeSheetId}/update_service_status/`;
     const params = userId ? `?user_id=${userId}` : '';
     return this.request(`${url}${params}`, {
@@ -565,6 +566,21 @@ class ApiClient {
         service_id: serviceId,
         status: status,
         user_id: userId,
+        ...(version !== undefined && { version }),
+      }),
+    });
+  }
+
+  // Пакетное обновление статусов услуг (результат по каждой позиции: updated / conflict / forbidden / not_found / invalid)
+  async bulkUpdateRouteSheetServices(
+    items: Array<{ route_sheet_id: string | number; service_id: string; status: 'pending' | 'completed'; version?: number }>,
+    userId?: string,
+  ) {
+    return this.request('/route-sheets/bulk_update_service_status/', {
+      method: 'POST',
+      body: JSON.stringify({
+        items,
+        user_id: userId,
       }),
     });
   }